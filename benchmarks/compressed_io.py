@@ -0,0 +1,143 @@
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import phantoms  # noqa: E402
+
+# Compressed NIfTI I/O with utils.niio against a single gzip stream read
+# and written by nibabel and the gzip module, per thread count: compressing
+# a volume, loading all of it, and reading the three GIF slices.
+
+
+def best_of(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def gzip_stream(in_file, out_file, level):
+    with open(in_file, "rb") as src:
+        with gzip.open(out_file, "wb", compresslevel=level) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+
+def run_size(size, threads_list, level, repeats, work_dir):
+    import nibabel as nb
+
+    from flirt_reg.reg import flirt_reg
+    from flirt_reg.utils import niio
+
+    data_dir = os.path.join(work_dir, str(size))
+    phantoms.write_series(data_dir, size=size, n_volumes=1)
+    nii_file = os.path.join(data_dir, "vol0000.nii")
+    stream_file = os.path.join(data_dir, "stream.nii.gz")
+    niio_file = os.path.join(data_dir, "niio.nii.gz")
+
+    results = [
+        {
+            "case": "gzip stream",
+            "threads": 1,
+            "compress_s": best_of(
+                lambda: gzip_stream(nii_file, stream_file, level), repeats
+            ),
+            "load_s": best_of(
+                lambda: nb.load(stream_file).get_fdata(), repeats
+            ),
+            "slices_s": best_of(
+                lambda: flirt_reg.get_gif_slices(nb.load(stream_file)),
+                repeats,
+            ),
+        }
+    ]
+    for threads in threads_list:
+        niio.configure(threads=threads)
+        results.append(
+            {
+                "case": "niio",
+                "threads": threads,
+                "compress_s": best_of(
+                    lambda: niio.compress_file(
+                        nii_file, niio_file, level=level
+                    ),
+                    repeats,
+                ),
+                "load_s": best_of(
+                    lambda: niio.load(niio_file).get_fdata(), repeats
+                ),
+                "slices_s": best_of(
+                    lambda: flirt_reg.get_gif_slices(nb.load(niio_file)),
+                    repeats,
+                ),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[128, 256],
+        help="phantom matrix sizes. Default: 128 256.",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        nargs="+",
+        type=int,
+        default=[1, 2, 4, 8],
+        help="niio thread counts. Default: 1 2 4 8.",
+    )
+    parser.add_argument(
+        "-l", "--level", type=int, default=1, help="gzip level. Default: 1."
+    )
+    parser.add_argument(
+        "-n",
+        "--repeats",
+        type=int,
+        default=3,
+        help="runs of each case, the best is kept. Default: 3.",
+    )
+    parser.add_argument(
+        "-o", "--output", help="write the results to this json file."
+    )
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="flirt_gz_") as work_dir:
+        for size in args.sizes:
+            print(f"Matrix size {size}")
+            for res in run_size(
+                size, args.threads, args.level, args.repeats, work_dir
+            ):
+                res["size"] = size
+                results.append(res)
+                print(
+                    f"  {res['case']:<12} {res['threads']:>2} threads: "
+                    f"compress {res['compress_s']:.3f} s, "
+                    f"load {res['load_s']:.3f} s, "
+                    f"GIF slices {res['slices_s']:.3f} s"
+                )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Import-time regression benchmark. The CLI entry points must not pull in
+# the GIF, FSL or GPU stacks until a stage actually needs them.
+
+HEAVY_MODULES = [
+    "matplotlib",
+    "nibabel",
+    "nipype",
+    "numpy",
+    "pygifsicle",
+    "gpuoptional",
+    "cupy",
+]
+
+ENTRY_MODULES = [
+    "flirt_reg.__main__",
+    "flirt_reg.reg.flirt_reg",
+    "flirt_reg.reg.omat",
+    "flirt_reg.utils.nii",
+]
+
+
+def time_import(module, repeats=5):
+    """
+    Best of repeats wall time in ms of importing module in a fresh
+    interpreter, minus the time of starting an empty interpreter
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [repo_dir] + [p for p in [env.get("PYTHONPATH")] if p]
+    )
+    check = (
+        "import sys, json; import {0}; "
+        "print(json.dumps([m for m in {1} if m in sys.modules]))"
+    ).format(module, HEAVY_MODULES)
+
+    def best_of(code):
+        best = None
+        out = ""
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            res = subprocess.run(
+                [sys.executable, "-c", code],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            elapsed = time.perf_counter() - start_time
+            if best is None or elapsed < best:
+                best = elapsed
+            out = res.stdout
+        return best, out
+
+    empty_time, _ = best_of("pass")
+    import_time, out = best_of(check)
+    return {
+        "module": module,
+        "import_ms": round(1000 * (import_time - empty_time), 1),
+        "heavy_loaded": json.loads(out.strip().splitlines()[-1]),
+    }
+
+
+def main():
+    """
+    Times each entry point import, exits non-zero on a regression
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--budget-ms",
+        help="maximum import time per entry point. Default: 150.",
+        type=float,
+        default=150,
+    )
+    parser.add_argument(
+        "-n",
+        "--repeats",
+        help="imports per module, the best is kept. Default: 5.",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "-o", "--output", help="write the results to this json file."
+    )
+    args = parser.parse_args()
+
+    results = [time_import(module, args.repeats) for module in ENTRY_MODULES]
+    regressed = False
+    for res in results:
+        print(
+            f"{res['module']}: {res['import_ms']} ms, heavy modules "
+            f"loaded: {res['heavy_loaded'] or 'none'}"
+        )
+        if res["heavy_loaded"] or res["import_ms"] > args.budget_ms:
+            regressed = True
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if regressed:
+        print("Import time regression")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import phantoms  # noqa: E402
+import stub_fsl  # noqa: E402
+
+# Peak resident memory of the in-process stages under each dtype policy.
+# Every case runs in a fresh interpreter and reports how far its peak RSS
+# rose above the interpreter with the pipeline imported, so the numbers
+# are what one more worker costs a node.
+
+# case: dtype policies it is run with
+CASES = {
+    "load": ["float64", "float32", "native"],
+    "gif_slices": ["float64", "float32", "native"],
+    "gif_slices_get_fdata": ["float64"],
+    "mask": ["native"],
+    "worker": ["float32"],
+}
+
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process. VmHWM starts afresh at exec, ru_maxrss (kB
+    on Linux) also counts the parent's memory at fork.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(case, dtype, data_dir):
+    """
+    Runs one case in this process, returns (baseline MB, peak MB)
+    """
+    import nibabel as nb
+    import numpy as np
+    from scipy import ndimage  # noqa: F401
+
+    from flirt_reg.reg import flirt_reg, volume
+
+    ref_name = os.path.join(data_dir, "vol0000.nii")
+    img = nb.load(ref_name)
+    base = peak_rss_mb()
+    if case == "load":
+        volume.load_data(img, dtype)
+    elif case == "gif_slices":
+        flirt_reg.get_gif_slices(img, dtype)
+    elif case == "gif_slices_get_fdata":
+        # What get_gif_slices did before the dtype policy
+        array = img.get_fdata()
+        mid = [n // 2 for n in array.shape]
+        [
+            np.flipud(array[mid[0], :, :]),
+            array[:, mid[1], :],
+            np.rot90(array[:, :, mid[2]]),
+        ]
+    elif case == "mask":
+        mask_name = os.path.join(data_dir, "tmp", "ref_mask.nii")
+        data = volume.load_data(img, "native")
+        nb.save(
+            nb.Nifti1Image(
+                (data > 0.1 * data.max()).astype(np.uint8), img.affine
+            ),
+            mask_name,
+        )
+        base = peak_rss_mb()
+        volume.apply_mask(
+            os.path.join(data_dir, "vol0001.nii"),
+            mask_name,
+            os.path.join(data_dir, "tmp", "masked.nii"),
+        )
+    elif case == "worker":
+        cur_dir = data_dir
+        os.makedirs(os.path.join(cur_dir, "tmp"), exist_ok=True)
+        os.link(ref_name, os.path.join(cur_dir, "tmp", "ref.nii"))
+        res = flirt_reg.register_task(
+            {"data_directory": data_dir, "nii": "vol0001.nii", "index": 1},
+            {
+                "cur_dir": cur_dir,
+                "fsl_dir": os.environ["FSLDIR"],
+                "extraction": False,
+                "plan": flirt_reg.retry_plan("leastsq"),
+                "output_policy": "params-only",
+            },
+        )
+        if res["failure"]:
+            raise RuntimeError(res["failure"]["error"])
+    return base, peak_rss_mb()
+
+
+def run_case_subprocess(case, dtype, size):
+    with tempfile.TemporaryDirectory(prefix="flirt_mem_") as work_dir:
+        data_dir = os.path.join(work_dir, "data")
+        phantoms.write_series(data_dir, size=size, n_volumes=2)
+        os.makedirs(os.path.join(data_dir, "tmp"))
+        bin_dir = stub_fsl.install_stubs(os.path.join(work_dir, "bin"))
+        env = dict(os.environ)
+        env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+        env["FSLDIR"] = os.path.join(work_dir, "fsl")
+        res = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--case",
+                case,
+                "--dtype",
+                dtype,
+                "--data-dir",
+                data_dir,
+            ],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if res.returncode != 0:
+            print(res.stdout + res.stderr)
+            raise RuntimeError(f"Case {case} {dtype} failed")
+        return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[128, 256],
+        help="phantom matrix sizes. Default: 128 256.",
+    )
+    parser.add_argument(
+        "-o", "--output", help="write the results to this json file."
+    )
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--dtype", help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        base, peak = run_case(args.case, args.dtype, args.data_dir)
+        print(json.dumps({"base_mb": base, "peak_mb": peak}))
+        return
+
+    results = []
+    for size in args.sizes:
+        # Same shape as phantoms.write_series, int16 on disk
+        shape = (size, size, int(size * 0.75))
+        disk_mb = shape[0] * shape[1] * shape[2] * 2 / 2**20
+        print(f"{shape[0]}x{shape[1]}x{shape[2]}, {disk_mb:.1f} MB as int16")
+        for case, dtypes in CASES.items():
+            for dtype in dtypes:
+                res = run_case_subprocess(case, dtype, size)
+                res.update({"size": size, "case": case, "dtype": dtype})
+                res["extra_mb"] = res["peak_mb"] - res["base_mb"]
+                results.append(res)
+                print(
+                    f"  {case:<21} {dtype:<8} +{res['extra_mb']:7.1f} MB "
+                    f"(peak {res['peak_mb']:.0f} MB)"
+                )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
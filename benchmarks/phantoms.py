@@ -0,0 +1,80 @@
+import os
+
+import nibabel as nb
+import numpy as np
+from scipy import ndimage
+
+import stub_fsl
+
+# Synthetic head-like phantoms with known rigid motion. Volume 0 is the
+# unmoved reference, every later volume is the phantom moved by a random
+# drift and resampled onto the same scanner grid.
+
+
+def phantom_data(shape):
+    """
+    Nested ellipsoids: a 'scalp', 'brain' and two 'ventricles'
+    """
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij")
+
+    def ellipsoid(centre, radii):
+        dist = sum(
+            ((axis - c) / r) ** 2 for axis, c, r in zip(grid, centre, radii)
+        )
+        return dist <= 1
+
+    data = np.zeros(shape, dtype=np.float32)
+    data[ellipsoid((0, 0, 0), (0.85, 0.9, 0.8))] = 300
+    data[ellipsoid((0, 0, 0), (0.75, 0.8, 0.7))] = 800
+    data[ellipsoid((-0.2, 0.1, 0.1), (0.12, 0.3, 0.15))] = 1500
+    data[ellipsoid((0.2, 0.1, 0.1), (0.12, 0.3, 0.15))] = 1500
+    data[ellipsoid((0.3, -0.4, -0.2), (0.1, 0.1, 0.1))] = 1100
+    return ndimage.gaussian_filter(data, 1)
+
+
+def phantom_affine(shape, zooms):
+    """
+    RAS voxel to world matrix centred on the volume
+    """
+    affine = np.diag(list(zooms) + [1.0])
+    affine[:3, 3] = -np.array(zooms) * (np.array(shape) - 1) / 2
+    return affine
+
+
+def random_motion(n_volumes, max_trans=3.0, max_rot_deg=3.0, seed=0):
+    """
+    Smooth random drift, (n_volumes, 6) of mm and radians, first row zero
+    """
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(size=(n_volumes, 6))
+    steps[0] = 0
+    drift = np.cumsum(steps, axis=0)
+    scale = np.abs(drift).max(axis=0)
+    scale[scale == 0] = 1
+    drift /= scale
+    drift[:, :3] *= max_trans
+    drift[:, 3:] *= np.radians(max_rot_deg)
+    return drift
+
+
+def write_series(
+    out_dir, size=64, n_volumes=10, zooms=(2.0, 2.0, 2.0), seed=0
+):
+    """
+    Writes vol0000.nii... to out_dir, returns the true motion per volume
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    shape = (size, size, int(size * 0.75))
+    affine = phantom_affine(shape, zooms)
+    reference = phantom_data(shape)
+    motion = random_motion(n_volumes, seed=seed)
+    for idx, params in enumerate(motion):
+        world = np.linalg.inv(stub_fsl.rigid(params))
+        vox = np.linalg.inv(affine) @ world @ affine
+        data = ndimage.affine_transform(
+            reference, vox[:3, :3], offset=vox[:3, 3], order=1
+        )
+        img = nb.Nifti1Image(np.round(data).astype(np.int16), affine)
+        img.header["descrip"] = stub_fsl.descrip_for(params)
+        nb.save(img, os.path.join(out_dir, f"vol{str(idx).zfill(4)}.nii"))
+    return motion
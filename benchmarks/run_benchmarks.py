@@ -0,0 +1,318 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel as nb
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import phantoms  # noqa: E402
+import stub_fsl  # noqa: E402
+
+# End to end benchmark of run_flirt, apply_transform, make_gif and the omat
+# parsers on synthetic phantoms, using the stub FSL tools in stub_fsl.py.
+# Each case runs in its own interpreter so peak RSS is per case. Results
+# are compared with baseline.json, see --help.
+
+# metric: (direction, relative tolerance factor). "higher" metrics regress
+# when they drop, "lower" ones when they grow, "max" ones are absolute
+# limits that must never be exceeded.
+CHECKS = {
+    "register_imgs_per_s": ("higher", 1.0),
+    "apply_imgs_per_s": ("higher", 1.0),
+    "gif_s": ("lower", 1.0),
+    "parse_avs_us": ("lower", 1.0),
+    "parse_csv_us": ("lower", 1.0),
+    "peak_rss_mb": ("lower", 0.5),
+    "trans_error_mm": ("max", 1e-3),
+    "rot_error_rad": ("max", 1e-3),
+}
+
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process. VmHWM starts afresh at exec, ru_maxrss (kB
+    on Linux) also counts the parent's memory at fork.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_per_call(func, *args, repeats=200):
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        func(*args)
+    return 1e6 * (time.perf_counter() - start_time) / repeats
+
+
+def write_mats(data_dir, matrices):
+    """
+    MAT_####.txt inputs for flirt-apply, one per volume
+    """
+    for idx, mat in enumerate(matrices):
+        with open(
+            os.path.join(data_dir, f"MAT_{str(idx).zfill(4)}.txt"), "w"
+        ) as file:
+            for row in mat:
+                file.write(" ".join(f"{val:.6f}" for val in row) + "\n")
+
+
+def run_case(size, n_volumes, work_dir, jobs=1):
+    """
+    Runs one case in this process, returns its metrics
+    """
+    from flirt_reg.reg import flirt_reg, omat
+
+    data_dir = os.path.join(work_dir, "data")
+    phantoms.write_series(data_dir, size=size, n_volumes=n_volumes)
+    ref_name = os.path.join(data_dir, "vol0000.nii")
+    names = sorted(f for f in os.listdir(data_dir) if f.endswith(".nii"))
+
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        omats, info = flirt_reg.flirt_reg(
+            fname=ref_name,
+            dname=[data_dir],
+            jobs=jobs,
+            full_output=True,
+            progress_bar=False,
+        )
+    register_s = time.perf_counter() - start_time
+
+    # Parameter error against the exact answer for each volume
+    ref_img = nb.load(ref_name)
+    expected = [
+        stub_fsl.flirt_matrix(nb.load(os.path.join(data_dir, name)), ref_img)
+        for name in names
+    ]
+    out = np.loadtxt(
+        os.path.join(data_dir, "results", "out.csv"), delimiter=","
+    )[:, :6]
+    truth = np.array([stub_fsl.matrix_params(mat) for mat in expected])
+    error = np.abs(out - truth)
+
+    write_mats(data_dir, expected)
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        flirt_reg.apply_transform(
+            dname=[data_dir],
+            iname=os.path.join(data_dir, "MAT_####.txt"),
+            jobs=jobs,
+            progress_bar=False,
+        )
+    apply_s = time.perf_counter() - start_time
+
+    avs_out = io.StringIO()
+    with contextlib.redirect_stdout(avs_out):
+        stub_fsl.avscale([os.path.join(data_dir, "tmp", "tmp1.txt"), ref_name])
+    gif_s = sum(
+        event["dur"] / 1e6 for event in info["trace"] if event["name"] == "gif"
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        parse_csv_us = time_per_call(
+            omat.csv_to_reg,
+            os.path.join(data_dir, "results", "out.csv"),
+            repeats=20,
+        )
+    return {
+        "size": size,
+        "volumes": n_volumes,
+        "jobs": jobs,
+        "register_imgs_per_s": (n_volumes - 1) / register_s,
+        "apply_imgs_per_s": (n_volumes - 1) / apply_s,
+        "gif_s": gif_s,
+        "parse_avs_us": time_per_call(omat.read_avs, avs_out.getvalue(), 0.5),
+        "parse_csv_us": parse_csv_us,
+        "peak_rss_mb": peak_rss_mb(),
+        "trans_error_mm": float(error[:, :3].max()),
+        "rot_error_rad": float(error[:, 3:].max()),
+        "failures": len(info["failures"]),
+    }
+
+
+def run_case_subprocess(size, n_volumes, jobs):
+    """
+    Runs a case in a fresh interpreter with the stub tools on PATH
+    """
+    with tempfile.TemporaryDirectory(prefix="flirt_bench_") as work_dir:
+        bin_dir = stub_fsl.install_stubs(os.path.join(work_dir, "bin"))
+        env = dict(os.environ)
+        env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+        env["FSLDIR"] = os.path.join(work_dir, "fsl")
+        env["MPLBACKEND"] = "Agg"
+        res = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--case",
+                f"{size}x{n_volumes}",
+                "--work-dir",
+                work_dir,
+                "--jobs",
+                str(jobs),
+            ],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if res.returncode != 0:
+            print(res.stdout + res.stderr)
+            raise RuntimeError(f"Case {size}x{n_volumes} failed")
+        return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def case_key(case):
+    return f"{case['size']}x{case['volumes']}x{case['jobs']}"
+
+
+def compare(results, baseline, tolerance):
+    """
+    Lists the metrics that regressed against the baseline
+    """
+    base_cases = {case_key(case): case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        base = base_cases.get(case_key(case))
+        for metric, (direction, factor) in CHECKS.items():
+            value = case[metric]
+            if direction == "max":
+                if value > factor:
+                    regressions.append(
+                        f"{case_key(case)} {metric}: {value:.3g} > {factor}"
+                    )
+                continue
+            if base is None:
+                continue
+            allowed = tolerance * factor
+            if direction == "higher" and value < base[metric] * (1 - allowed):
+                regressions.append(
+                    f"{case_key(case)} {metric}: {value:.3g} vs "
+                    f"baseline {base[metric]:.3g}"
+                )
+            elif direction == "lower" and value > base[metric] * (1 + allowed):
+                regressions.append(
+                    f"{case_key(case)} {metric}: {value:.3g} vs "
+                    f"baseline {base[metric]:.3g}"
+                )
+        if case["failures"]:
+            regressions.append(
+                f"{case_key(case)}: {case['failures']} images failed"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=[32, 64],
+        help="phantom matrix sizes. Default: 32 64.",
+    )
+    parser.add_argument(
+        "-n",
+        "--volumes",
+        nargs="+",
+        type=int,
+        default=[5, 20],
+        help="series lengths. Default: 5 20.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="images registered at once. Default: 1.",
+    )
+    parser.add_argument(
+        "-o", "--output", help="write the results to this json file."
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        default=os.path.join(BENCH_DIR, "baseline.json"),
+        help="baseline to compare with. Default: benchmarks/baseline.json.",
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=0.3,
+        help="allowed relative slowdown before a metric regresses. \
+            Default: 0.3.",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="save the results as the new baseline.",
+    )
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        size, n_volumes = [int(val) for val in args.case.split("x")]
+        print(json.dumps(run_case(size, n_volumes, args.work_dir, args.jobs)))
+        return
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cases": [],
+    }
+    for size in args.sizes:
+        for n_volumes in args.volumes:
+            case = run_case_subprocess(size, n_volumes, args.jobs)
+            results["cases"].append(case)
+            print(
+                f"{size}^3 x {n_volumes}: "
+                f"{case['register_imgs_per_s']:.2f} reg/s, "
+                f"{case['apply_imgs_per_s']:.2f} apply/s, "
+                f"gif {case['gif_s']:.2f} s, "
+                f"{case['peak_rss_mb']:.0f} MB, "
+                f"error {case['trans_error_mm']:.2g} mm "
+                f"{case['rot_error_rad']:.2g} rad"
+            )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    else:
+        baseline = {"cases": []}
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+import math
+import os
+import sys
+
+import nibabel as nb
+import numpy as np
+from scipy import ndimage
+
+# Deterministic stand-ins for the FSL tools the pipeline calls. Install
+# them with install_stubs(bin_dir), which symlinks this script under each
+# tool name, and put bin_dir first on PATH.
+#
+# Phantoms store their true rigid motion (world mm, radians) in the NIfTI
+# descrip field. The stub flirt returns the exact FLIRT matrix implied by
+# the headers of -in and -ref, so it stays correct for cropped, masked or
+# chained inputs. avscale decomposes matrices the same way FSL does.
+
+TOOLS = ["bet", "flirt", "avscale", "std2imgcoord", "gifsicle"]
+DESCRIP_TAG = "flirt-stub"
+
+
+def install_stubs(bin_dir):
+    """
+    Symlinks this script into bin_dir under every tool name
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    script = os.path.abspath(__file__)
+    os.chmod(script, 0o755)
+    for tool in TOOLS:
+        link = os.path.join(bin_dir, tool)
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(script, link)
+    return bin_dir
+
+
+def euler_to_rot(rx, ry, rz):
+    """
+    Rotation matrix for FSL's (x, y, z) Euler angles, the inverse of
+    rot_to_euler
+    """
+    cx, sx = math.cos(rx), math.sin(rx)
+    cy, sy = math.cos(ry), math.sin(ry)
+    cz, sz = math.cos(rz), math.sin(rz)
+    rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return (rot_z @ rot_y @ rot_x).T
+
+
+def rot_to_euler(rot):
+    """
+    FSL's rotmat2euler, as reported by avscale
+    """
+    return (
+        math.atan2(rot[1, 2], rot[2, 2]),
+        -math.asin(np.clip(rot[0, 2], -1, 1)),
+        math.atan2(rot[0, 1], rot[0, 0]),
+    )
+
+
+def rigid(params):
+    """
+    4x4 matrix from (tx, ty, tz, rx, ry, rz)
+    """
+    mat = np.eye(4)
+    mat[:3, :3] = euler_to_rot(*params[3:6])
+    mat[:3, 3] = params[0:3]
+    return mat
+
+
+def matrix_params(mat):
+    """
+    (tx, ty, tz, rx, ry, rz) as written to out.csv by the pipeline
+    """
+    return np.concatenate([mat[:3, 3], rot_to_euler(mat[:3, :3])])
+
+
+def fsl_coords(img):
+    """
+    Voxel to FLIRT's scaled voxel coordinates, x is flipped when the
+    voxel to world matrix has a positive determinant
+    """
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    mat = np.diag(list(zooms) + [1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        mat[0, 0] = -zooms[0]
+        mat[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return mat
+
+
+def true_motion(img):
+    """
+    World motion stored in a phantom header, identity for anything else
+    """
+    descrip = img.header["descrip"].tobytes().decode(errors="ignore")
+    descrip = descrip.strip("\x00 ")
+    if not descrip.startswith(DESCRIP_TAG):
+        return np.eye(4)
+    return rigid([float(val) for val in descrip.split()[1:7]])
+
+
+def descrip_for(params):
+    return DESCRIP_TAG + " " + " ".join(f"{val:.6f}" for val in params)
+
+
+def flirt_matrix(in_img, ref_img):
+    """
+    The FLIRT matrix that maps in_img onto ref_img given their true motion
+    """
+    world = true_motion(ref_img) @ np.linalg.inv(true_motion(in_img))
+    return (
+        fsl_coords(ref_img)
+        @ np.linalg.inv(ref_img.affine)
+        @ world
+        @ in_img.affine
+        @ np.linalg.inv(fsl_coords(in_img))
+    )
+
+
+def resample(in_img, ref_img, mat):
+    """
+    Resamples in_img into ref_img's grid through FLIRT matrix mat
+    """
+    vox = (
+        np.linalg.inv(fsl_coords(in_img))
+        @ np.linalg.inv(mat)
+        @ fsl_coords(ref_img)
+    )
+    data = ndimage.affine_transform(
+        np.asarray(in_img.dataobj, dtype=np.float32),
+        vox[:3, :3],
+        offset=vox[:3, 3],
+        output_shape=ref_img.shape[:3],
+        order=1,
+    )
+    out = nb.Nifti1Image(data, ref_img.affine, ref_img.header)
+    out.set_data_dtype(np.float32)
+    return out
+
+
+def out_name(name):
+    """
+    Adds the extension FSL would add for $FSLOUTPUTTYPE
+    """
+    if name.endswith(".nii") or name.endswith(".nii.gz"):
+        return name
+    if os.environ.get("FSLOUTPUTTYPE", "NIFTI_GZ") == "NIFTI":
+        return name + ".nii"
+    return name + ".nii.gz"
+
+
+def write_mat(fname, mat):
+    with open(fname, "w") as file:
+        for row in mat:
+            file.write("  ".join(f"{val:.6f}" for val in row) + "  \n")
+
+
+def read_mat(fname):
+    return np.loadtxt(fname)
+
+
+def opt(args, name):
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def bet(args):
+    """
+    Thresholds at 10% of the maximum, -m also writes the mask
+    """
+    img = nb.load(args[0])
+    data = np.asarray(img.dataobj)
+    mask = data > 0.1 * data.max()
+    out = out_name(args[1])
+    nb.save(nb.Nifti1Image(data * mask, img.affine, img.header), out)
+    if "-m" in args:
+        mask_name = out.replace(".nii", "_mask.nii")
+        mask_img = nb.Nifti1Image(mask.astype(np.uint8), img.affine)
+        nb.save(mask_img, mask_name)
+
+
+def flirt(args):
+    in_img = nb.load(opt(args, "-in"))
+    ref_img = nb.load(opt(args, "-ref"))
+    if "-init" in args and ("-applyxfm" in args or "-schedule" in args):
+        mat = read_mat(opt(args, "-init"))
+    else:
+        mat = flirt_matrix(in_img, ref_img)
+    if opt(args, "-omat"):
+        write_mat(opt(args, "-omat"), mat)
+    if opt(args, "-out"):
+        nb.save(resample(in_img, ref_img, mat), out_name(opt(args, "-out")))
+    if "-schedule" in args and "-applyxfm" not in args:
+        # measurecost prints the cost first, normalised sum of squares
+        moved = resample(in_img, ref_img, mat).get_fdata(dtype=np.float32)
+        ref = ref_img.get_fdata(dtype=np.float32)
+        cost = np.mean((moved - ref) ** 2) / max(np.mean(ref**2), 1e-12)
+        print(f"{cost:.6f}  0 0 0 0 0 0")
+
+
+def avscale(args):
+    mat = read_mat(args[-2])
+    rx, ry, rz = rot_to_euler(mat[:3, :3])
+    print("Rotation & Translation Matrix:")
+    for row in mat:
+        print(" ".join(f"{val:.6f}" for val in row))
+    print(f"Rotation Angles (x,y,z) [rads] = {rx:.6f} {ry:.6f} {rz:.6f}")
+    print(
+        f"Translations (x,y,z) [mm] = {mat[0, 3]:.6f} {mat[1, 3]:.6f} "
+        f"{mat[2, 3]:.6f}"
+    )
+
+
+def std2imgcoord(args):
+    with open(args[-2]) as file:
+        coords = file.read().split()
+    print("  ".join(coords[:3]))
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    if tool == "bet":
+        bet(args)
+    elif tool == "flirt":
+        flirt(args)
+    elif tool == "avscale":
+        avscale(args)
+    elif tool == "std2imgcoord":
+        std2imgcoord(args)
+    elif tool == "gifsicle":
+        # pygifsicle optimises in place, nothing to do
+        pass
+    else:
+        sys.exit(f"Unknown stub tool {tool}")
+
+
+if __name__ == "__main__":
+    main()
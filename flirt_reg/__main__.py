@@ -1,6 +1,8 @@
 import argparse
+import sys
 import time
-from flirt_reg.reg import flirt_reg
+from flirt_reg.reg import costs, flirt_reg, quick, volume
+from flirt_reg.utils import niio
 
 
 def main():
@@ -24,6 +26,13 @@ def main():
         help="input directory name(s). Default: searches \
                     same directory for as filename for .nii.",
     )
+    parser.add_argument(
+        "--auto-reference",
+        action="store_true",
+        help="without -f, use the volume that correlates best with all \
+            the others as the reference instead of the first, the scores \
+            are written to reference.csv. Default: false.",
+    )
     parser.add_argument(
         "-n",
         "--num",
@@ -58,19 +67,266 @@ def main():
         help="Select a cost function from the following list:\
             [mutualinfo,corratio,normcorr,normmi,leastsq,labeldiff,bbr]",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of images to register at once. Default: 1.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--retries",
+        help="times to retry an image that fails. Default: 0, or one \
+            retry per --retry-cost.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--retry-cost",
+        nargs="+",
+        help="cost functions to try, in order, when an image fails. \
+            Default: retry with the same cost function.",
+    )
+    parser.add_argument(
+        "--retry-search",
+        help="search range in degrees used for retries. Default: 180.",
+        type=int,
+        default=180,
+    )
+    parser.add_argument(
+        "--trace",
+        help="save per stage timings of every image to this file in \
+            Chrome trace-event format. Default: no trace.",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        help="write live metrics to flirt_reg.prom and status.json in \
+            this directory. Default: no metrics files.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        help="seconds between metrics file updates. Default: 10.",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "--no-progress",
+        action="store_true",
+        help="do not draw the progress bar. Default: false.",
+    )
+    parser.add_argument(
+        "--output-policy",
+        choices=flirt_reg.OUTPUT_POLICIES,
+        default="compressed",
+        help="how registered images are written: gzipped, as NIFTI, or \
+            not at all (params-only, unless needed for the GIF or --qc). \
+            Default: compressed.",
+    )
+    parser.add_argument(
+        "--compress-level",
+        help="gzip level of the registered images. Default: 1.",
+        type=int,
+        default=niio.GZIP_LEVEL,
+    )
+    parser.add_argument(
+        "--compress-threads",
+        help="threads compressing or decompressing each image. \
+            Default: the number of CPUs, at most 8.",
+        type=int,
+        default=niio.THREADS,
+    )
+    parser.add_argument(
+        "--bet-mode",
+        choices=flirt_reg.BET_MODES,
+        default="each",
+        help="with -b, run BET on each image or only on the reference and \
+            carry its mask onto the other images. Default: each.",
+    )
+    parser.add_argument(
+        "--mask-refine",
+        action="store_true",
+        help="with --bet-mode reference, carry the mask through a first \
+            registration and register again. Default: false.",
+    )
+    parser.add_argument(
+        "--mask-check",
+        help="with --bet-mode reference, compare the carried mask with \
+            BET on this many images. Default: 0.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--crop",
+        action="store_true",
+        help="register only the reference foreground and a margin around \
+            it. Default: false.",
+    )
+    parser.add_argument(
+        "--crop-margin",
+        help="margin in mm kept around the foreground by --crop, also \
+            allowed for motion. Default: 10.",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=volume.DTYPES,
+        default="float32",
+        help="how voxel data is loaded in this process, native keeps the \
+            stored integers where that is lossless. Default: float32.",
+    )
+    parser.add_argument(
+        "--qc",
+        action="store_true",
+        help="write framewise displacement, DVARS and outlier flags for \
+            every volume to qc.csv. Default: false.",
+    )
+    parser.add_argument(
+        "--fd-radius",
+        help="head radius in mm used to turn rotations into displacement. \
+            Default: 50.",
+        type=float,
+        default=50,
+    )
+    parser.add_argument(
+        "--fd-threshold",
+        help="framewise displacement in mm above which a volume is \
+            flagged. Default: 0.5.",
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "--report-costs",
+        help="comma separated costs to evaluate on each registered image, \
+            written as extra columns of original_out.csv, from \
+            [leastsq,normcorr,corratio,mutualinfo,normmi]. Default: none.",
+    )
+    parser.add_argument(
+        "--prefetch-depth",
+        help="inputs staged ahead of the registration workers, 0 stages \
+            each input in its worker. Default: 2.",
+        type=int,
+        default=flirt_reg.PREFETCH_DEPTH,
+    )
+    parser.add_argument(
+        "--write-depth",
+        help="registered images that may wait to be written, 0 writes \
+            them in the registration worker. Default: 2.",
+        type=int,
+        default=flirt_reg.WRITE_DEPTH,
+    )
+    parser.add_argument(
+        "--io-threads",
+        help="threads reading inputs and as many writing outputs. \
+            Default: 2.",
+        type=int,
+        default=flirt_reg.IO_THREADS,
+    )
+    parser.add_argument(
+        "--hierarchical",
+        action="store_true",
+        help="with several directories, register each directory's anchor \
+            to the reference once and its images to the anchor with a \
+            narrow search. Default: false.",
+    )
+    parser.add_argument(
+        "--anchor",
+        choices=flirt_reg.ANCHORS,
+        default="first",
+        help="the anchor of each directory with --hierarchical, its first \
+            volume or the mean of its volumes. Default: first.",
+    )
+    parser.add_argument(
+        "--anchor-search",
+        help="search range in degrees for images registered to their \
+            directory's anchor. Default: 15.",
+        type=int,
+        default=flirt_reg.ANCHOR_SEARCH,
+    )
+    parser.add_argument(
+        "--quick",
+        dest="quick_voxel",
+        nargs="?",
+        const=quick.QUICK_VOXEL,
+        type=float,
+        metavar="MM",
+        help="fit each volume quickly on a grid of MM mm voxels (6 if not \
+            given) instead of registering it with FLIRT, the rows are \
+            flagged in approximate.csv. Default: false.",
+    )
+    parser.add_argument(
+        "--upgrade",
+        nargs="*",
+        type=int,
+        metavar="ROW",
+        help="replace these out.csv rows of a --quick run, or every \
+            approximate row if none are given, with full registrations.",
+    )
+    parser.add_argument(
+        "--plan",
+        nargs="?",
+        const=0,
+        type=int,
+        metavar="CPUS",
+        help="predict the wall time, peak memory and best --jobs for these \
+            inputs and settings on CPUS cores (this machine's if not \
+            given) from the run history, without registering.",
+    )
+    parser.add_argument(
+        "--history",
+        help="run history database, see --plan. Default: \
+            $FLIRT_REG_HISTORY or ~/.flirt_reg/history.sqlite.",
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="do not record this run in the history or use it to order \
+            the images. Default: false.",
+    )
+    parser.add_argument(
+        "--no-gif",
+        action="store_true",
+        help="do not make the registration GIF. Default: false.",
+    )
+    parser.add_argument(
+        "--queue",
+        help="shared directory for a distributed work queue, this process \
+            coordinates and merges results. Default: run locally.",
+    )
+    parser.add_argument(
+        "--worker",
+        help="join the work queue in this shared directory as a worker.",
+    )
+    parser.add_argument(
+        "--local-workers",
+        help="number of workers the coordinator starts on this machine. \
+            Default: 0.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--lease",
+        help="seconds before an unrenewed task is requeued. Default: 60.",
+        type=float,
+        default=60,
+    )
     args = parser.parse_args()
 
+    if args.worker:
+        flirt_reg.queue_worker(args.worker, verbose=args.verbose)
+        return
+
+    # Check for a resonable cost function
+    cost_func_list = [
+        "mutualinfo",
+        "corratio",
+        "normcorr",
+        "normmi",
+        "leastsq",
+        "labeldiff",
+        "bbr",
+    ]
     if args.cost:
-        # Check for a resonable cost function
-        cost_func_list = [
-            "mutualinfo",
-            "corratio",
-            "normcorr",
-            "normmi",
-            "leastsq",
-            "labeldiff",
-            "bbr",
-        ]
         if args.cost in cost_func_list:
             cost_func = args.cost
         else:
@@ -81,9 +337,75 @@ def main():
             exit(0)
     else:
         cost_func = "leastsq"
+    for retry_cost in args.retry_cost or []:
+        if retry_cost not in cost_func_list:
+            parser.error(
+                f"{retry_cost} is not a valid cost function, please use one "
+                "of: [mutualinfo,corratio,normcorr,normmi,leastsq,labeldiff,bbr]"
+            )
+    report_costs = None
+    if args.report_costs:
+        report_costs = [
+            name.strip() for name in args.report_costs.split(",") if name
+        ]
+        for name in report_costs:
+            if name not in costs.COSTS:
+                parser.error(
+                    f"{name} cannot be reported, please use one of: "
+                    f"[{','.join(costs.COSTS)}]"
+                )
+
+    if args.plan is not None:
+        flirt_reg.plan_run(
+            fname=args.filename,
+            dname=args.dirname,
+            max_images=args.num,
+            cpus=args.plan or None,
+            history_file=args.history,
+            extraction=args.brain_extract,
+            bet_mode=args.bet_mode,
+            mask_refine=args.mask_refine,
+            cost_func=cost_func,
+            crop=args.crop,
+            crop_margin=args.crop_margin,
+            hierarchical=args.hierarchical,
+            anchor_search=args.anchor_search,
+            quick_voxel=args.quick_voxel,
+            output_policy=args.output_policy,
+            gif=not args.no_gif,
+            report_costs=report_costs,
+        )
+        return
+
+    if args.upgrade is not None:
+        try:
+            _, failures = flirt_reg.upgrade(
+                rows=args.upgrade or None,
+                fname=args.filename,
+                oname=args.output,
+                verbose=args.verbose,
+                max_images=args.num,
+                dname=args.dirname,
+                extraction=args.brain_extract,
+                cost_func=cost_func,
+                jobs=args.jobs,
+                retries=args.retries,
+                retry_costs=args.retry_cost,
+                retry_search=args.retry_search,
+                bet_mode=args.bet_mode,
+                mask_refine=args.mask_refine,
+                crop=args.crop,
+                crop_margin=args.crop_margin,
+                auto_reference=args.auto_reference,
+            )
+        except ValueError as err:
+            parser.error(str(err))
+        if failures:
+            sys.exit(1)
+        return
 
     # call the flirt_reg function with cmd line args
-    omats = flirt_reg.flirt_reg(
+    omats, info = flirt_reg.flirt_reg(
         fname=args.filename,
         oname=args.output,
         verbose=args.verbose,
@@ -92,12 +414,51 @@ def main():
         rads=args.radians,
         extraction=args.brain_extract,
         cost_func=cost_func,
+        queue_dir=args.queue,
+        local_workers=args.local_workers,
+        lease_time=args.lease,
+        jobs=args.jobs,
+        retries=args.retries,
+        retry_costs=args.retry_cost,
+        retry_search=args.retry_search,
+        full_output=True,
+        trace_file=args.trace,
+        progress_bar=not args.no_progress,
+        metrics_dir=args.metrics_dir,
+        metrics_interval=args.metrics_interval,
+        output_policy=args.output_policy,
+        gif=not args.no_gif,
+        bet_mode=args.bet_mode,
+        mask_refine=args.mask_refine,
+        mask_check=args.mask_check,
+        crop=args.crop,
+        crop_margin=args.crop_margin,
+        dtype=args.dtype,
+        qc_metrics=args.qc,
+        fd_radius=args.fd_radius,
+        fd_threshold=args.fd_threshold,
+        report_costs=report_costs,
+        prefetch_depth=args.prefetch_depth,
+        write_depth=args.write_depth,
+        io_threads=args.io_threads,
+        hierarchical=args.hierarchical,
+        anchor=args.anchor,
+        anchor_search=args.anchor_search,
+        compress_level=args.compress_level,
+        compress_threads=args.compress_threads,
+        quick_voxel=args.quick_voxel,
+        history_file=args.history,
+        use_history=not args.no_history,
+        auto_reference=args.auto_reference,
     )
 
     if args.verbose:
         total_time = time.gmtime((time.time() - start_time))
         print(f"Pipeline complete in {time.strftime('%Hh%Mm%Ss', total_time)}")
 
+    if info["failures"]:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,155 @@
+from flirt_reg.reg import volume
+from flirt_reg.utils import niio
+
+# FLIRT style cost functions evaluated in Python on a registered volume and
+# the reference. Every requested cost is derived from one set of shared
+# statistics: the moments of both images and, if a histogram based cost is
+# asked for, one joint histogram. As in FLIRT lower is better, so the
+# similarity measures are negated or subtracted from 1.
+
+COSTS = ["leastsq", "normcorr", "corratio", "mutualinfo", "normmi"]
+HISTOGRAM_COSTS = ["corratio", "mutualinfo", "normmi"]
+BINS = 256
+
+
+def check_costs(names):
+    """
+    Raises ValueError for a cost this module cannot evaluate
+    """
+    for name in names:
+        if name not in COSTS:
+            raise ValueError(
+                f"Cannot report cost {name}, use one of {', '.join(COSTS)}"
+            )
+
+
+def bin_index(data, low, high, bins=BINS):
+    """
+    Bin of every voxel, bins spread evenly over [low, high]
+    """
+    import numpy as np
+
+    if high == low:
+        return np.zeros(data.shape, dtype=np.intp)
+    idx = ((data - low) * (bins / (high - low))).astype(np.intp)
+    return np.minimum(idx, bins - 1)
+
+
+def joint_stats(reg, ref, histogram=True, bins=BINS, chunk=1 << 20):
+    """
+    The statistics every cost is computed from. Voxels are visited in
+    chunks, summed in float64, so no full size float64 copy is made.
+    """
+    import numpy as np
+
+    reg = reg.ravel()
+    ref = ref.ravel()
+    keys = ["sum_reg", "sum_ref", "sum_reg2", "sum_ref2", "sum_prod"]
+    stats = dict.fromkeys(keys + ["sum_diff2"], 0.0)
+    stats["n"] = reg.size
+    if histogram:
+        reg_range = (float(reg.min()), float(reg.max()))
+        ref_range = (float(ref.min()), float(ref.max()))
+        stats["joint"] = np.zeros(bins * bins, dtype=np.int64)
+        # Moments of reg within each reference bin, for the correlation
+        # ratio
+        stats["bin_sum"] = np.zeros(bins)
+        stats["bin_sum2"] = np.zeros(bins)
+    for start in range(0, reg.size, chunk):
+        reg_c = reg[start : start + chunk].astype(np.float64)
+        ref_c = ref[start : start + chunk].astype(np.float64)
+        diff = reg_c - ref_c
+        stats["sum_reg"] += reg_c.sum()
+        stats["sum_ref"] += ref_c.sum()
+        stats["sum_reg2"] += np.dot(reg_c, reg_c)
+        stats["sum_ref2"] += np.dot(ref_c, ref_c)
+        stats["sum_prod"] += np.dot(reg_c, ref_c)
+        stats["sum_diff2"] += np.dot(diff, diff)
+        if histogram:
+            ref_bins = bin_index(ref_c, *ref_range, bins)
+            reg_bins = bin_index(reg_c, *reg_range, bins)
+            stats["joint"] += np.bincount(
+                ref_bins * bins + reg_bins, minlength=bins * bins
+            )
+            stats["bin_sum"] += np.bincount(ref_bins, reg_c, minlength=bins)
+            stats["bin_sum2"] += np.bincount(
+                ref_bins, reg_c * reg_c, minlength=bins
+            )
+    if histogram:
+        stats["joint"] = stats["joint"].reshape(bins, bins)
+    return stats
+
+
+def entropy(counts):
+    import numpy as np
+
+    prob = counts[counts > 0] / counts.sum()
+    return -np.sum(prob * np.log(prob))
+
+
+def costs_from_stats(stats, names):
+    """
+    {cost: value} for each cost in names
+    """
+    import numpy as np
+
+    n = stats["n"]
+    mean_reg = stats["sum_reg"] / n
+    mean_ref = stats["sum_ref"] / n
+    var_reg = stats["sum_reg2"] / n - mean_reg**2
+    var_ref = stats["sum_ref2"] / n - mean_ref**2
+    cov = stats["sum_prod"] / n - mean_reg * mean_ref
+    values = {}
+    for name in names:
+        if name == "leastsq":
+            values[name] = stats["sum_diff2"] / n
+        elif name == "normcorr":
+            denom = np.sqrt(var_reg * var_ref)
+            values[name] = 1 - (cov / denom if denom > 0 else 0.0)
+        elif name == "corratio":
+            counts = stats["joint"].sum(axis=1)
+            used = counts > 0
+            within = (
+                stats["bin_sum2"][used]
+                - stats["bin_sum"][used] ** 2 / counts[used]
+            ).sum()
+            values[name] = within / (n * var_reg) if var_reg > 0 else 1.0
+        elif name in ["mutualinfo", "normmi"]:
+            joint = stats["joint"]
+            h_ref = entropy(joint.sum(axis=1))
+            h_reg = entropy(joint.sum(axis=0))
+            h_joint = entropy(joint.ravel())
+            if name == "mutualinfo":
+                values[name] = -(h_ref + h_reg - h_joint)
+            else:
+                values[name] = -(h_ref + h_reg) / h_joint if h_joint else -2.0
+    return {name: float(value) for name, value in values.items()}
+
+
+def registered_costs(
+    names,
+    ref_file,
+    reg_file=None,
+    in_file=None,
+    mat_file=None,
+    dtype="float32",
+):
+    """
+    Evaluates each cost in names between the reference and a registered
+    image: reg_file if FLIRT wrote one, else in_file resampled through
+    the FLIRT matrix in mat_file. Returns the values in the order of names.
+    """
+    import numpy as np
+
+    ref_img, ref = volume.load_reference(ref_file, dtype)
+    if reg_file:
+        reg = volume.load_data(niio.load(reg_file), dtype)
+    else:
+        reg = volume.resample_to_ref(in_file, ref_img, mat_file, dtype)
+    stats = joint_stats(
+        np.asarray(reg)[..., 0] if np.ndim(reg) > 3 else np.asarray(reg),
+        np.asarray(ref),
+        histogram=any(name in HISTOGRAM_COSTS for name in names),
+    )
+    values = costs_from_stats(stats, names)
+    return [values[name] for name in names]
@@ -1,19 +1,47 @@
 import argparse
 import csv
 import errno
-from re import VERBOSE
-import gpuoptional.gpuoptional as gpopt
+import itertools
 import logging
 import os
-import subprocess
+import shutil
+import sys
 import time
-import nibabel as nb
-import nipype.interfaces.fsl as fsl  # fsl
-import matplotlib.pyplot as plt
-from pygifsicle import optimize
-from matplotlib.animation import FuncAnimation, PillowWriter
-from flirt_reg.reg import omat
-from flirt_reg.utils import progress, figstring
+from flirt_reg.reg import fsl_exec, omat
+
+# matplotlib, pygifsicle and nibabel, and most of flirt_reg's own modules,
+# are imported inside the functions that use them so the CLI and worker
+# processes start quickly
+
+# What happens to resampled volumes. compressed: FSL writes NIFTI which is
+# gzipped afterwards by utils.niio (at GZIP_LEVEL unless configured), off
+# the event loop so several images compress at once. uncompressed: NIFTI
+# is kept. params-only: only the matrices are written, plus uncompressed
+# volumes if the GIF or QC needs them.
+OUTPUT_POLICIES = ["compressed", "uncompressed", "params-only"]
+
+# Brain extraction with -b. each: BET on every image. reference: BET on the
+# reference only, its mask is carried onto each image through the header
+# affines (and with mask_refine again through the first FLIRT matrix).
+BET_MODES = ["each", "reference"]
+# Mask parity below this Dice overlap is reported as a warning
+MASK_DICE_WARN = 0.9
+
+# Images staged ahead of the registration workers, registered images
+# waiting to be written, and threads in each of those stages
+PREFETCH_DEPTH = 2
+WRITE_DEPTH = 2
+IO_THREADS = 2
+# Finished images waiting for a slow iter_registrations consumer
+RESULT_DEPTH = 16
+
+# Hierarchical runs over several directories. Each directory other than the
+# reference's gets an anchor, its first volume or the mean of its volumes,
+# registered to the reference once with the full search. Its images are
+# registered to the anchor with a +/-ANCHOR_SEARCH degree search and the
+# two matrices are composed.
+ANCHORS = ["first", "mean"]
+ANCHOR_SEARCH = 15
 
 
 def is_nii(path):
@@ -66,13 +94,27 @@ def get_inputs(n_nii, input_schema):
     return all_inputs
 
 
-def make_coords(datadir, all_inputs, all_nii, fsl_dir, i):
+def trans_name(datadir, i, link=0):
+    """
+    FLIRT matrix make_coords writes for image i, link is its place in a
+    chain of matrices
+    """
+    if link:
+        return f"{datadir}/tmp/trans_tmp{i}_{link}.txt"
+    return f"{datadir}/tmp/trans_tmp{i}.txt"
+
+
+def make_coords(datadir, all_inputs, all_nii, fsl_dir, i, link=0):
+    import subprocess
+
+    trans_file = trans_name(datadir, i, link)
+    coord_file = trans_file.replace("trans_tmp", "coord_tmp")
     in_coords = []
     with open(f"{all_inputs[i]}", "r") as file:
         for line in file:
             line_in = line.strip("\n").split(" ")
             in_coords.append(line_in)
-    with open(f"{datadir}/tmp/coord_tmp{i}.txt", "w") as csvfile:
+    with open(coord_file, "w") as csvfile:
         regwriter = csv.writer(csvfile, delimiter=" ")
         regwriter.writerow(
             [
@@ -82,26 +124,26 @@ def make_coords(datadir, all_inputs, all_nii, fsl_dir, i):
             ]
         )
 
-    f = open(f"{datadir}/tmp/trans_tmp{i}.txt", "w")
-    subprocess.run(
-        [
-            f"{fsl_dir}/bin/std2imgcoord",
-            "-std",
-            f"{datadir}/{all_nii[datadir][0]}",
-            "-img",
-            f"{datadir}/{all_nii[datadir][i]}",
-            f"{datadir}/tmp/coord_tmp{i}.txt",
-            "-vox",
-        ],
-        check=True,
-        stdout=f,
-    )
+    with open(trans_file, "w") as f:
+        subprocess.run(
+            [
+                fsl_exec.fsl_bin("std2imgcoord", fsl_dir),
+                "-std",
+                f"{datadir}/{all_nii[datadir][0]}",
+                "-img",
+                f"{datadir}/{all_nii[datadir][i]}",
+                coord_file,
+                "-vox",
+            ],
+            check=True,
+            stdout=f,
+        )
 
     new_translations = []
-    with open(f"{datadir}/tmp/trans_tmp{i}.txt", "r") as file:
+    with open(trans_file, "r") as file:
         for line in file:
             new_translations = line.strip("\n").split("  ")
-    with open(f"{datadir}/tmp/trans_tmp{i}.txt", "w") as csvfile:
+    with open(trans_file, "w") as csvfile:
         regwriter = csv.writer(csvfile, delimiter=" ")
         regwriter.writerow(
             [
@@ -139,447 +181,3234 @@ def make_coords(datadir, all_inputs, all_nii, fsl_dir, i):
     return True
 
 
-def run_flirt(
-    all_nii,
-    cur_dir,
-    fsl_dir,
-    rads=False,
-    extraction=False,
-    cost_func="leastsq",
-):
-    xp = gpopt.array_module("cupy")
-    omats = []
-    original_omats = []
-    out_names = []
-    # First entry is 'registered' to itself
-    original_omats.append(xp.array([0, 0, 0, 0, 0, 0]))
-    omats.append(xp.array([0, 0, 0, 0, 0, 0]))
-    for data_directory in all_nii:
-        if not os.path.exists(f"{data_directory}/tmp"):
-            os.mkdir(f"{data_directory}/tmp")
-        dir_len = len(all_nii[data_directory])
-        if cur_dir == data_directory:
-            start_idx = 1
-        else:
-            start_idx = 0
+def gzip_nii(nii_name, level=None):
+    """
+    Compresses nii_name to nii_name.gz, in parallel and with a seek index
+    (see utils.niio), and removes the original
+    """
+    from flirt_reg.utils import niio
 
-        print(f"Running FLIRT on {data_directory}")
-        progress.printProgressBar(
-            start_idx,
-            dir_len,
-            prefix="Progress:",
-            suffix="Complete",
-            length=50,
-        )
-        for i in range(start_idx, dir_len):
-            if extraction:
-                btr = fsl.BET()
-                btr.inputs.in_file = (
-                    f"{data_directory}/{all_nii[data_directory][i]}"
-                )
-                btr.inputs.output_type = "NIFTI"
-                btr.inputs.out_file = f"{data_directory}/tmp/tmp.nii"
-                res = btr.run()
-                if res.runtime.returncode != 0:
-                    print(
-                        f'Error in FSL bet command: \'{fsl_dir}/bin/bet \
-                        "{data_directory}/{all_nii[data_directory][i]}" "{data_directory}/tmp/tmp.nii"\'\
-                        , check there are no spaces in path'
-                    )
-                    exit(0)
-            else:
-                os.system(
-                    f"cp {data_directory}/{all_nii[data_directory][i]} {data_directory}/tmp/tmp.nii"
-                )
+    gz_name = niio.compress_file(nii_name, level=level)
+    os.remove(nii_name)
+    return gz_name
 
-            flt = fsl.FLIRT(
-                bins=256,
-                dof=6,
-                cost_func=cost_func,
-                uses_qform=True,
-                terminal_output="allatonce",
-            )
-            flt.inputs.in_file = f"{data_directory}/tmp/tmp.nii"
-            flt.inputs.reference = f"{cur_dir}/tmp/ref.nii"
-            flt.inputs.output_type = "NIFTI_GZ"
-            flt.inputs.out_matrix_file = f"{data_directory}/tmp/tmp{i}.txt"
-            flt.inputs.out_file = f"{data_directory}/tmp/reg{i}.nii.gz"
-            flt.inputs.searchr_x = [-90, 90]
-            flt.inputs.searchr_y = [-90, 90]
-            flt.inputs.searchr_z = [-90, 90]
-            flt.inputs.interp = "trilinear"
-            res = flt.run()
-            if res.runtime.returncode != 0:
-                print(f"Error in FLIRT command: '{flt.cmdline}'")
-                exit(0)
-
-            # This will use avscale to get real world co-ords
-            # out of FLIRT
-            f = open(f"{data_directory}/tmp/avs.txt", "w")
-            avscale = fsl.AvScale(all_param=True, terminal_output="allatonce")
-            avscale.inputs.mat_file = f"{data_directory}/tmp/tmp{i}.txt"
-            avscale.inputs.ref_file = f"{data_directory}/tmp/reg{i}.nii.gz"
-            res = avscale.run()
-            if res.runtime.returncode != 0:
-                print("Error in AVScale command")
-                exit(0)
-            avs_str = str(res.runtime.stdout)
-            flt = fsl.FLIRT(
-                cost_func=cost_func,
-                terminal_output="allatonce",
-            )
-            flt.inputs.in_file = f"{data_directory}/tmp/reg{i}.nii.gz"
-            flt.inputs.reference = f"{cur_dir}/tmp/ref.nii"
-            flt.inputs.output_type = "NIFTI_GZ"
-            flt.inputs.schedule = f"{fsl_dir}/etc/flirtsch/measurecost1.sch"
-            flt.inputs.in_matrix_file = f"{data_directory}/tmp/tmp{i}.txt"
-            flt.inputs.out_matrix_file = (
-                f"{data_directory}/tmp/reg{i}_flirt.mat"
-            )
-            flt.inputs.out_file = f"{data_directory}/tmp/reg{i}.nii.gz"
-            out_names.append(f"{data_directory}/tmp/reg{i}.nii.gz")
-
-            res = flt.run()
-            cost_str = str(res.runtime.stdout)
-            cost_val = float(cost_str.split()[0])
-            if res.runtime.returncode != 0:
-                print(f"Error in FLIRT command: '{flt.cmdline}'")
-                exit(0)
-            try:
-                original_omats.append(omat.read_avs(avs_str, cost_val))
-                tmp_omat = omat.read_tmp_trans(
-                    f"{data_directory}/tmp/tmp{i}.txt"
-                )
-                original_omats[-1][0] = tmp_omat[0][3]
-                original_omats[-1][1] = tmp_omat[1][3]
-                original_omats[-1][2] = tmp_omat[2][3]
-                omats.append(original_omats[-1])
-            except IndexError:
-                logging.debug(
-                    f"{data_directory}/tmp/tmp{i}.txt does not contain omat data"
-                )
 
-            progress.printProgressBar(
-                i + 1,
-                dir_len,
-                prefix="Progress:",
-                suffix="Complete",
-                length=50,
-            )
-    return omats, original_omats, out_names
+def volume_policy(output_policy="compressed", gif=True):
+    """
+    Policy for the registered volumes, params-only still writes them
+    (uncompressed) when they are needed, for the GIF or QC
+    """
+    if output_policy not in OUTPUT_POLICIES:
+        raise ValueError(f"Unknown output policy {output_policy}")
+    if output_policy == "params-only" and gif:
+        return "uncompressed"
+    return output_policy
 
 
-def flirt_reg(
-    fname=None,
-    oname=None,
-    verbose=False,
-    max_images=None,
-    dname=None,
-    rads=False,
-    extraction=False,
-    cost_func="leastsq",
+async def write_volume_async(
+    cmd, out_nii, output_policy, tracer, image, worker
 ):
     """
-    FLIRT registration function
+    Runs an FSL command that writes out_nii as NIFTI, then compresses it
+    if the policy asks for it. Returns the final path.
     """
-    # Setup debugging
-    print("Starting flirt_reg")
-    if verbose:
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format="%(asctime)s - %(levelname)s - %(message)s",
-        )
-        logging.debug(f"Verbosity: {verbose}")
+    import asyncio
 
-    data_dirs = []
-    if dname:
-        for directory in dname:
-            data_dirs.append(os.path.abspath(directory))
-    else:
-        data_dirs.append(os.getcwd())
+    from flirt_reg.utils import trace
 
-    # Check input files and get the baseline file to register against
-    if fname:
-        logging.debug(f"Checking file {fname}")
-        if os.path.isfile(os.path.abspath(fname)):
-            logging.debug(f"Opening file {fname}")
-            cur_dir = os.path.dirname(os.path.abspath(fname))
-            all_nii = {}
-            n_nii = 0
-            for data_directory in data_dirs:
-                all_nii[data_directory] = get_nii(data_directory, max_images)
-                n_nii += len(all_nii[data_directory])
-        else:
-            logging.debug(f"!!! {fname} is not a file. !!!\nExiting...")
-            raise FileNotFoundError(
-                errno.ENOENT, os.strerror(errno.ENOENT), fname
-            )
-    else:
-        cur_dir = os.getcwd()
-        all_nii = {}
-        all_nii[data_dirs[0]] = get_nii(data_dirs[0], max_images)
-        fname = os.path.join(data_dirs[0], all_nii[data_dirs[0]][0])
-        n_nii = len(all_nii)
+    await fsl_exec.run_cmd(cmd, output_type="NIFTI")
+    if output_policy != "compressed":
+        return out_nii
+    with trace.span(tracer, "compress", image, worker) as sp:
+        sp.read(out_nii)
+        gz_name = await asyncio.get_running_loop().run_in_executor(
+            None, gzip_nii, out_nii
+        )
+        sp.wrote(gz_name)
+    return gz_name
 
-    if n_nii == 0:
-        print("No NIFTI files found, exiting...")
-        exit()
 
-    if os.path.exists("/usr/local/fsl"):
-        fsl_dir = "/usr/local/fsl"
-    elif os.path.exists("/usr/share/fsl/5.0"):
-        fsl_dir = "/usr/share/fsl/5.0"
+def stage_input(in_nii, out_nii):
+    """
+    Copies in_nii to out_nii, decompressing .nii.gz inputs so the FSL
+    tools read plain NIFTI
+    """
+    from flirt_reg.utils import niio
+
+    if in_nii.endswith(".gz"):
+        niio.decompress_file(in_nii, out_nii)
     else:
-        fsl_dir = "/usr/share/fsl"
+        shutil.copyfile(in_nii, out_nii)
+    return out_nii
 
-    logging.debug(f"FSL Base Dir: {fsl_dir}")
 
-    if not os.path.exists(f"{cur_dir}/tmp"):
-        os.mkdir(f"{cur_dir}/tmp")
-    # Brain extract the reference image
+def staged_name(data_directory, i, extraction=False):
+    """
+    Where image i is staged, BET or masking then writes tmp{i}.nii
+    """
     if extraction:
-        btr = fsl.BET()
-        btr.inputs.in_file = fname
-        btr.inputs.output_type = "NIFTI"
-        btr.inputs.out_file = f"{cur_dir}/tmp/ref.nii"
-        res = btr.run()
-        if res.runtime.returncode != 0:
-            print(
-                f'Error in FSL bet command: \'{fsl_dir}/bin/bet \
-                "{fname}" "{cur_dir}/tmp/ref.nii"\'\
-                , check there are no spaces in path'
-            )
-            exit(0)
-    else:
-        os.system(f"cp {fname} {cur_dir}/tmp/ref.nii")
+        return f"{data_directory}/tmp/in{i}.nii"
+    return f"{data_directory}/tmp/tmp{i}.nii"
 
-    omats, original_omats, out_paths = run_flirt(
-        all_nii,
-        cur_dir,
-        fsl_dir,
-        rads=rads,
-        extraction=extraction,
-        cost_func=cost_func,
-    )
 
-    for registration in omats:
-        logging.debug(omat.get_reg_str(registration, rads=rads))
+def remove_staged(data_directory, i, extraction=False, crop_margin=None):
+    """
+    Removes the copies of image i made for registration (see staged_name
+    and register_image_async), its matrix tmp{i}.txt is kept
+    """
+    files = {
+        f"{data_directory}/tmp/tmp{i}.nii",
+        staged_name(data_directory, i, extraction),
+    }
+    if crop_margin is not None:
+        files.add(f"{data_directory}/tmp/tmp{i}_crop.nii")
+    for fname in files:
+        if os.path.exists(fname):
+            os.remove(fname)
+
 
-    if oname:
-        # Save to specified filename
-        logging.debug(f"Saving to {oname}")
-        omat.reg_to_csv(omats, os.path.join(data_dirs[0], oname))
-        omat.avs_to_csv(
-            original_omats,
-            os.path.join(data_dirs[0], f"original_{oname}"),
-        )
-    else:
-        # Save to out.nii
-        logging.debug("Saving to out.csv")
-        if not os.path.exists(f"{data_dirs[0]}/results"):
-            os.mkdir(f"{data_dirs[0]}/results")
-        omat.reg_to_csv(
-            omats,
-            os.path.join(os.path.join(data_dirs[0], "results"), "out.csv"),
-        )
-        omat.avs_to_csv(
-            original_omats,
-            os.path.join(
-                os.path.join(data_dirs[0], "results"), "original_out.csv"
-            ),
+async def stage_image_async(
+    in_nii, out_nii, tracer=None, worker=0, executor=None
+):
+    """
+    Reads in_nii into the staging file out_nii, on executor
+    """
+    import asyncio
+
+    from flirt_reg.utils import trace
+
+    with trace.span(tracer, "staging", in_nii, worker) as sp:
+        await asyncio.get_running_loop().run_in_executor(
+            executor, stage_input, in_nii, out_nii
         )
+        sp.read(in_nii)
+        sp.wrote(out_nii)
+    return out_nii
 
-    make_gif(out_paths, data_dirs[0])
 
-    return omats
+async def finish_image_async(
+    result,
+    staged=None,
+    output_policy="compressed",
+    tracer=None,
+    image=None,
+    worker=0,
+    executor=None,
+):
+    """
+    The writing left once an image is registered: compresses the
+    registered volume if the policy asks for it and that was left to this
+    stage, and removes the staged copies of the input, staged is the
+    (data_directory, i, extraction, crop_margin) of remove_staged
+    """
+    import asyncio
 
+    from flirt_reg.utils import trace
 
-def apply_transform(
-    oname="out_####.nii", dname=None, iname=None, verbose=False
+    original_omat, out_name, failure = result
+    if (
+        out_name
+        and output_policy == "compressed"
+        and not out_name.endswith(".gz")
+    ):
+        with trace.span(tracer, "compress", image, worker) as sp:
+            sp.read(out_name)
+            out_name = await asyncio.get_running_loop().run_in_executor(
+                executor, gzip_nii, out_name
+            )
+            sp.wrote(out_name)
+    if staged:
+        remove_staged(*staged)
+    return original_omat, out_name, failure
+
+
+async def crop_input_async(
+    in_file, box_file, out_file, margin, tracer=None, image=None, worker=0
 ):
     """
-    Applies transforms in FLIRT style mat files
+    Crops in_file to the field of view of box_file plus margin mm
     """
-    print("Starting apply_transform")
-    if verbose:
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format="%(asctime)s - %(levelname)s - %(message)s",
-        )
-        logging.debug(f"Verbosity: {verbose}")
-    data_dirs = []
-    if dname:
-        for directory in dname:
-            data_dirs.append(os.path.abspath(directory))
-    else:
-        data_dirs.append(os.getcwd())
+    import asyncio
 
-    if iname:
-        filen, file_ext = os.path.splitext(iname)
-        # Allow numbers to be replaced with #
-        input_schema = [filen.replace("#", ""), file_ext]
-    else:
-        input_schema = [os.path.join(data_dirs[0], "MAT_"), ".txt"]
-    # Check input file exists
-    first_file = f"{input_schema[0]}0000{input_schema[1]}"
-    logging.debug(f"Checking file {first_file}")
-    if os.path.isfile(os.path.abspath(first_file)):
-        logging.debug(f"Opening file {first_file}")
-        cur_dir = os.path.dirname(os.path.abspath(first_file))
-        all_nii = {}
-        n_nii = 0
-        for data_directory in data_dirs:
-            all_nii[data_directory] = get_nii(data_directory)
-            n_nii += len(all_nii[data_directory])
-            all_inputs = get_inputs(n_nii, input_schema)
-    else:
-        logging.debug(f"!!! {first_file} is not a file. !!!\nExiting...")
-        raise FileNotFoundError(
-            errno.ENOENT, os.strerror(errno.ENOENT), first_file
+    from flirt_reg.reg import volume
+    from flirt_reg.utils import trace
+
+    with trace.span(tracer, "crop", image, worker) as sp:
+        await asyncio.get_running_loop().run_in_executor(
+            None, volume.crop_like, in_file, box_file, out_file, margin
         )
+        sp.read(in_file)
+        sp.wrote(out_file)
 
-    if n_nii == 0:
-        print("No NIFTI files found, exiting...")
-        exit()
 
-    # Should make this a global somewhere
-    if os.path.exists("/usr/local/fsl"):
-        fsl_dir = "/usr/local/fsl"
-    elif os.path.exists("/usr/share/fsl/6.0"):
-        fsl_dir = "/usr/share/fsl/6.0"
-    elif os.path.exists("/usr/share/fsl/5.0"):
-        fsl_dir = "/usr/share/fsl/5.0"
-    else:
-        fsl_dir = "/usr/share/fsl"
+async def register_image_async(
+    data_directory,
+    nii_name,
+    i,
+    cur_dir,
+    fsl_dir,
+    extraction=False,
+    cost_func="leastsq",
+    search=90,
+    tracer=None,
+    worker=0,
+    output_policy="compressed",
+    bet_mode="each",
+    mask_refine=False,
+    crop_margin=None,
+    report_costs=None,
+    dtype="float32",
+    staged=False,
+    anchor=None,
+):
+    """
+    Registers a single image to the reference in cur_dir/tmp/ref.nii,
+    returns the avscale parameters (or None) and the registered image path,
+    None with the params-only output policy. BET, FLIRT, avscale and the
+    cost pass run as one chain of subprocesses, each recorded as a span on
+    tracer.
 
-    logging.debug(f"FSL Base Dir: {fsl_dir}")
+    With bet_mode="reference" the reference mask replaces BET, and with
+    mask_refine the mask is carried through the first FLIRT matrix and
+    FLIRT is run again from that matrix. With crop_margin FLIRT runs on
+    the image cropped to the reference crop in cur_dir/tmp/ref_crop.nii
+    plus crop_margin mm, and the matrix is converted back to the full
+    images.
 
-    for data_directory in all_nii:
-        dir_len = len(all_nii[data_directory])
+    Each cost in report_costs (see costs.COSTS) is evaluated between the
+    registered image and the reference and appended to the parameters.
+    With staged the input has already been copied to staged_name.
 
-        print(f"Applying FLIRT Transform on {data_directory}")
-        if cur_dir == data_directory:
-            start_idx = 1
-        else:
-            start_idx = 0
+    anchor is (anchor to reference matrix file, reference image) when
+    cur_dir/tmp/ref.nii is a directory anchor, see prepare_anchors. The
+    matrix found is composed with the anchor's and the input resampled
+    through it, so the parameters, report costs and registered image are
+    to the reference, only the FLIRT cost is to the anchor.
+    """
+    import asyncio
+
+    from flirt_reg.reg import costs, volume
+    from flirt_reg.utils import gpu, trace
 
-        progress.printProgressBar(
-            start_idx,
-            dir_len,
-            prefix="Progress:",
-            suffix="Complete",
-            length=50,
+    # Staging files are per image so several workers can share a directory
+    in_nii = f"{data_directory}/{nii_name}"
+    tmp_nii = f"{data_directory}/tmp/tmp{i}.nii"
+    mat_file = f"{data_directory}/tmp/tmp{i}.txt"
+    out_name = None
+    if output_policy != "params-only":
+        out_name = f"{data_directory}/tmp/reg{i}.nii"
+    ref_nii = f"{cur_dir}/tmp/ref.nii"
+    ref_mask = f"{cur_dir}/tmp/ref_mask.nii"
+    # BET and masking read the staged copy when there is one
+    source = staged_name(data_directory, i, extraction) if staged else in_nii
+    propagate = extraction and bet_mode == "reference"
+    if propagate:
+        with trace.span(tracer, "mask", in_nii, worker) as sp:
+            await asyncio.get_running_loop().run_in_executor(
+                None, volume.apply_mask, source, ref_mask, tmp_nii
+            )
+            sp.read(source, ref_mask)
+            sp.wrote(tmp_nii)
+    elif extraction:
+        with trace.span(tracer, "bet", in_nii, worker) as sp:
+            await fsl_exec.run_cmd(
+                fsl_exec.bet_cmd(fsl_dir, source, tmp_nii),
+                output_type="NIFTI",
+            )
+            sp.read(source)
+            sp.wrote(tmp_nii)
+    elif not staged:
+        await stage_image_async(in_nii, tmp_nii, tracer, worker)
+
+    # FLIRT runs on reg_in and reg_ref, the cropped images when cropping
+    reg_in, reg_ref, reg_mat = tmp_nii, ref_nii, mat_file
+    if anchor:
+        # mat_file is left for the matrix composed with the anchor's
+        reg_mat = f"{data_directory}/tmp/tmp{i}_anchor.txt"
+    if crop_margin is not None:
+        reg_in = f"{data_directory}/tmp/tmp{i}_crop.nii"
+        reg_ref = f"{cur_dir}/tmp/ref_crop.nii"
+        reg_mat = f"{data_directory}/tmp/tmp{i}_crop.txt"
+        await crop_input_async(
+            tmp_nii, reg_ref, reg_in, crop_margin, tracer, in_nii, worker
         )
 
-        if not os.path.exists(f"{data_directory}/tmp"):
-            os.mkdir(f"{data_directory}/tmp")
-        if not os.path.exists(f"{data_directory}/FLIRT_out"):
-            os.mkdir(f"{data_directory}/FLIRT_out")
-        for i in range(start_idx, dir_len):
-            make_coords(data_directory, all_inputs, all_nii, fsl_dir, i)
-            # apply the transform
-            flt = fsl.FLIRT(apply_xfm=True, terminal_output="allatonce")
-            flt.inputs.in_file = (
-                f"{data_directory}/{all_nii[data_directory][i]}"
+    init_file = None
+    if propagate and mask_refine:
+        init_file = f"{data_directory}/tmp/init{i}.txt"
+        init_reg = init_file
+        if crop_margin is not None:
+            init_reg = f"{data_directory}/tmp/init{i}_crop.txt"
+        with trace.span(tracer, "flirt", in_nii, worker) as sp:
+            await fsl_exec.run_cmd(
+                fsl_exec.flirt_cmd(
+                    fsl_dir,
+                    reg_in,
+                    reg_ref,
+                    None,
+                    init_reg,
+                    cost_func=cost_func,
+                    search=search,
+                )
             )
-            flt.inputs.reference = (
-                f"{data_directory}/{all_nii[data_directory][0]}"
+            sp.read(reg_in, reg_ref)
+            sp.wrote(init_reg)
+        with trace.span(tracer, "mask", in_nii, worker) as sp:
+            if crop_margin is not None:
+                volume.crop_to_full(
+                    init_reg, init_file, tmp_nii, reg_in, ref_nii, reg_ref
+                )
+            await asyncio.get_running_loop().run_in_executor(
+                None, volume.apply_mask, source, ref_mask, tmp_nii, init_file
+            )
+            sp.read(source, ref_mask, init_file)
+            sp.wrote(tmp_nii)
+        if crop_margin is not None:
+            await crop_input_async(
+                tmp_nii, reg_ref, reg_in, crop_margin, tracer, in_nii, worker
             )
-            flt.inputs.output_type = "NIFTI_GZ"
-            flt.inputs.schedule = f"{fsl_dir}/etc/flirtsch/measurecost1.sch"
-            flt.inputs.in_matrix_file = (
-                f"{data_directory}/tmp/trans_tmp{i}.txt"
+        init_file = init_reg
+
+    # With an anchor the registered image is resampled once the matrix is
+    # composed, FLIRT's own would be in the anchor's space
+    flirt_out = None if anchor else out_name
+    with trace.span(
+        tracer, "refine" if init_file else "flirt", in_nii, worker
+    ) as sp:
+        cmd = fsl_exec.flirt_cmd(
+            fsl_dir,
+            reg_in,
+            reg_ref,
+            flirt_out,
+            reg_mat,
+            cost_func=cost_func,
+            search=search,
+            init_matrix=init_file,
+        )
+        if flirt_out:
+            out_name = await write_volume_async(
+                cmd, out_name, output_policy, tracer, in_nii, worker
             )
-            flt.inputs.out_file = f"{data_directory}/FLIRT_out/out_{i}.nii.gz"
-            res = flt.run()
-            if res.runtime.returncode != 0:
-                print(f"Error in FLIRT command: '{flt.cmdline}'")
-                exit(0)
-            progress.printProgressBar(
-                i + 1,
-                dir_len,
-                prefix="Progress:",
-                suffix="Complete",
-                length=50,
+        else:
+            await fsl_exec.run_cmd(cmd)
+        sp.read(reg_in, reg_ref)
+        sp.wrote(flirt_out, reg_mat)
+
+    # The cost of the matrix found above, measured on the staged input
+    with trace.span(tracer, "cost", in_nii, worker) as sp:
+        cost_str = await fsl_exec.run_cmd(
+            fsl_exec.cost_cmd(
+                fsl_dir,
+                reg_in,
+                reg_ref,
+                reg_mat,
+                f"{data_directory}/tmp/reg{i}_flirt.mat",
+                cost_func=cost_func,
             )
+        )
+        sp.read(reg_in, reg_ref, reg_mat)
+    full_mat = reg_mat
+    if crop_margin is not None:
+        full_mat = volume.crop_to_full(
+            reg_mat, mat_file, tmp_nii, reg_in, ref_nii, reg_ref
+        )
+    avs_ref = ref_nii
+    if anchor:
+        compose_anchor(anchor[0], full_mat, mat_file)
+        # The report costs compare the full input, through the composed
+        # matrix, with the reference
+        reg_in, reg_ref, reg_mat = tmp_nii, anchor[1], mat_file
+        avs_ref = anchor[1]
+        if out_name:
+            with trace.span(tracer, "resample", in_nii, worker) as sp:
+                out_name = await write_volume_async(
+                    fsl_exec.applyxfm_cmd(
+                        fsl_dir, tmp_nii, avs_ref, mat_file, out_name
+                    ),
+                    out_name,
+                    output_policy,
+                    tracer,
+                    in_nii,
+                    worker,
+                )
+                sp.read(tmp_nii, avs_ref, mat_file)
+                sp.wrote(out_name)
 
-    return True
+    # This will use avscale to get real world co-ords
+    # out of FLIRT, the registered image shares the reference's geometry
+    with trace.span(tracer, "avscale", in_nii, worker) as sp:
+        avs_str = await fsl_exec.run_cmd(
+            fsl_exec.avscale_cmd(fsl_dir, mat_file, avs_ref)
+        )
+        sp.read(mat_file, avs_ref)
+    cost_val = float(cost_str.split()[0])
+    try:
+        original_omat = omat.read_avs(avs_str, cost_val)
+        tmp_omat = omat.read_tmp_trans(mat_file)
+        original_omat[0] = tmp_omat[0][3]
+        original_omat[1] = tmp_omat[1][3]
+        original_omat[2] = tmp_omat[2][3]
+    except IndexError:
+        logging.debug(f"{mat_file} does not contain omat data")
+        original_omat = None
+    if report_costs and original_omat is not None:
+        with trace.span(tracer, "costs", in_nii, worker) as sp:
+            values = await asyncio.get_running_loop().run_in_executor(
+                None,
+                costs.registered_costs,
+                report_costs,
+                reg_ref,
+                out_name,
+                reg_in,
+                reg_mat,
+                dtype,
+            )
+            sp.read(out_name or reg_in, reg_ref)
+        xp = gpu.array_module()
+        original_omat = xp.concatenate([original_omat, xp.array(values)])
+    return original_omat, out_name
 
 
-def apply_transform_cmd():
-    # Initialise simple timer
-    start_time = time.time()
+def register_image(*args, **kwargs):
     """
-    A simple runner for the program with arguments
+    Blocking version of register_image_async
     """
-    # execute only if run as a script
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-d",
-        "--dirname",
-        nargs="+",
-        help="input directory name(s). Default: searches \
-                same directory for as filename for .nii.",
-    )
-    parser.add_argument(
-        "-o", "--output", help="output filenames. Default: out_####.nii."
-    )
-    parser.add_argument(
-        "-v",
-        "--verbose",
-        action="store_true",
-        help="prints debugging information. Default: false.",
-    )
-    parser.add_argument(
-        "-i",
-        "--input",
-        help="input mat files. Default: tries to find MAT_####.txt \
-                in local dir.",
-    )
-    args = parser.parse_args()
-
-    # call the apply_transform function with cmd line args
-    apply_transform(
-        oname=args.output,
-        dname=args.dirname,
-        iname=args.input,
-        verbose=args.verbose,
-    )
+    import asyncio
 
-    if args.verbose:
-        total_time = time.gmtime((time.time() - start_time))
-        print(f"Pipeline complete in {time.strftime('%Hh%Mm%Ss', total_time)}")
+    return asyncio.run(register_image_async(*args, **kwargs))
 
 
-def get_gif_slices(image):
-    """Gets 3 orthogonal slices that show how good the registration is
+def retry_plan(cost_func, retries=0, retry_costs=None, retry_search=180):
+    """
+    Lists the (cost function, search range) used for each attempt, retries
+    move through retry_costs then repeat cost_func with the wider search
+    """
+    retry_costs = list(retry_costs or [])
+    plan = [(cost_func, 90)]
+    for attempt in range(max(retries, len(retry_costs))):
+        if attempt < len(retry_costs):
+            plan.append((retry_costs[attempt], retry_search))
+        else:
+            plan.append((cost_func, retry_search))
+    return plan
 
-    Args:
-        image (nb.NiftiImage): the image to get slices from
 
-    Returns:
-        (np.array): the three slices
+async def register_with_retries(
+    data_directory,
+    nii_name,
+    i,
+    cur_dir,
+    fsl_dir,
+    extraction=False,
+    plan=None,
+    tracer=None,
+    worker=0,
+    output_policy="compressed",
+    bet_mode="each",
+    mask_refine=False,
+    crop_margin=None,
+    report_costs=None,
+    dtype="float32",
+    staged=False,
+    anchor=None,
+):
     """
-    xp = gpopt.array_module("cupy")
-    array = image.get_fdata()
-    shape = xp.shape(array)
-    mid_x = int(xp.floor(shape[0] / 2))
-    mid_y = int(xp.floor(shape[1] / 2))
-    mid_z = int(xp.floor(shape[2] / 2))
-    slices = [
-        xp.flipud(array[mid_x, :, :]),
-        array[:, mid_y, :],
-        xp.rot90(array[:, :, mid_z]),
-    ]
-    return slices
+    Runs register_image_async through each attempt in plan until one
+    succeeds. Returns (avscale parameters, registered image path, failure)
+    where failure is None on success or a dict describing the last error.
+    """
+    from nibabel.filebasedimages import ImageFileError
 
+    if not plan:
+        plan = retry_plan("leastsq")
+    for attempt, (cost_func, search) in enumerate(plan):
+        try:
+            original_omat, out_name = await register_image_async(
+                data_directory,
+                nii_name,
+                i,
+                cur_dir,
+                fsl_dir,
+                extraction=extraction,
+                cost_func=cost_func,
+                search=search,
+                tracer=tracer,
+                worker=worker,
+                output_policy=output_policy,
+                bet_mode=bet_mode,
+                mask_refine=mask_refine,
+                crop_margin=crop_margin,
+                report_costs=report_costs,
+                dtype=dtype,
+                staged=staged,
+                anchor=anchor,
+            )
+            if attempt:
+                logging.debug(
+                    f"{nii_name} registered on attempt {attempt + 1} "
+                    f"with {cost_func}, search +/-{search}"
+                )
+            return original_omat, out_name, None
+        except (
+            fsl_exec.FSLError,
+            ImageFileError,
+            ValueError,
+            IndexError,
+            OSError,
+        ) as err:
+            logging.debug(f"Attempt {attempt + 1} on {nii_name} failed: {err}")
+            error = err
+    failure = {
+        "image": f"{data_directory}/{nii_name}",
+        "attempts": len(plan),
+        "error": str(error).strip(),
+    }
+    if isinstance(error, fsl_exec.FSLError) and error.stderr:
+        failure["error"] += f": {error.stderr.strip()}"
+    return None, None, failure
 
-def make_gif(img_paths, out_path):
 
-    slices = []
-    for path in img_paths:
-        img = nb.load(path)
-        slices.append(get_gif_slices(img))
+def compose_anchor(anchor_mat, mat_file, out_file):
+    """
+    Writes the FLIRT matrix in anchor_mat (anchor to reference) applied
+    after the one in mat_file (image to anchor) to out_file
+    """
+    import numpy as np
+
+    return omat.write_omat(
+        np.loadtxt(anchor_mat) @ np.loadtxt(mat_file), out_file
+    )
+
+
+def image_reference(
+    data_directory, cur_dir, plan, anchors=None, anchor_search=ANCHOR_SEARCH
+):
+    """
+    (reference directory, plan, anchor) for the images in data_directory,
+    the anchor's directory and a narrow search first if it has an anchor
+    in anchors (see prepare_anchors), else cur_dir and plan unchanged
+    """
+    anchor_mat = (anchors or {}).get(data_directory)
+    if not anchor_mat:
+        return cur_dir, plan, None
+    if not plan:
+        plan = retry_plan("leastsq")
+    # The full search is the first fallback
+    plan = [(plan[0][0], anchor_search)] + list(plan)
+    return data_directory, plan, (anchor_mat, f"{cur_dir}/tmp/ref.nii")
+
+
+def prepare_anchor(
+    data_directory,
+    images,
+    cur_dir,
+    fsl_dir,
+    extraction=False,
+    tracer=None,
+    bet_mode="each",
+    crop_margin=None,
+    cost_func="leastsq",
+    anchor="first",
+    dtype="float32",
+):
+    """
+    Stages the anchor of data_directory as its tmp/ref.nii (see
+    prepare_reference) and registers it to the reference with the full
+    search. Returns the anchor to reference matrix file, or None if FLIRT
+    failed.
+    """
+    import asyncio
+
+    from flirt_reg.reg import volume
+    from flirt_reg.utils import trace
+
+    tmp_dir = f"{data_directory}/tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    source = f"{data_directory}/{images[0]}"
+    if anchor == "mean":
+        with trace.span(tracer, "anchor_mean", data_directory) as sp:
+            source = volume.mean_volume(
+                [f"{data_directory}/{name}" for name in images],
+                f"{tmp_dir}/anchor_mean.nii",
+                dtype,
+            )
+            sp.wrote(source)
+    prepare_reference(
+        source,
+        data_directory,
+        fsl_dir,
+        extraction,
+        tracer,
+        bet_mode,
+        crop_margin,
+    )
+    anchor_mat = f"{tmp_dir}/anchor.txt"
+    with trace.span(tracer, "anchor", data_directory) as sp:
+        try:
+            asyncio.run(
+                fsl_exec.run_cmd(
+                    fsl_exec.flirt_cmd(
+                        fsl_dir,
+                        f"{tmp_dir}/ref.nii",
+                        f"{cur_dir}/tmp/ref.nii",
+                        None,
+                        anchor_mat,
+                        cost_func=cost_func,
+                        search=90,
+                    )
+                )
+            )
+        except fsl_exec.FSLError as err:
+            print(
+                f"Could not register the anchor of {data_directory} ({err}), "
+                "its images are registered to the reference directly"
+            )
+            return None
+        sp.read(f"{tmp_dir}/ref.nii", f"{cur_dir}/tmp/ref.nii")
+        sp.wrote(anchor_mat)
+    logging.debug(f"Anchor of {data_directory}: {source}")
+    return anchor_mat
+
+
+def prepare_anchors(
+    all_nii,
+    cur_dir,
+    fsl_dir,
+    extraction=False,
+    jobs=1,
+    tracer=None,
+    bet_mode="each",
+    crop_margin=None,
+    cost_func="leastsq",
+    anchor="first",
+    dtype="float32",
+):
+    """
+    Prepares an anchor for every directory other than the reference's,
+    up to jobs at once, see prepare_anchor. Returns {directory: anchor to
+    reference matrix file} for the anchors that registered.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if anchor not in ANCHORS:
+        raise ValueError(f"Unknown anchor {anchor}")
+    directories = [
+        data_directory
+        for data_directory in all_nii
+        if data_directory != cur_dir and all_nii[data_directory]
+    ]
+    print(f"Registering {len(directories)} directory anchors")
+    with ThreadPoolExecutor(max(jobs, 1)) as pool:
+        futures = {
+            data_directory: pool.submit(
+                prepare_anchor,
+                data_directory,
+                all_nii[data_directory],
+                cur_dir,
+                fsl_dir,
+                extraction,
+                tracer,
+                bet_mode,
+                crop_margin,
+                cost_func,
+                anchor,
+                dtype,
+            )
+            for data_directory in directories
+        }
+        anchors = {
+            data_directory: future.result()
+            for data_directory, future in futures.items()
+        }
+    return {
+        data_directory: anchor_mat
+        for data_directory, anchor_mat in anchors.items()
+        if anchor_mat
+    }
+
+
+def reference_index(all_nii, cur_dir, data_directory, reference=None):
+    """
+    Index of the reference among the files of data_directory, None if it
+    is not there. The reference is the file reference names, or the first
+    file of cur_dir if it is None or not one of them.
+    """
+    if cur_dir != data_directory:
+        return None
+    path = os.path.abspath(reference) if reference else ""
+    name = os.path.basename(path)
+    if (
+        os.path.dirname(path) == data_directory
+        and name in all_nii[data_directory]
+    ):
+        return all_nii[data_directory].index(name)
+    return 0
+
+
+def list_images(all_nii, cur_dir, data_directory, reference=None):
+    """
+    (directory, file, index) of each image to register in data_directory,
+    the reference itself is skipped, see reference_index
+    """
+    skip = reference_index(all_nii, cur_dir, data_directory, reference)
+    return [
+        (data_directory, nii_name, i)
+        for i, nii_name in enumerate(all_nii[data_directory])
+        if i != skip
+    ]
+
+
+def reference_row(all_nii, cur_dir, reference=None):
+    """
+    Row of the reference in out.csv, its place among the inputs so the
+    rows stay in input order. The images of list_images fill the other
+    rows, position pos in row pos + (pos >= reference_row).
+    """
+    row = 0
+    for data_directory in all_nii:
+        skip = reference_index(all_nii, cur_dir, data_directory, reference)
+        if skip is not None:
+            return row + skip
+        row += len(all_nii[data_directory])
+    return 0
+
+
+async def iter_flirt_async(
+    all_nii,
+    cur_dir,
+    fsl_dir,
+    extraction=False,
+    plan=None,
+    jobs=1,
+    tracer=None,
+    metrics=None,
+    output_policy="compressed",
+    bet_mode="each",
+    mask_refine=False,
+    crop_margin=None,
+    report_costs=None,
+    dtype="float32",
+    prefetch_depth=PREFETCH_DEPTH,
+    write_depth=WRITE_DEPTH,
+    io_threads=IO_THREADS,
+    anchors=None,
+    anchor_search=ANCHOR_SEARCH,
+    predict=None,
+    reference=None,
+    stop=None,
+):
+    """
+    Registers every image with jobs registration workers, yields
+    (position, (directory, file, index), (avscale parameters, registered
+    image path, failure)) for each image as soon as it finishes.
+
+    Reading and writing run in stages of their own, joined to the workers
+    by bounded queues: io_threads prefetch threads stage inputs up to
+    prefetch_depth images ahead of the workers, and io_threads writer
+    threads compress registered volumes with up to write_depth waiting.
+    A full queue holds the stage before it back. A depth of 0 does that
+    step in the registration worker instead.
+
+    Images in a directory with an anchor in anchors are registered to
+    the anchor, see image_reference.
+
+    predict(image path) gives the expected seconds of an image (see
+    utils.history), with it the longest images are started first.
+    reference is the reference image, see reference_index. Once stop (a
+    threading.Event) is set no more images are started.
+    """
+    from flirt_reg.reg import pipeline
+    from flirt_reg.utils.metrics import Metrics
+
+    images = []
+    for data_directory in all_nii:
+        if not os.path.exists(f"{data_directory}/tmp"):
+            os.mkdir(f"{data_directory}/tmp")
+        print(f"Running FLIRT on {data_directory}")
+        images += list_images(all_nii, cur_dir, data_directory, reference)
+
+    if metrics is None:
+        metrics = Metrics()
+    metrics.set_total(len(images))
+
+    order = None
+    if predict is not None:
+        # A long image started last would hold up the end of the run
+        seconds = [predict(f"{image[0]}/{image[1]}") for image in images]
+        order = sorted(range(len(images)), key=lambda pos: -seconds[pos])
+
+    # Compression is left to the writers when there are any
+    reg_policy = output_policy
+    if write_depth and output_policy == "compressed":
+        reg_policy = "uncompressed"
+
+    async def stage(pos, lane, executor):
+        data_directory, nii_name, i = images[pos]
+        in_nii = f"{data_directory}/{nii_name}"
+        staged_nii = staged_name(data_directory, i, extraction)
+        try:
+            await stage_image_async(in_nii, staged_nii, tracer, lane, executor)
+        except OSError as err:
+            return {"image": in_nii, "attempts": 0, "error": str(err)}
+        return None
+
+    async def register(pos, worker, staged, failure):
+        data_directory, nii_name, i = images[pos]
+        metrics.set_queue_depth(metrics.queue_depth - 1)
+        res = (None, None, failure)
+        if failure is None:
+            ref_dir, ref_plan, anchor = image_reference(
+                data_directory, cur_dir, plan, anchors, anchor_search
+            )
+            res = await register_with_retries(
+                data_directory,
+                nii_name,
+                i,
+                ref_dir,
+                fsl_dir,
+                extraction=extraction,
+                plan=ref_plan,
+                tracer=tracer,
+                worker=worker,
+                output_policy=reg_policy,
+                bet_mode=bet_mode,
+                mask_refine=mask_refine,
+                crop_margin=crop_margin,
+                report_costs=report_costs,
+                dtype=dtype,
+                staged=staged,
+                anchor=anchor,
+            )
+        metrics.image_done(failed=res[2] is not None)
+        return res
+
+    async def finish(pos, res, lane, executor=None):
+        data_directory, nii_name, i = images[pos]
+        return await finish_image_async(
+            res,
+            (data_directory, i, extraction, crop_margin),
+            output_policy,
+            tracer,
+            f"{data_directory}/{nii_name}",
+            lane,
+            executor,
+        )
+
+    stages = pipeline.Pipeline(
+        len(images),
+        stage,
+        register,
+        finish,
+        jobs=jobs,
+        prefetch_depth=prefetch_depth,
+        write_depth=write_depth,
+        io_threads=io_threads,
+        order=order,
+        stop=stop,
+    )
+    async for pos, res in stages.results():
+        yield pos, images[pos], res
+
+
+async def run_flirt_async(
+    all_nii,
+    cur_dir,
+    fsl_dir,
+    extraction=False,
+    plan=None,
+    jobs=1,
+    tracer=None,
+    metrics=None,
+    output_policy="compressed",
+    bet_mode="each",
+    mask_refine=False,
+    crop_margin=None,
+    report_costs=None,
+    dtype="float32",
+    prefetch_depth=PREFETCH_DEPTH,
+    write_depth=WRITE_DEPTH,
+    io_threads=IO_THREADS,
+    anchors=None,
+    anchor_search=ANCHOR_SEARCH,
+    reference=None,
+):
+    """
+    Registers every image with at most jobs images in flight, returns
+    (avscale parameters, registered image path, failure) in input order
+    """
+    results = {}
+    async for pos, _, res in iter_flirt_async(
+        all_nii,
+        cur_dir,
+        fsl_dir,
+        extraction=extraction,
+        plan=plan,
+        jobs=jobs,
+        tracer=tracer,
+        metrics=metrics,
+        output_policy=output_policy,
+        bet_mode=bet_mode,
+        mask_refine=mask_refine,
+        crop_margin=crop_margin,
+        report_costs=report_costs,
+        dtype=dtype,
+        prefetch_depth=prefetch_depth,
+        write_depth=write_depth,
+        io_threads=io_threads,
+        anchors=anchors,
+        anchor_search=anchor_search,
+        reference=reference,
+    ):
+        results[pos] = res
+    return [results[pos] for pos in sorted(results)]
+
+
+def collect_result(collected, result, n_costs=0):
+    """
+    Adds one (avscale parameters, path, failure) result to the lists made
+    by collect_results, a failed image gets a row of NaNs (7 plus n_costs
+    reported costs wide) so rows still line up with the inputs
+    """
+    from flirt_reg.utils import gpu
+
+    xp = gpu.array_module()
+    omats, original_omats, out_names, failures = collected
+    original_omat, out_name, failure = result
+    if failure:
+        failures.append(failure)
+        original_omats.append(xp.full(7 + n_costs, xp.nan))
+        omats.append(original_omats[-1])
+        return collected
+    if out_name:
+        out_names.append(out_name)
+    if original_omat is not None:
+        original_omats.append(original_omat)
+        omats.append(original_omat)
+    return collected
+
+
+def add_reference(collected):
+    """
+    Adds the reference's row, 'registered' to itself, to the lists made
+    by collect_results
+    """
+    from flirt_reg.utils import gpu
+
+    xp = gpu.array_module()
+    collected[0].append(xp.array([0, 0, 0, 0, 0, 0]))
+    collected[1].append(xp.array([0, 0, 0, 0, 0, 0]))
+    return collected
+
+
+def collect_results(results, n_costs=0, ref_row=0):
+    """
+    Turns per image (avscale parameters, path, failure) results, in input
+    order, into the omat lists with the reference's row at ref_row, see
+    collect_result and reference_row
+    """
+    collected = ([], [], [], [])
+    for result in results:
+        if len(collected[0]) == ref_row:
+            add_reference(collected)
+        collect_result(collected, result, n_costs)
+    if len(collected[0]) == ref_row:
+        add_reference(collected)
+    return collected
+
+
+def run_flirt(
+    all_nii,
+    cur_dir,
+    fsl_dir,
+    rads=False,
+    extraction=False,
+    cost_func="leastsq",
+    jobs=1,
+    retries=0,
+    retry_costs=None,
+    retry_search=180,
+    tracer=None,
+    metrics=None,
+    output_policy="compressed",
+    bet_mode="each",
+    mask_refine=False,
+    crop_margin=None,
+    report_costs=None,
+    dtype="float32",
+    prefetch_depth=PREFETCH_DEPTH,
+    write_depth=WRITE_DEPTH,
+    io_threads=IO_THREADS,
+    anchors=None,
+    anchor_search=ANCHOR_SEARCH,
+    reference=None,
+):
+    """
+    Registers all images to the reference, an image that still fails after
+    its retries is reported in the returned failures list
+    """
+    import asyncio
+
+    plan = retry_plan(cost_func, retries, retry_costs, retry_search)
+    results = asyncio.run(
+        run_flirt_async(
+            all_nii,
+            cur_dir,
+            fsl_dir,
+            extraction=extraction,
+            plan=plan,
+            jobs=jobs,
+            tracer=tracer,
+            metrics=metrics,
+            output_policy=output_policy,
+            bet_mode=bet_mode,
+            mask_refine=mask_refine,
+            crop_margin=crop_margin,
+            report_costs=report_costs,
+            dtype=dtype,
+            prefetch_depth=prefetch_depth,
+            write_depth=write_depth,
+            io_threads=io_threads,
+            anchors=anchors,
+            anchor_search=anchor_search,
+            reference=reference,
+        )
+    )
+    return collect_results(
+        results,
+        len(report_costs or []),
+        reference_row(all_nii, cur_dir, reference),
+    )
+
+
+def register_task(task, config):
+    """
+    Runs one work queue task, see workqueue.run_worker
+    """
+    import asyncio
+
+    from flirt_reg.utils import niio, trace
+
+    data_directory = task["data_directory"]
+    if not os.path.exists(f"{data_directory}/tmp"):
+        os.makedirs(f"{data_directory}/tmp", exist_ok=True)
+    niio.configure(**config.get("compression", {}))
+    tracer = trace.Tracer()
+    ref_dir, plan, anchor = image_reference(
+        data_directory,
+        config["cur_dir"],
+        config["plan"],
+        config.get("anchors"),
+        config.get("anchor_search", ANCHOR_SEARCH),
+    )
+    original_omat, out_name, failure = asyncio.run(
+        register_with_retries(
+            data_directory,
+            task["nii"],
+            task["index"],
+            ref_dir,
+            config["fsl_dir"],
+            extraction=config["extraction"],
+            plan=plan,
+            tracer=tracer,
+            output_policy=config.get("output_policy", "compressed"),
+            bet_mode=config.get("bet_mode", "each"),
+            mask_refine=config.get("mask_refine", False),
+            crop_margin=config.get("crop_margin"),
+            report_costs=config.get("report_costs"),
+            dtype=config.get("dtype", "float32"),
+            anchor=anchor,
+        )
+    )
+    remove_staged(
+        data_directory,
+        task["index"],
+        config["extraction"],
+        config.get("crop_margin"),
+    )
+    if original_omat is not None:
+        original_omat = [float(val) for val in original_omat]
+    return {
+        "omat": original_omat,
+        "out_name": out_name,
+        "failure": failure,
+        "spans": tracer.events,
+    }
+
+
+def queue_result(res):
+    """
+    (avscale parameters, registered image path, failure) of a work queue
+    result
+    """
+    from flirt_reg.utils import gpu
+
+    xp = gpu.array_module()
+    original_omat = None if res["omat"] is None else xp.array(res["omat"])
+    return original_omat, res["out_name"], res.get("failure")
+
+
+def run_flirt_queue(
+    all_nii,
+    cur_dir,
+    fsl_dir,
+    queue_dir,
+    extraction=False,
+    cost_func="leastsq",
+    local_workers=0,
+    lease_time=60,
+    verbose=False,
+    retries=0,
+    retry_costs=None,
+    retry_search=180,
+    tracer=None,
+    metrics=None,
+    output_policy="compressed",
+    bet_mode="each",
+    mask_refine=False,
+    crop_margin=None,
+    report_costs=None,
+    dtype="float32",
+    on_image=None,
+    anchors=None,
+    anchor_search=ANCHOR_SEARCH,
+    reference=None,
+    stop=None,
+):
+    """
+    Distributes run_flirt over workers sharing queue_dir, returns the same
+    values as run_flirt once every task has a result. on_image is called
+    with (position, (directory, file, index), result) as each arrives.
+    Once stop (a threading.Event) is set the rest is left in queue_dir
+    and None is returned, see workqueue.run_coordinator.
+    """
+    from flirt_reg.reg import workqueue
+    from flirt_reg.utils import niio
+    from flirt_reg.utils.metrics import Metrics
+
+    for data_directory in all_nii:
+        if not os.path.exists(f"{data_directory}/tmp"):
+            os.mkdir(f"{data_directory}/tmp")
+    images = []
+    for data_directory in all_nii:
+        images += list_images(all_nii, cur_dir, data_directory, reference)
+    tasks = workqueue.make_tasks(images)
+    config = {
+        "cur_dir": cur_dir,
+        "fsl_dir": fsl_dir,
+        "extraction": extraction,
+        "plan": retry_plan(cost_func, retries, retry_costs, retry_search),
+        "output_policy": output_policy,
+        "bet_mode": bet_mode,
+        "mask_refine": mask_refine,
+        "crop_margin": crop_margin,
+        "report_costs": report_costs,
+        "dtype": dtype,
+        "anchors": anchors,
+        "anchor_search": anchor_search,
+        "compression": dict(niio.SETTINGS),
+    }
+    if metrics is None:
+        metrics = Metrics()
+    metrics.set_total(len(tasks))
+
+    def on_result(res, reused):
+        if reused:
+            metrics.cache_hit()
+        else:
+            metrics.cache_miss()
+            if tracer is not None:
+                tracer.extend(res.get("spans", []))
+        metrics.image_done(failed=res.get("failure") is not None)
+        if on_image:
+            task = tasks[res["id"]]
+            image = (task["data_directory"], task["nii"], task["index"])
+            on_image((res["id"], image, queue_result(res)))
+
+    results = workqueue.run_coordinator(
+        queue_dir,
+        tasks,
+        config,
+        local_workers=local_workers,
+        lease_time=lease_time,
+        verbose=verbose,
+        on_result=on_result,
+        on_poll=metrics.set_queue_depth,
+        stop=stop,
+    )
+    if results is None:
+        return None
+    return collect_results(
+        [queue_result(res) for res in results],
+        len(report_costs or []),
+        reference_row(all_nii, cur_dir, reference),
+    )
+
+
+def write_failures(failures, fname):
+    """
+    Writes a report of images that could not be processed
+    """
+    with open(fname, "w", newline="\n") as csvfile:
+        failwriter = csv.writer(csvfile, delimiter=",")
+        failwriter.writerow(["image", "attempts", "error"])
+        for failure in failures:
+            failwriter.writerow(
+                [failure["image"], failure["attempts"], failure["error"]]
+            )
+    print(f"{len(failures)} images failed, see {fname}")
+
+
+def queue_worker(queue_dir, verbose=False):
+    """
+    Joins a work queue started by flirt_reg(queue_dir=...)
+    """
+    from flirt_reg.reg import workqueue
+
+    if verbose:
+        logging.basicConfig(
+            level=logging.DEBUG,
+            format="%(asctime)s - %(levelname)s - %(message)s",
+        )
+    return workqueue.run_worker(queue_dir, register_task)
+
+
+def find_inputs(fname, data_dirs, max_images=None):
+    """
+    Finds the images to register and the reference, returns the reference
+    directory, the {directory: [files]} dict, the image count and the
+    reference path
+    """
+    # Check input files and get the baseline file to register against
+    if fname:
+        logging.debug(f"Checking file {fname}")
+        if os.path.isfile(os.path.abspath(fname)):
+            logging.debug(f"Opening file {fname}")
+            cur_dir = os.path.dirname(os.path.abspath(fname))
+            all_nii = {}
+            n_nii = 0
+            for data_directory in data_dirs:
+                all_nii[data_directory] = get_nii(data_directory, max_images)
+                n_nii += len(all_nii[data_directory])
+        else:
+            logging.debug(f"!!! {fname} is not a file. !!!\nExiting...")
+            raise FileNotFoundError(
+                errno.ENOENT, os.strerror(errno.ENOENT), fname
+            )
+    else:
+        cur_dir = os.getcwd()
+        all_nii = {}
+        all_nii[data_dirs[0]] = get_nii(data_dirs[0], max_images)
+        fname = os.path.join(data_dirs[0], all_nii[data_dirs[0]][0])
+        n_nii = len(all_nii)
+    return cur_dir, all_nii, n_nii, fname
+
+
+def catalog_inputs(fname, all_nii, cur_dir, jobs=8):
+    """
+    Reads the header of every input in parallel, keeping the index in
+    cur_dir/tmp so unchanged files are not re-read next time, and warns
+    about images that cannot be read or whose geometry differs from the
+    reference. Returns the catalog and the mismatches.
+    """
+    from flirt_reg.utils import nii
+
+    paths = [fname]
+    for data_directory in all_nii:
+        paths += [
+            os.path.join(data_directory, nii_name)
+            for nii_name in all_nii[data_directory]
+        ]
+    catalog = nii.catalog_files(
+        paths, jobs, index_file=f"{cur_dir}/tmp/{nii.INDEX_NAME}"
+    )
+    for error in nii.unreadable(catalog):
+        print(f"Warning: could not read {error}")
+    mismatches = nii.geometry_mismatches(catalog, fname)
+    if mismatches:
+        print(
+            f"Warning: {len(mismatches)} images do not match the "
+            "reference geometry:"
+        )
+        for mismatch in mismatches[:10]:
+            print(f"  {mismatch}")
+        if len(mismatches) > 10:
+            print(f"  ... and {len(mismatches) - 10} more")
+    return catalog, mismatches
+
+
+def prepare_reference(
+    fname,
+    cur_dir,
+    fsl_dir,
+    extraction=False,
+    tracer=None,
+    bet_mode="each",
+    crop_margin=None,
+):
+    """
+    Stages the reference as cur_dir/tmp/ref.nii, brain extracting it if
+    requested. With bet_mode="reference" the brain mask is kept as
+    cur_dir/tmp/ref_mask.nii for the other images. With crop_margin the
+    foreground (or brain mask) plus crop_margin mm is also written to
+    cur_dir/tmp/ref_crop.nii.
+    """
+    import asyncio
+
+    from flirt_reg.reg import volume
+    from flirt_reg.utils import trace
+
+    with trace.span(tracer, "reference", fname) as sp:
+        if extraction:
+            try:
+                asyncio.run(
+                    fsl_exec.run_cmd(
+                        fsl_exec.bet_cmd(
+                            fsl_dir,
+                            fname,
+                            f"{cur_dir}/tmp/ref.nii",
+                            mask=bet_mode == "reference",
+                        ),
+                        output_type="NIFTI",
+                    )
+                )
+            except fsl_exec.FSLError as err:
+                print(f"{err}, check there are no spaces in path")
+                sys.exit(1)
+        else:
+            shutil.copyfile(fname, f"{cur_dir}/tmp/ref.nii")
+        sp.read(fname)
+        sp.wrote(f"{cur_dir}/tmp/ref.nii")
+    if crop_margin is None:
+        return
+    mask_file = None
+    if extraction and bet_mode == "reference":
+        mask_file = f"{cur_dir}/tmp/ref_mask.nii"
+    with trace.span(tracer, "crop", fname) as sp:
+        full_shape, crop_shape = volume.crop_reference(
+            f"{cur_dir}/tmp/ref.nii",
+            f"{cur_dir}/tmp/ref_crop.nii",
+            crop_margin,
+            mask_file,
+        )
+        sp.wrote(f"{cur_dir}/tmp/ref_crop.nii")
+    full_vox = full_shape[0] * full_shape[1] * full_shape[2]
+    crop_vox = crop_shape[0] * crop_shape[1] * crop_shape[2]
+    print(
+        f"Cropped reference from {full_shape} to {crop_shape}, "
+        f"{100 * crop_vox / full_vox:.0f}% of the voxels"
+    )
+
+
+async def mask_parity_async(images, cur_dir, fsl_dir, mask_refine=False):
+    """
+    Runs BET on each image and compares its mask with the propagated
+    reference mask, returns a {image, dice} dict per image
+    """
+    import asyncio
+
+    from flirt_reg.reg import volume
+
+    ref_mask = f"{cur_dir}/tmp/ref_mask.nii"
+    loop = asyncio.get_running_loop()
+
+    async def check(data_directory, nii_name, i):
+        in_nii = f"{data_directory}/{nii_name}"
+        mat_file = None
+        if mask_refine:
+            mat_file = f"{data_directory}/tmp/init{i}.txt"
+            if not os.path.isfile(mat_file):
+                # Registration failed, nothing to compare
+                return None
+        check_nii = f"{data_directory}/tmp/check{i}.nii"
+        await fsl_exec.run_cmd(
+            fsl_exec.bet_cmd(fsl_dir, in_nii, check_nii, mask=True),
+            output_type="NIFTI",
+        )
+        dice = await loop.run_in_executor(
+            None,
+            volume.mask_dice,
+            in_nii,
+            ref_mask,
+            f"{data_directory}/tmp/check{i}_mask.nii",
+            mat_file,
+        )
+        return {"image": in_nii, "dice": dice}
+
+    parity = await asyncio.gather(*[check(*image) for image in images])
+    return [res for res in parity if res]
+
+
+def check_mask_parity(
+    all_nii,
+    cur_dir,
+    fsl_dir,
+    sample,
+    out_dir,
+    mask_refine=False,
+    reference=None,
+):
+    """
+    Compares the propagated reference mask with per image BET on sample
+    images spread through the series, writes mask_parity.csv to out_dir
+    """
+    import asyncio
+
+    images = []
+    for data_directory in all_nii:
+        images += list_images(all_nii, cur_dir, data_directory, reference)
+    if sample < len(images):
+        images = [images[idx * len(images) // sample] for idx in range(sample)]
+    try:
+        parity = asyncio.run(
+            mask_parity_async(images, cur_dir, fsl_dir, mask_refine)
+        )
+    except (fsl_exec.FSLError, OSError) as err:
+        print(f"Mask parity check failed: {err}")
+        return []
+    fname = os.path.join(out_dir, "mask_parity.csv")
+    with open(fname, "w", newline="\n") as csvfile:
+        paritywriter = csv.writer(csvfile, delimiter=",")
+        paritywriter.writerow(["image", "dice"])
+        for res in parity:
+            paritywriter.writerow([res["image"], res["dice"]])
+    if parity:
+        dices = [res["dice"] for res in parity]
+        print(
+            f"Mask parity with per image BET over {len(dices)} images: "
+            f"mean Dice {sum(dices) / len(dices):.3f}, min {min(dices):.3f}"
+        )
+        if min(dices) < MASK_DICE_WARN:
+            print(
+                f"Warning: propagated mask Dice below {MASK_DICE_WARN}, "
+                f"consider --mask-refine or --bet-mode each, see {fname}"
+            )
+    return parity
+
+
+def series_qc(
+    omats,
+    fname,
+    all_nii,
+    cur_dir,
+    out_dir,
+    mask_file=None,
+    fd_radius=None,
+    fd_threshold=None,
+    dtype="float32",
+    tracer=None,
+    registered=None,
+    crop_margin=None,
+):
+    """
+    Writes qc.csv for the reference and the registered images, in the
+    same order as the rows of out.csv. DVARS is computed on the
+    registered files, one per image or None, see write_results, which
+    are on the grid of the reference (cropped with crop_margin). Images
+    without one get NaN, see qc.stream_dvars.
+    """
+    from flirt_reg.reg import qc
+    from flirt_reg.utils import trace
+
+    images = []
+    for data_directory in all_nii:
+        images += [
+            f"{directory}/{nii_name}"
+            for directory, nii_name, _ in list_images(
+                all_nii, cur_dir, data_directory, fname
+            )
+        ]
+    ref_file = f"{cur_dir}/tmp/ref.nii"
+    if crop_margin is not None:
+        # The brain mask is on the full grid
+        ref_file, mask_file = f"{cur_dir}/tmp/ref_crop.nii", None
+    volumes = list(registered or [None] * len(images))
+    ref_row = reference_row(all_nii, cur_dir, fname)
+    images.insert(ref_row, os.path.abspath(fname))
+    volumes.insert(ref_row, ref_file)
+    params = [[float(val) for val in reg[:6]] for reg in omats]
+    qc_csv = os.path.join(out_dir, "qc.csv")
+    with trace.span(tracer, "qc") as sp:
+        summary = qc.run_qc(
+            params,
+            images,
+            ref_file,
+            qc_csv,
+            mask_file=mask_file,
+            radius=qc.FD_RADIUS if fd_radius is None else fd_radius,
+            fd_threshold=(
+                qc.FD_THRESHOLD if fd_threshold is None else fd_threshold
+            ),
+            dtype=dtype,
+            volumes=volumes,
+        )
+        sp.read(*[volume for volume in volumes if volume])
+        sp.wrote(qc_csv)
+    print(
+        f"QC: mean FD {summary['fd_mean']:.3f} mm, max "
+        f"{summary['fd_max']:.3f} mm, {len(summary['outliers'])} outlier "
+        f"volumes, see {qc_csv}"
+    )
+    return summary
+
+
+def check_options(output_policy, gif, bet_mode, dtype, report_costs=None):
+    """
+    Validates the flirt_reg options, returns the registered volume policy
+    """
+    from flirt_reg.reg import costs, volume
+
+    if bet_mode not in BET_MODES:
+        raise ValueError(f"Unknown BET mode {bet_mode}")
+    if dtype not in volume.DTYPES:
+        raise ValueError(f"Unknown dtype {dtype}")
+    costs.check_costs(report_costs or [])
+    return volume_policy(output_policy, gif)
+
+
+def reference_costs(
+    original_omats, report_costs, cur_dir, crop_margin=None, ref_row=0
+):
+    """
+    Fills in the reported costs of the reference against itself, row
+    ref_row of original_omats
+    """
+    from flirt_reg.reg import costs
+    from flirt_reg.utils import gpu
+
+    if not report_costs:
+        return original_omats
+    xp = gpu.array_module()
+    ref_nii = f"{cur_dir}/tmp/ref.nii"
+    if crop_margin is not None:
+        ref_nii = f"{cur_dir}/tmp/ref_crop.nii"
+    values = costs.registered_costs(report_costs, ref_nii, reg_file=ref_nii)
+    original_omats[ref_row] = xp.concatenate([xp.zeros(7), xp.array(values)])
+    return original_omats
+
+
+def choose_reference(all_nii, data_dir, cur_dir, jobs=1, dtype="float32"):
+    """
+    Picks the reference among the images of data_dir that share the most
+    common voxel grid, see refselect.select_reference
+    """
+    from flirt_reg.reg import quick, refselect
+    from flirt_reg.utils import nii
+
+    paths = [
+        os.path.join(data_dir, nii_name) for nii_name in all_nii[data_dir]
+    ]
+    catalog = nii.catalog_files(
+        paths, max(jobs, 8), index_file=f"{cur_dir}/tmp/{nii.INDEX_NAME}"
+    )
+    # Only volumes on the same grid can be compared voxel by voxel
+    candidates = nii.geometry_groups(catalog)[0]
+    print(f"Choosing the reference from {len(candidates)} volumes")
+    selection = refselect.select_reference(
+        candidates, quick.QUICK_VOXEL, dtype, jobs
+    )
+    print(
+        f"Reference: {selection['image']}, mean correlation "
+        f"{selection['score']:.4f} with the other volumes"
+    )
+    return selection
+
+
+def prepare_run(
+    fname=None,
+    dname=None,
+    max_images=None,
+    extraction=False,
+    jobs=1,
+    tracer=None,
+    bet_mode="each",
+    crop_margin=None,
+    auto_reference=False,
+    dtype="float32",
+):
+    """
+    Finds the inputs, catalogues their headers and prepares the reference.
+    Returns (data_dirs, cur_dir, all_nii, fname, fsl_dir, mismatches,
+    selection). With auto_reference and no fname the reference is chosen
+    by choose_reference, selection is its result (else None).
+    """
+    from flirt_reg.utils import trace
+
+    data_dirs = []
+    if dname:
+        for directory in dname:
+            data_dirs.append(os.path.abspath(directory))
+    else:
+        data_dirs.append(os.getcwd())
+
+    given = fname
+    with trace.span(tracer, "discovery"):
+        cur_dir, all_nii, n_nii, fname = find_inputs(
+            fname, data_dirs, max_images
+        )
+
+    if n_nii == 0:
+        print("No NIFTI files found, exiting...")
+        exit()
+
+    fsl_dir = fsl_exec.find_fsl_dir()
+
+    logging.debug(f"FSL Base Dir: {fsl_dir}")
+
+    if not os.path.exists(f"{cur_dir}/tmp"):
+        os.mkdir(f"{cur_dir}/tmp")
+    selection = None
+    if auto_reference and not given:
+        with trace.span(tracer, "select_reference") as sp:
+            selection = choose_reference(
+                all_nii, data_dirs[0], cur_dir, jobs, dtype
+            )
+            sp.read(*selection["candidates"])
+        fname = selection["image"]
+    with trace.span(tracer, "catalog"):
+        _, mismatches = catalog_inputs(fname, all_nii, cur_dir, max(jobs, 8))
+    prepare_reference(
+        fname, cur_dir, fsl_dir, extraction, tracer, bet_mode, crop_margin
+    )
+    return data_dirs, cur_dir, all_nii, fname, fsl_dir, mismatches, selection
+
+
+def output_files(data_dir, oname=None):
+    """
+    (output directory, out.csv path, original_out.csv path)
+    """
+    if oname:
+        # Save to specified filename
+        logging.debug(f"Saving to {oname}")
+        out_dir = data_dir
+        out_csv = os.path.join(data_dir, oname)
+        original_csv = os.path.join(data_dir, f"original_{oname}")
+    else:
+        # Save to out.nii
+        logging.debug("Saving to out.csv")
+        out_dir = os.path.join(data_dir, "results")
+        if not os.path.exists(f"{data_dir}/results"):
+            os.mkdir(f"{data_dir}/results")
+        out_csv = os.path.join(out_dir, "out.csv")
+        original_csv = os.path.join(out_dir, "original_out.csv")
+    return out_dir, out_csv, original_csv
+
+
+def stream_results(produce, ordered=False, depth=RESULT_DEPTH):
+    """
+    Runs produce(put, stop) in a background thread and yields each
+    (position, ...) item it puts as it arrives or, with ordered, in
+    position order. Errors in produce are raised here. put blocks while
+    depth items wait for the consumer. If the consumer stops early stop,
+    a threading.Event, is set, produce should then start no more images,
+    and the images in flight are finished before this returns.
+    """
+    import queue
+    import threading
+
+    results = queue.Queue(max(depth, 1))
+    stop = threading.Event()
+    done = object()
+    errors = []
+
+    def put(item):
+        # Nobody takes items once the consumer has stopped
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run():
+        try:
+            produce(put, stop)
+        except BaseException as err:
+            errors.append(err)
+        finally:
+            put(done)
+
+    thread = threading.Thread(target=run, name="registrations", daemon=True)
+    thread.start()
+    # Items that arrived before an earlier position, when ordered
+    waiting = {}
+    next_pos = 0
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            if not ordered:
+                yield item
+                continue
+            waiting[item[0]] = item
+            while next_pos in waiting:
+                yield waiting.pop(next_pos)
+                next_pos += 1
+    finally:
+        stop.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def image_timings(tracer):
+    """
+    {image: {stage: seconds}}, filled in from tracer as spans finish, see
+    utils.history.image_seconds
+    """
+    import functools
+
+    from flirt_reg.utils import history
+
+    timings = {}
+    tracer.add_listener(functools.partial(history.add_seconds, timings))
+    return timings
+
+
+def image_record(item, report_costs=None, timings=None, ref_row=0):
+    """
+    The iter_registrations record of a (position, image, result) item,
+    ref_row is the reference's row, see reference_row
+    """
+    pos, (data_directory, nii_name, i), result = item
+    original_omat, out_name, failure = result
+    image = f"{data_directory}/{nii_name}"
+    record = {
+        "row": pos + (pos >= ref_row),
+        "image": image,
+        "params": None,
+        "cost": None,
+        "costs": {},
+        "matrix": None,
+        "out_name": out_name,
+        "failure": failure,
+        "timings": (timings or {}).pop(image, {}),
+        "omat": original_omat,
+        "approximate": False,
+    }
+    if original_omat is not None:
+        record["params"] = [float(val) for val in original_omat[:6]]
+        record["cost"] = float(original_omat[6])
+        record["costs"] = {
+            name: float(val)
+            for name, val in zip(report_costs or [], original_omat[7:])
+        }
+        record["matrix"] = omat.read_omat(f"{data_directory}/tmp/tmp{i}.txt")
+    return record
+
+
+def quick_stream(
+    all_nii,
+    cur_dir,
+    voxel,
+    dtype="float32",
+    tracer=None,
+    metrics=None,
+    reference=None,
+):
+    """
+    Yields an image_record per image, in input order, from a quick fit to
+    cur_dir/tmp/ref.nii (see quick.QuickReference) warm started from the
+    previous image's. The fitted matrix is written to tmp/tmp{i}.txt as
+    for a full registration and the records are flagged approximate.
+    """
+    from nibabel.filebasedimages import ImageFileError
+
+    from flirt_reg.reg import quick
+    from flirt_reg.utils import gpu, trace
+    from flirt_reg.utils.metrics import Metrics
+
+    if tracer is None:
+        tracer = trace.Tracer()
+    timings = image_timings(tracer)
+    if metrics is None:
+        metrics = Metrics()
+    ref_row = reference_row(all_nii, cur_dir, reference)
+    images = []
+    for data_directory in all_nii:
+        os.makedirs(f"{data_directory}/tmp", exist_ok=True)
+        images += list_images(all_nii, cur_dir, data_directory, reference)
+    metrics.set_total(len(images))
+    xp = gpu.array_module()
+    with trace.span(tracer, "quick_reference", f"{cur_dir}/tmp/ref.nii"):
+        quick_ref = quick.QuickReference(
+            f"{cur_dir}/tmp/ref.nii", voxel, dtype
+        )
+    params = None
+    for pos, image in enumerate(images):
+        data_directory, nii_name, i = image
+        in_nii = f"{data_directory}/{nii_name}"
+        try:
+            with trace.span(tracer, "quick", in_nii) as sp:
+                mat, params, cost = quick_ref.fit(in_nii, params)
+                sp.read(in_nii)
+                sp.wrote(
+                    omat.write_omat(mat, f"{data_directory}/tmp/tmp{i}.txt")
+                )
+            result = (xp.array(quick.omat_row(mat, cost)), None, None)
+        except (ImageFileError, OSError, ValueError) as err:
+            logging.debug(f"Quick fit of {in_nii} failed: {err}")
+            failure = {"image": in_nii, "attempts": 1, "error": str(err)}
+            result = (None, None, failure)
+        metrics.image_done(failed=result[2] is not None)
+        record = image_record((pos, image, result), None, timings, ref_row)
+        record["approximate"] = result[2] is None
+        yield record
+
+
+def registration_stream(
+    all_nii,
+    cur_dir,
+    fsl_dir,
+    ordered=False,
+    queue_dir=None,
+    local_workers=0,
+    lease_time=60,
+    verbose=False,
+    jobs=1,
+    cost_func="leastsq",
+    retries=0,
+    retry_costs=None,
+    retry_search=180,
+    tracer=None,
+    metrics=None,
+    extraction=False,
+    output_policy="compressed",
+    bet_mode="each",
+    mask_refine=False,
+    crop_margin=None,
+    report_costs=None,
+    dtype="float32",
+    prefetch_depth=PREFETCH_DEPTH,
+    write_depth=WRITE_DEPTH,
+    io_threads=IO_THREADS,
+    anchors=None,
+    anchor_search=ANCHOR_SEARCH,
+    quick_voxel=None,
+    predict=None,
+    reference=None,
+):
+    """
+    Registers every image in a background thread, locally or through the
+    work queue in queue_dir, and yields an image_record for each as soon
+    as it finishes or, with ordered, in input order. The prefetch and
+    writer stages (see iter_flirt_async) only run locally, queue workers
+    take one image at a time. Locally predict orders the images, longest
+    first, see iter_flirt_async. reference is the reference image, which
+    is not registered, see reference_index.
+
+    With quick_voxel set the images are only fitted quickly on a grid of
+    quick_voxel mm, in this thread and in input order, see quick_stream.
+    """
+    import asyncio
+
+    from flirt_reg.utils import trace
+
+    if quick_voxel:
+        yield from quick_stream(
+            all_nii, cur_dir, quick_voxel, dtype, tracer, metrics, reference
+        )
+        return
+    if tracer is None:
+        tracer = trace.Tracer()
+    timings = image_timings(tracer)
+    options = {
+        "extraction": extraction,
+        "tracer": tracer,
+        "metrics": metrics,
+        "output_policy": output_policy,
+        "bet_mode": bet_mode,
+        "mask_refine": mask_refine,
+        "crop_margin": crop_margin,
+        "report_costs": report_costs,
+        "dtype": dtype,
+        "anchors": anchors,
+        "anchor_search": anchor_search,
+        "reference": reference,
+    }
+
+    def produce_queue(put, stop):
+        run_flirt_queue(
+            all_nii,
+            cur_dir,
+            fsl_dir,
+            queue_dir,
+            cost_func=cost_func,
+            local_workers=local_workers,
+            lease_time=lease_time,
+            verbose=verbose,
+            retries=retries,
+            retry_costs=retry_costs,
+            retry_search=retry_search,
+            on_image=put,
+            stop=stop,
+            **options,
+        )
+
+    def produce_local(put, stop):
+        plan = retry_plan(cost_func, retries, retry_costs, retry_search)
+
+        async def run():
+            async for item in iter_flirt_async(
+                all_nii,
+                cur_dir,
+                fsl_dir,
+                plan=plan,
+                jobs=jobs,
+                prefetch_depth=prefetch_depth,
+                write_depth=write_depth,
+                io_threads=io_threads,
+                predict=predict,
+                stop=stop,
+                **options,
+            ):
+                put(item)
+
+        asyncio.run(run())
+
+    produce = produce_queue if queue_dir else produce_local
+    ref_row = reference_row(all_nii, cur_dir, reference)
+    for item in stream_results(produce, ordered):
+        yield image_record(item, report_costs, timings, ref_row)
+
+
+def iter_registrations(
+    fname=None,
+    dname=None,
+    max_images=None,
+    ordered=False,
+    verbose=False,
+    extraction=False,
+    cost_func="leastsq",
+    queue_dir=None,
+    local_workers=0,
+    lease_time=60,
+    jobs=1,
+    retries=0,
+    retry_costs=None,
+    retry_search=180,
+    output_policy="compressed",
+    bet_mode="each",
+    mask_refine=False,
+    crop=False,
+    crop_margin=10,
+    dtype="float32",
+    report_costs=None,
+    prefetch_depth=PREFETCH_DEPTH,
+    write_depth=WRITE_DEPTH,
+    io_threads=IO_THREADS,
+    hierarchical=False,
+    anchor="first",
+    anchor_search=ANCHOR_SEARCH,
+    quick_voxel=None,
+    auto_reference=False,
+    tracer=None,
+    metrics=None,
+):
+    """
+    Registers the inputs as flirt_reg does but yields a record per image
+    as soon as it is registered, in completion order or, with ordered,
+    input order. Only the files in tmp/ are written. Each record is a
+    dict with:
+
+        row: the image's row in out.csv, in input order with the
+            reference's row among them, see reference_row
+        image: the input path
+        params: translations in mm and rotations in radians, or None
+        cost: the FLIRT cost, costs: {cost: value} for report_costs
+        matrix: the 4x4 FLIRT matrix
+        out_name: the registered image, None with params-only
+        failure: None, or a dict describing the last error
+        timings: {stage: seconds}
+        omat: the original_out.csv row
+        approximate: True for a quick fit, see quick_stream
+
+    Registration runs in a background thread, so it carries on while the
+    caller works on a record. With quick_voxel set each image is fitted
+    quickly instead, and auto_reference chooses the reference, see
+    flirt_reg.
+    """
+    from flirt_reg.utils import trace
+
+    reg_policy = check_options(
+        output_policy, False, bet_mode, dtype, report_costs
+    )
+    if quick_voxel:
+        extraction, crop, report_costs = False, False, None
+        hierarchical = False
+    if tracer is None:
+        tracer = trace.Tracer()
+    crop_margin = crop_margin if crop else None
+    _, cur_dir, all_nii, fname, fsl_dir, _, _ = prepare_run(
+        fname,
+        dname,
+        max_images,
+        extraction,
+        jobs,
+        tracer,
+        bet_mode,
+        crop_margin,
+        auto_reference,
+        dtype,
+    )
+    anchors = None
+    if hierarchical:
+        anchors = prepare_anchors(
+            all_nii,
+            cur_dir,
+            fsl_dir,
+            extraction,
+            jobs,
+            tracer,
+            bet_mode,
+            crop_margin,
+            cost_func,
+            anchor,
+            dtype,
+        )
+    yield from registration_stream(
+        all_nii,
+        cur_dir,
+        fsl_dir,
+        ordered=ordered,
+        queue_dir=queue_dir,
+        local_workers=local_workers,
+        lease_time=lease_time,
+        verbose=verbose,
+        jobs=jobs,
+        cost_func=cost_func,
+        retries=retries,
+        retry_costs=retry_costs,
+        retry_search=retry_search,
+        tracer=tracer,
+        metrics=metrics,
+        extraction=extraction,
+        output_policy=reg_policy,
+        bet_mode=bet_mode,
+        mask_refine=mask_refine,
+        crop_margin=crop_margin,
+        report_costs=report_costs,
+        dtype=dtype,
+        prefetch_depth=prefetch_depth,
+        write_depth=write_depth,
+        io_threads=io_threads,
+        anchors=anchors,
+        anchor_search=anchor_search,
+        quick_voxel=quick_voxel,
+        reference=fname,
+    )
+
+
+def write_flags(records, fname):
+    """
+    Writes approximate.csv, whether each row of out.csv is a quick fit
+    """
+    with open(fname, "w", newline="\n") as csvfile:
+        flagwriter = csv.writer(csvfile, delimiter=",")
+        flagwriter.writerow(["row", "image", "approximate"])
+        for record in records:
+            flagwriter.writerow(
+                [record["row"], record["image"], int(record["approximate"])]
+            )
+
+
+def write_results(
+    records,
+    cur_dir,
+    out_csv,
+    original_csv,
+    report_costs=None,
+    crop_margin=None,
+    gif=True,
+    dtype="float32",
+    rads=False,
+    flags_csv=None,
+    ref_row=0,
+):
+    """
+    Consumes input ordered records, writing each row of out.csv and
+    original_out.csv as it arrives, the reference's at ref_row (see
+    reference_row), and reading the GIF slices of each registered image.
+    Returns the collect_results lists, the slices and the registered file
+    of each image (None if there is none). With flags_csv the approximate
+    flags are written there, see write_flags.
+    """
+    import nibabel as nb
+
+    n_costs = len(report_costs or [])
+    collected = ([], [], [], [])
+    slices = []
+    flags = []
+    registered = []
+    with open(out_csv, "w", newline="\n") as out_file, open(
+        original_csv, "w", newline="\n"
+    ) as original_file:
+        out_writer = csv.writer(out_file, delimiter=",")
+        original_writer = csv.writer(original_file, delimiter=",")
+        n_rows = 0
+        for record in itertools.chain([None], records):
+            if record is not None:
+                flags.append(record)
+                registered.append(
+                    None if record["failure"] else record["out_name"]
+                )
+                collect_result(
+                    collected,
+                    (record["omat"], record["out_name"], record["failure"]),
+                    n_costs,
+                )
+            if len(collected[0]) == ref_row:
+                add_reference(collected)
+                reference_costs(
+                    collected[1], report_costs, cur_dir, crop_margin, ref_row
+                )
+            # Any rows this record added, and the reference's after it
+            for reg, original in zip(
+                collected[0][n_rows:], collected[1][n_rows:]
+            ):
+                logging.debug(omat.get_reg_str(reg, rads=rads))
+                out_writer.writerow(omat.reg_row(reg))
+                original_writer.writerow(omat.avs_row(original, 7 + n_costs))
+            n_rows = len(collected[0])
+            # Rows are readable as soon as their image is done
+            out_file.flush()
+            original_file.flush()
+            if gif and record and record["out_name"]:
+                slices.append(
+                    get_gif_slices(nb.load(record["out_name"]), dtype)
+                )
+    if flags_csv:
+        write_flags(flags, flags_csv)
+    return collected + (slices, registered)
+
+
+def start_metrics(
+    tracer, progress_bar=True, metrics_dir=None, metrics_interval=10
+):
+    """
+    Sets up the run metrics, fed by tracer, and their consumers
+    """
+    from flirt_reg.utils import progress
+    from flirt_reg.utils.metrics import Metrics, MetricsExporter
+
+    metrics = Metrics()
+    tracer.add_listener(metrics.observe_span)
+    if progress_bar:
+        metrics.add_listener(progress.metrics_progress())
+    exporter = None
+    if metrics_dir:
+        exporter = MetricsExporter(
+            metrics, metrics_dir, metrics_interval
+        ).start()
+    return metrics, exporter
+
+
+def run_settings(
+    extraction=False,
+    bet_mode="each",
+    mask_refine=False,
+    cost_func="leastsq",
+    crop_margin=None,
+    hierarchical=False,
+    anchor_search=ANCHOR_SEARCH,
+    quick_voxel=None,
+    output_policy="compressed",
+    gif=True,
+    report_costs=None,
+):
+    """
+    The settings a run's timings depend on, runs are only compared with
+    past runs with the same (or similar) settings, see utils.history
+    """
+    return {
+        "extraction": bool(extraction),
+        "bet_mode": bet_mode if extraction else None,
+        "mask_refine": bool(extraction and mask_refine),
+        "cost_func": cost_func,
+        "search": anchor_search if hierarchical else 90,
+        "crop": crop_margin is not None,
+        "quick_voxel": quick_voxel,
+        "output_policy": output_policy,
+        "gif": bool(gif),
+        "report_costs": list(report_costs or []),
+    }
+
+
+def plan_run(
+    fname=None,
+    dname=None,
+    max_images=None,
+    cpus=None,
+    history_file=None,
+    extraction=False,
+    bet_mode="each",
+    mask_refine=False,
+    cost_func="leastsq",
+    crop=False,
+    crop_margin=10,
+    hierarchical=False,
+    anchor_search=ANCHOR_SEARCH,
+    quick_voxel=None,
+    output_policy="compressed",
+    gif=True,
+    report_costs=None,
+):
+    """
+    Prints the predicted wall time and peak memory of registering the
+    inputs with these settings for several --jobs on cpus cores (this
+    machine's by default) and the best --jobs, from the run history. Only
+    the headers are read, nothing is registered. Returns the
+    history.plan dict, None without a matching history.
+    """
+    from flirt_reg.utils import history, nii
+
+    if quick_voxel:
+        extraction, crop, report_costs = False, False, None
+        hierarchical = False
+    data_dirs = [os.path.abspath(directory) for directory in dname or []]
+    cur_dir, all_nii, _, fname = find_inputs(
+        fname, data_dirs or [os.getcwd()], max_images
+    )
+    images = []
+    for data_directory in all_nii:
+        images += [
+            os.path.join(image[0], image[1])
+            for image in list_images(all_nii, cur_dir, data_directory, fname)
+        ]
+    index_file = f"{cur_dir}/tmp/{nii.INDEX_NAME}"
+    catalog = nii.catalog_files(
+        images,
+        8,
+        index_file=index_file if os.path.isdir(f"{cur_dir}/tmp") else None,
+    )
+    sizes = [
+        history.voxels(catalog[os.path.abspath(image)]) for image in images
+    ]
+    settings = run_settings(
+        extraction,
+        bet_mode,
+        mask_refine,
+        cost_func,
+        crop_margin if crop else None,
+        hierarchical,
+        anchor_search,
+        quick_voxel,
+        output_policy,
+        gif,
+        report_costs,
+    )
+    res = history.plan(settings, sizes, cpus, path=history_file)
+    if res is None:
+        print(
+            f"No runs with these settings in "
+            f"{history.history_file(history_file)} yet, run flirt-reg "
+            "once to record one"
+        )
+        return None
+    print(
+        f"{res['images']} images on {res['cpus']} cores, from "
+        f"{res['history_runs']} past runs with {res['match']} settings"
+    )
+    print("  jobs   wall time  peak memory")
+    for row in res["options"]:
+        wall = time.strftime("%Hh%Mm%Ss", time.gmtime(row["wall_s"]))
+        print(f"  {row['jobs']:>4}  {wall:>10}  {row['peak_mb']:>8.0f} MB")
+    print(f"Best --jobs: {res['best_jobs']}")
+    return res
+
+
+def flirt_reg(
+    fname=None,
+    oname=None,
+    verbose=False,
+    max_images=None,
+    dname=None,
+    rads=False,
+    extraction=False,
+    cost_func="leastsq",
+    queue_dir=None,
+    local_workers=0,
+    lease_time=60,
+    jobs=1,
+    retries=0,
+    retry_costs=None,
+    retry_search=180,
+    full_output=False,
+    trace_file=None,
+    progress_bar=True,
+    metrics_dir=None,
+    metrics_interval=10,
+    output_policy="compressed",
+    gif=True,
+    bet_mode="each",
+    mask_refine=False,
+    mask_check=0,
+    crop=False,
+    crop_margin=10,
+    dtype="float32",
+    qc_metrics=False,
+    fd_radius=None,
+    fd_threshold=None,
+    report_costs=None,
+    prefetch_depth=PREFETCH_DEPTH,
+    write_depth=WRITE_DEPTH,
+    io_threads=IO_THREADS,
+    hierarchical=False,
+    anchor="first",
+    anchor_search=ANCHOR_SEARCH,
+    compress_level=None,
+    compress_threads=None,
+    quick_voxel=None,
+    history_file=None,
+    use_history=False,
+    auto_reference=False,
+):
+    """
+    FLIRT registration function, runs up to jobs registrations at once.
+    With queue_dir set the registrations are farmed out to workers sharing
+    that directory instead.
+
+    An image that fails is retried up to retries times, first with each
+    of retry_costs then with cost_func, using a +/-retry_search search.
+    Images that still fail get NaN rows in the outputs and are listed in
+    failures.csv. With full_output=True returns (omats, info) where
+    info["failures"] lists the failed images and info["trace"] holds a
+    Chrome trace event per stage of every image, also saved to trace_file
+    if given.
+
+    Throughput, stage latencies, queue depth and failures are kept in a
+    utils.metrics.Metrics, returned as info["metrics"]. With metrics_dir
+    set they are written there every metrics_interval seconds as a
+    Prometheus textfile and a json status file. The progress bar is drawn
+    from the same metrics unless progress_bar is False.
+
+    output_policy is one of OUTPUT_POLICIES and sets how the registered
+    volumes in tmp/ are written, compressed volumes at compress_level with
+    compress_threads threads per image (see utils.niio). With gif=False
+    no GIF is made, so without qc_metrics params-only writes no volumes
+    at all.
+
+    With extraction and bet_mode="reference" only the reference is brain
+    extracted, see BET_MODES. mask_check > 0 compares the propagated mask
+    with per image BET on that many images, the Dice overlaps are returned
+    as info["mask_parity"] and written to mask_parity.csv.
+
+    With crop=True FLIRT only sees the reference foreground plus
+    crop_margin mm (and the same field of view plus crop_margin in each
+    image). The matrices are converted back, so the outputs are for the
+    full images as before, apart from the registered images in tmp/.
+
+    Voxel data read in this process is loaded as dtype, one of
+    volume.DTYPES.
+
+    With qc_metrics=True framewise displacement (fd_radius mm sphere),
+    DVARS and the global signal of every input are written to qc.csv,
+    volumes with FD above fd_threshold mm or outlying DVARS are flagged.
+    The summary is returned as info["qc"].
+
+    Input headers are catalogued up front (see utils.nii) and images whose
+    geometry differs from the reference are listed in a warning and in
+    info["geometry_mismatches"].
+
+    report_costs lists costs (see costs.COSTS) to evaluate between each
+    registered image and the reference, written after the FLIRT cost as
+    extra columns of original_out.csv in the order given.
+
+    Locally, io_threads threads stage inputs up to prefetch_depth images
+    ahead of the registration workers and io_threads more write their
+    outputs with up to write_depth waiting, see iter_flirt_async.
+
+    With hierarchical=True and several directories, each directory other
+    than the reference's gets an anchor (its first volume, or with
+    anchor="mean" the mean of its volumes) registered to the reference
+    once with the full search. Its images are registered to the anchor
+    with a +/-anchor_search degree search, falling back to the usual
+    attempts, and the matrices are composed, see prepare_anchors.
+
+    With quick_voxel set (in mm) each image is only fitted quickly to the
+    reference on a grid of that size, warm started from the previous
+    image, see quick_stream. Brain extraction, cropping, report_costs,
+    hierarchical anchors and the work queue are not used. approximate.csv
+    flags the quick rows, upgrade() replaces them with full registrations.
+
+    With use_history the image sizes, settings and stage timings of the
+    run are added to the history in history_file (see utils.history), and
+    past runs with the same settings are used to start the longest images
+    first. plan_run predicts a run from the history. flirt-reg turns it on
+    unless --no-history is given.
+
+    With auto_reference and no fname the reference is the medoid of the
+    first directory's volumes by correlation on a coarse grid rather than
+    its first volume, see refselect. The other volumes, the first among
+    them, are registered to it and its row of out.csv is at its place
+    among the inputs as usual.
+    The scores are written to reference.csv and the choice is returned as
+    info["reference"].
+    """
+    from flirt_reg.reg import refselect
+    from flirt_reg.utils import history, nii, niio, trace
+
+    # Setup debugging
+    print("Starting flirt_reg")
+    if verbose:
+        logging.basicConfig(
+            level=logging.DEBUG,
+            format="%(asctime)s - %(levelname)s - %(message)s",
+        )
+        logging.debug(f"Verbosity: {verbose}")
+
+    start_time = time.perf_counter()
+    tracer = trace.Tracer()
+    metrics, exporter = start_metrics(
+        tracer, progress_bar, metrics_dir, metrics_interval
+    )
+    # The history and the metrics exporter are kept up to date even when
+    # the run stops on an error
+    catalog = None
+    failures = []
+    try:
+        reg_policy = check_options(
+            output_policy, gif or qc_metrics, bet_mode, dtype, report_costs
+        )
+        niio.configure(level=compress_level, threads=compress_threads)
+        if quick_voxel:
+            # A quick fit sees the plain reference and images, no anchors
+            extraction, crop, report_costs = False, False, None
+            hierarchical = False
+        crop_margin = crop_margin if crop else None
+        (
+            data_dirs,
+            cur_dir,
+            all_nii,
+            fname,
+            fsl_dir,
+            mismatches,
+            selection,
+        ) = prepare_run(
+            fname,
+            dname,
+            max_images,
+            extraction,
+            jobs,
+            tracer,
+            bet_mode,
+            crop_margin,
+            auto_reference,
+            dtype,
+        )
+        out_dir, out_csv, original_csv = output_files(data_dirs[0], oname)
+        if selection:
+            refselect.write_scores(
+                selection, os.path.join(out_dir, "reference.csv")
+            )
+        anchors = None
+        if hierarchical:
+            anchors = prepare_anchors(
+                all_nii,
+                cur_dir,
+                fsl_dir,
+                extraction,
+                jobs,
+                tracer,
+                bet_mode,
+                crop_margin,
+                cost_func,
+                anchor,
+                dtype,
+            )
+        settings = run_settings(
+            extraction,
+            bet_mode,
+            mask_refine,
+            cost_func,
+            crop_margin,
+            hierarchical,
+            anchor_search,
+            quick_voxel,
+            output_policy,
+            gif,
+            report_costs,
+        )
+        # The reference's own spans are not an image's timings
+        catalog = nii.load_index(f"{cur_dir}/tmp/{nii.INDEX_NAME}")
+        catalog.pop(os.path.abspath(fname), None)
+        predict = None
+        if use_history:
+            estimator = history.Estimator(settings, history_file)
+            if estimator.available:
+                predict = estimator.predictor(catalog)
+
+        records = registration_stream(
+            all_nii,
+            cur_dir,
+            fsl_dir,
+            ordered=True,
+            queue_dir=queue_dir,
+            local_workers=local_workers,
+            lease_time=lease_time,
+            verbose=verbose,
+            jobs=jobs,
+            cost_func=cost_func,
+            retries=retries,
+            retry_costs=retry_costs,
+            retry_search=retry_search,
+            tracer=tracer,
+            metrics=metrics,
+            extraction=extraction,
+            output_policy=reg_policy,
+            bet_mode=bet_mode,
+            mask_refine=mask_refine,
+            crop_margin=crop_margin,
+            report_costs=report_costs,
+            dtype=dtype,
+            prefetch_depth=prefetch_depth,
+            write_depth=write_depth,
+            io_threads=io_threads,
+            anchors=anchors,
+            anchor_search=anchor_search,
+            quick_voxel=quick_voxel,
+            predict=predict,
+            reference=fname,
+        )
+        (
+            omats,
+            original_omats,
+            out_paths,
+            failures,
+            gif_slices,
+            registered,
+        ) = write_results(
+            records,
+            cur_dir,
+            out_csv,
+            original_csv,
+            report_costs,
+            crop_margin,
+            gif,
+            dtype,
+            rads,
+            os.path.join(out_dir, "approximate.csv") if quick_voxel else None,
+            reference_row(all_nii, cur_dir, fname),
+        )
+
+        if failures:
+            write_failures(failures, os.path.join(out_dir, "failures.csv"))
+
+        mask_file = None
+        mask_parity = []
+        if extraction and bet_mode == "reference":
+            mask_file = f"{cur_dir}/tmp/ref_mask.nii"
+            if mask_check:
+                with trace.span(tracer, "mask_check"):
+                    mask_parity = check_mask_parity(
+                        all_nii,
+                        cur_dir,
+                        fsl_dir,
+                        mask_check,
+                        out_dir,
+                        mask_refine,
+                        fname,
+                    )
+
+        qc_summary = (
+            series_qc(
+                omats,
+                fname,
+                all_nii,
+                cur_dir,
+                out_dir,
+                mask_file,
+                fd_radius,
+                fd_threshold,
+                dtype,
+                tracer,
+                registered,
+                crop_margin,
+            )
+            if qc_metrics
+            else None
+        )
+
+        if gif and out_paths:
+            with trace.span(tracer, "gif") as sp:
+                sp.wrote(make_gif(out_paths, data_dirs[0], dtype, gif_slices))
+
+        if trace_file:
+            tracer.save(trace_file)
+    finally:
+        if exporter:
+            exporter.stop()
+        if use_history and catalog is not None:
+            history.record_run(
+                settings,
+                catalog,
+                tracer.events,
+                jobs,
+                time.perf_counter() - start_time,
+                {failure["image"] for failure in failures},
+                history_file,
+            )
+
+    if full_output:
+        return omats, {
+            "failures": failures,
+            "trace": tracer.events,
+            "metrics": metrics.to_status(),
+            "mask_parity": mask_parity,
+            "qc": qc_summary,
+            "geometry_mismatches": mismatches,
+            "anchors": anchors or {},
+            "reference": {
+                "image": os.path.abspath(fname),
+                "score": selection["score"] if selection else None,
+                "auto": selection is not None,
+            },
+        }
+    return omats
+
+
+async def register_images_async(images, cur_dir, fsl_dir, jobs=1, **options):
+    """
+    Registers the (directory, file, index) images with register_with_retries
+    and the given options, at most jobs at once, returns their results in
+    order
+    """
+    import asyncio
+
+    slots = asyncio.Semaphore(max(jobs, 1))
+
+    async def register(image):
+        async with slots:
+            res = await register_with_retries(
+                image[0], image[1], image[2], cur_dir, fsl_dir, **options
+            )
+        remove_staged(
+            image[0],
+            image[2],
+            options.get("extraction", False),
+            options.get("crop_margin"),
+        )
+        return res
+
+    return await asyncio.gather(*[register(image) for image in images])
+
+
+def read_rows(fname):
+    with open(fname, "r", newline="") as csvfile:
+        return list(csv.reader(csvfile, delimiter=","))
+
+
+def write_rows(rows, fname):
+    with open(fname, "w", newline="\n") as csvfile:
+        csv.writer(csvfile, delimiter=",").writerows(rows)
+
+
+def upgrade(
+    rows=None,
+    fname=None,
+    oname=None,
+    verbose=False,
+    max_images=None,
+    dname=None,
+    extraction=False,
+    cost_func="leastsq",
+    jobs=1,
+    retries=0,
+    retry_costs=None,
+    retry_search=180,
+    bet_mode="each",
+    mask_refine=False,
+    crop=False,
+    crop_margin=10,
+    auto_reference=False,
+):
+    """
+    Replaces quick fits (see flirt_reg's quick_voxel) with full
+    registrations. rows lists out.csv rows, by default every row flagged
+    in approximate.csv. The inputs and outputs are found as by flirt_reg
+    with the same arguments (an automatic reference is chosen again the
+    same way). Rows that are not in approximate.csv raise a ValueError,
+    rows that cannot be registered are left as they were and listed in
+    upgrade_failures.csv. Returns the rows that were upgraded and the
+    failures.
+    """
+    import asyncio
+
+    if verbose:
+        logging.basicConfig(
+            level=logging.DEBUG,
+            format="%(asctime)s - %(levelname)s - %(message)s",
+        )
+    crop_margin = crop_margin if crop else None
+    data_dirs, cur_dir, all_nii, fname, fsl_dir, _, _ = prepare_run(
+        fname,
+        dname,
+        max_images,
+        extraction,
+        jobs,
+        None,
+        bet_mode,
+        crop_margin,
+        auto_reference,
+    )
+    out_dir, out_csv, original_csv = output_files(data_dirs[0], oname)
+    flags_csv = os.path.join(out_dir, "approximate.csv")
+    flags = {int(row[0]): row for row in read_rows(flags_csv)[1:]}
+    out_rows = read_rows(out_csv)
+    if rows is None:
+        rows = [row for row, flag in flags.items() if flag[2] == "1"]
+    images = []
+    for data_directory in all_nii:
+        images += list_images(all_nii, cur_dir, data_directory, fname)
+    # The reference row is all zeros and never needs upgrading
+    ref_row = reference_row(all_nii, cur_dir, fname)
+    rows = [row for row in dict.fromkeys(rows) if row != ref_row]
+    unknown = [
+        row for row in rows if row not in flags or not 0 <= row < len(out_rows)
+    ]
+    if unknown:
+        raise ValueError(
+            f"Rows {unknown} are not in {flags_csv}, please use the rows "
+            "listed there"
+        )
+    print(f"Upgrading {len(rows)} quick fits to full registrations")
+    results = asyncio.run(
+        register_images_async(
+            [images[row - (row > ref_row)] for row in rows],
+            cur_dir,
+            fsl_dir,
+            jobs,
+            extraction=extraction,
+            plan=retry_plan(cost_func, retries, retry_costs, retry_search),
+            output_policy="params-only",
+            bet_mode=bet_mode,
+            mask_refine=mask_refine,
+            crop_margin=crop_margin,
+        )
+    )
+    original_rows = read_rows(original_csv)
+    upgraded = []
+    failures = []
+    for row, (original_omat, _, failure) in zip(rows, results):
+        if failure or original_omat is None:
+            print(f"Row {row} could not be registered, left as it was")
+            data_directory, nii_name, _ = images[row - (row > ref_row)]
+            failures.append(
+                failure
+                or {
+                    "image": f"{data_directory}/{nii_name}",
+                    "attempts": 1,
+                    "error": "FLIRT wrote no matrix",
+                }
+            )
+            continue
+        out_rows[row] = omat.reg_row(original_omat)
+        original_rows[row] = omat.avs_row(
+            original_omat, len(original_rows[row])
+        )
+        flags[row][2] = "0"
+        upgraded.append(row)
+    write_rows(out_rows, out_csv)
+    write_rows(original_rows, original_csv)
+    write_rows(
+        [["row", "image", "approximate"]] + list(flags.values()), flags_csv
+    )
+    if failures:
+        write_failures(failures, os.path.join(out_dir, "upgrade_failures.csv"))
+    return upgraded, failures
+
+
+def chain_links(inames, data_dir):
+    """
+    Parses flirt-apply -i patterns into (kind, value) links, in the order
+    they are applied: a pattern with # is one MAT file per image,
+    ("image", input schema) as in get_inputs, anything else a FLIRT
+    matrix shared by every image, ("shared", path)
+    """
+    if isinstance(inames, str):
+        inames = [inames]
+    links = []
+    for iname in inames or [os.path.join(data_dir, "MAT_####.txt")]:
+        if "#" in iname:
+            filen, file_ext = os.path.splitext(iname)
+            # Allow numbers to be replaced with #
+            links.append(("image", [filen.replace("#", ""), file_ext]))
+        else:
+            links.append(("shared", os.path.abspath(iname)))
+    return links
+
+
+def image_matrices(data_directory, chain, all_nii, fsl_dir, i):
+    """
+    Converts the per image links of chain for image i with make_coords,
+    returns their FLIRT matrices in chain order
+    """
+    import numpy as np
+
+    mats = []
+    for link, (kind, inputs) in enumerate(chain):
+        if kind == "image":
+            make_coords(data_directory, inputs, all_nii, fsl_dir, i, link)
+            mats.append(np.loadtxt(trans_name(data_directory, i, link)))
+    return mats
+
+
+def compose_chain(chain, image_mats):
+    """
+    Composes chain into one FLIRT matrix per image, (N, 4, 4), with one
+    batched product per link. image_mats holds the N images' per image
+    matrices (see image_matrices), shared links hold their 4x4 matrix.
+    """
+    import numpy as np
+
+    n_images = len(image_mats)
+    n_links = sum(kind == "image" for kind, _ in chain)
+    stacks = np.asarray(image_mats, dtype=float).reshape(
+        n_images, n_links, 4, 4
+    )
+    composite = np.broadcast_to(np.eye(4), (n_images, 4, 4))
+    link = 0
+    for kind, inputs in chain:
+        if kind == "image":
+            composite = np.matmul(stacks[:, link], composite)
+            link += 1
+        else:
+            composite = np.matmul(inputs, composite)
+    return composite
+
+
+def apply_transform(
+    oname="out_####.nii",
+    dname=None,
+    iname=None,
+    verbose=False,
+    jobs=1,
+    retries=0,
+    progress_bar=True,
+    output_policy="compressed",
+    reference=None,
+    compress_level=None,
+    compress_threads=None,
+):
+    """
+    Applies transforms in FLIRT style mat files, up to jobs at once. The
+    outputs are gzipped unless output_policy is "uncompressed", at
+    compress_level with compress_threads threads per image (see
+    utils.niio).
+    Returns False if any image still failed after its retries.
+
+    iname may list several patterns, a chain of matrices applied in
+    order (see chain_links), e.g. MAT_####.txt then a session to template
+    matrix. Each image's chain is composed into one matrix and the image
+    is resampled once, into reference if given, else the first image of
+    its directory. The reference, if it is one of the images, is skipped
+    (else the first image of the first link's directory is).
+    """
+    import asyncio
+
+    import numpy as np
+
+    from flirt_reg.utils import niio, progress
+    from flirt_reg.utils.metrics import Metrics
+
+    if output_policy not in ["compressed", "uncompressed"]:
+        raise ValueError(f"Unknown output policy {output_policy}")
+    niio.configure(level=compress_level, threads=compress_threads)
+    print("Starting apply_transform")
+    if verbose:
+        logging.basicConfig(
+            level=logging.DEBUG,
+            format="%(asctime)s - %(levelname)s - %(message)s",
+        )
+        logging.debug(f"Verbosity: {verbose}")
+    data_dirs = []
+    if dname:
+        for directory in dname:
+            data_dirs.append(os.path.abspath(directory))
+    else:
+        data_dirs.append(os.getcwd())
+
+    links = chain_links(iname, data_dirs[0])
+    # Check input files exist
+    first_files = [
+        f"{inputs[0]}0000{inputs[1]}" if kind == "image" else inputs
+        for kind, inputs in links
+    ]
+    for first_file in first_files + ([reference] if reference else []):
+        logging.debug(f"Checking file {first_file}")
+        if not os.path.isfile(os.path.abspath(first_file)):
+            logging.debug(f"!!! {first_file} is not a file. !!!\nExiting...")
+            raise FileNotFoundError(
+                errno.ENOENT, os.strerror(errno.ENOENT), first_file
+            )
+    if links[0][0] == "image":
+        cur_dir = os.path.dirname(os.path.abspath(first_files[0]))
+    else:
+        cur_dir = data_dirs[0]
+    all_nii = {}
+    n_nii = 0
+    for data_directory in data_dirs:
+        all_nii[data_directory] = get_nii(data_directory)
+        n_nii += len(all_nii[data_directory])
+    chain = [
+        (
+            (kind, get_inputs(n_nii, inputs))
+            if kind == "image"
+            else (kind, np.loadtxt(inputs))
+        )
+        for kind, inputs in links
+    ]
+
+    if n_nii == 0:
+        print("No NIFTI files found, exiting...")
+        exit()
+
+    fsl_dir = fsl_exec.find_fsl_dir()
+
+    logging.debug(f"FSL Base Dir: {fsl_dir}")
+
+    images = []
+    for data_directory in all_nii:
+        dir_len = len(all_nii[data_directory])
+
+        print(f"Applying FLIRT Transform on {data_directory}")
+        skip = reference_index(all_nii, cur_dir, data_directory, reference)
+
+        if not os.path.exists(f"{data_directory}/tmp"):
+            os.mkdir(f"{data_directory}/tmp")
+        if not os.path.exists(f"{data_directory}/FLIRT_out"):
+            os.mkdir(f"{data_directory}/FLIRT_out")
+        for i in range(dir_len):
+            if i != skip:
+                images.append((data_directory, i))
+
+    metrics = Metrics()
+    if progress_bar:
+        metrics.add_listener(progress.metrics_progress())
+    failures = asyncio.run(
+        apply_images_async(
+            images,
+            None,
+            all_nii,
+            fsl_dir,
+            jobs,
+            retries=retries,
+            metrics=metrics,
+            output_policy=output_policy,
+            chain=chain,
+            reference=reference and os.path.abspath(reference),
+        )
+    )
+    failures = [failure for failure in failures if failure]
+    if failures:
+        write_failures(
+            failures, os.path.join(data_dirs[0], "FLIRT_out", "failures.csv")
+        )
+        return False
+
+    return True
+
+
+async def apply_image_async(
+    data_directory,
+    all_inputs,
+    all_nii,
+    fsl_dir,
+    i,
+    output_policy="compressed",
+    matrix_file=None,
+    reference=None,
+):
+    """
+    Converts one mat file and resamples its image with FLIRT. With
+    matrix_file the image is resampled through that FLIRT matrix instead.
+    The output is in the space of reference, by default the first image
+    of the directory.
+    """
+    import asyncio
+
+    if matrix_file is None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, make_coords, data_directory, all_inputs, all_nii, fsl_dir, i
+        )
+        matrix_file = trans_name(data_directory, i)
+    # apply the transform
+    out_nii = f"{data_directory}/FLIRT_out/out_{i}.nii"
+    return await write_volume_async(
+        fsl_exec.applyxfm_cmd(
+            fsl_dir,
+            f"{data_directory}/{all_nii[data_directory][i]}",
+            reference or f"{data_directory}/{all_nii[data_directory][0]}",
+            matrix_file,
+            out_nii,
+        ),
+        out_nii,
+        output_policy,
+        None,
+        out_nii,
+        0,
+    )
+
+
+async def apply_images_async(
+    images,
+    all_inputs,
+    all_nii,
+    fsl_dir,
+    jobs=1,
+    retries=0,
+    metrics=None,
+    output_policy="compressed",
+    chain=None,
+    reference=None,
+):
+    """
+    Transforms every image, returns a failure dict or None per image.
+
+    chain lists the (kind, inputs) links applied to each image, see
+    chain_links, by default the one MAT file per image in all_inputs. The
+    per image links are converted first, then every image's chain is
+    composed in one batched product and each image resampled once.
+    """
+    import asyncio
+    import subprocess
+
+    from nibabel.filebasedimages import ImageFileError
+
+    from flirt_reg.utils.metrics import Metrics
+
+    sem = asyncio.Semaphore(jobs)
+    if metrics is None:
+        metrics = Metrics()
+    metrics.set_total(len(images))
+    if chain is None:
+        chain = [("image", all_inputs)]
+    loop = asyncio.get_running_loop()
+
+    async def with_retries(step, data_directory, i):
+        failure = None
+        async with sem:
+            for attempt in range(retries + 1):
+                try:
+                    return await step(), None
+                except (
+                    fsl_exec.FSLError,
+                    subprocess.CalledProcessError,
+                    ImageFileError,
+                    IndexError,
+                    ValueError,
+                    OSError,
+                ) as err:
+                    logging.debug(f"Attempt {attempt + 1} failed: {err}")
+                    failure = {
+                        "image": f"{data_directory}/"
+                        f"{all_nii[data_directory][i]}",
+                        "attempts": attempt + 1,
+                        "error": str(err).strip(),
+                    }
+        return None, failure
+
+    async def convert(data_directory, i):
+        return await with_retries(
+            lambda: loop.run_in_executor(
+                None,
+                image_matrices,
+                data_directory,
+                chain,
+                all_nii,
+                fsl_dir,
+                i,
+            ),
+            data_directory,
+            i,
+        )
+
+    converted = await asyncio.gather(*[convert(*image) for image in images])
+    done = [n for n, (_, failure) in enumerate(converted) if failure is None]
+    composed = compose_chain(chain, [converted[n][0] for n in done])
+    matrix_files = {}
+    for n, mat in zip(done, composed):
+        data_directory, i = images[n]
+        matrix_files[n] = omat.write_omat(
+            mat, f"{data_directory}/tmp/chain_tmp{i}.txt"
+        )
+
+    async def apply(n, data_directory, i):
+        failure = converted[n][1]
+        metrics.set_queue_depth(metrics.queue_depth - 1)
+        if failure is None:
+            _, failure = await with_retries(
+                lambda: apply_image_async(
+                    data_directory,
+                    None,
+                    all_nii,
+                    fsl_dir,
+                    i,
+                    output_policy=output_policy,
+                    matrix_file=matrix_files[n],
+                    reference=reference,
+                ),
+                data_directory,
+                i,
+            )
+        metrics.image_done(failed=failure is not None)
+        return failure
+
+    return await asyncio.gather(
+        *[apply(n, *image) for n, image in enumerate(images)]
+    )
+
+
+def apply_transform_cmd():
+    from flirt_reg.utils import niio
+
+    # Initialise simple timer
+    start_time = time.time()
+    """
+    A simple runner for the program with arguments
+    """
+    # execute only if run as a script
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--dirname",
+        nargs="+",
+        help="input directory name(s). Default: searches \
+                same directory for as filename for .nii.",
+    )
+    parser.add_argument(
+        "-o", "--output", help="output filenames. Default: out_####.nii."
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="prints debugging information. Default: false.",
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        nargs="+",
+        help="input mat files, several make a chain applied in order: \
+                patterns with # give one MAT file per image, other files \
+                are FLIRT matrices used for every image. Default: tries \
+                to find MAT_####.txt in local dir.",
+    )
+    parser.add_argument(
+        "-r",
+        "--reference",
+        help="image whose space the chain ends in, e.g. a template, or \
+                the reference chosen by flirt-reg --auto-reference. \
+                Default: the first image of each directory.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of images to transform at once. Default: 1.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--retries",
+        help="times to retry an image that fails. Default: 0.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--no-progress",
+        action="store_true",
+        help="do not draw the progress bar. Default: false.",
+    )
+    parser.add_argument(
+        "--output-policy",
+        choices=["compressed", "uncompressed"],
+        default="compressed",
+        help="gzip the transformed images or keep them as NIFTI. \
+                Default: compressed.",
+    )
+    parser.add_argument(
+        "--compress-level",
+        help="gzip level of the transformed images. Default: 1.",
+        type=int,
+        default=niio.GZIP_LEVEL,
+    )
+    parser.add_argument(
+        "--compress-threads",
+        help="threads compressing or decompressing each image. \
+                Default: the number of CPUs, at most 8.",
+        type=int,
+        default=niio.THREADS,
+    )
+    args = parser.parse_args()
+
+    # call the apply_transform function with cmd line args
+    success = apply_transform(
+        oname=args.output,
+        dname=args.dirname,
+        iname=args.input,
+        verbose=args.verbose,
+        jobs=args.jobs,
+        retries=args.retries,
+        progress_bar=not args.no_progress,
+        output_policy=args.output_policy,
+        reference=args.reference,
+        compress_level=args.compress_level,
+        compress_threads=args.compress_threads,
+    )
+
+    if args.verbose:
+        total_time = time.gmtime((time.time() - start_time))
+        print(f"Pipeline complete in {time.strftime('%Hh%Mm%Ss', total_time)}")
+
+    if not success:
+        sys.exit(1)
+
+
+def get_gif_slices(image, dtype="float32"):
+    """Gets 3 orthogonal slices that show how good the registration is
+
+    Args:
+        image (nb.NiftiImage): the image to get slices from
+        dtype (str): how the slices are loaded, see volume.DTYPES
+
+    Returns:
+        (np.array): the three slices
+    """
+    from flirt_reg.reg import volume
+    from flirt_reg.utils import gpu
+
+    xp = gpu.array_module()
+    shape = image.shape
+    mid_x = int(xp.floor(shape[0] / 2))
+    mid_y = int(xp.floor(shape[1] / 2))
+    mid_z = int(xp.floor(shape[2] / 2))
+    # Only the three slices are read, not the whole volume
+    slices = [
+        xp.flipud(
+            volume.load_data(image, dtype, (mid_x, slice(None), slice(None)))
+        ),
+        volume.load_data(image, dtype, (slice(None), mid_y, slice(None))),
+        xp.rot90(
+            volume.load_data(image, dtype, (slice(None), slice(None), mid_z))
+        ),
+    ]
+    return slices
+
+
+def make_gif(img_paths, out_path, dtype="float32", slices=None):
+    import matplotlib.pyplot as plt
+    import nibabel as nb
+    from matplotlib.animation import FuncAnimation, PillowWriter
+    from pygifsicle import optimize
+
+    from flirt_reg.utils import figstring
+
+    # The slices may already have been read as the images were registered
+    if slices is None:
+        slices = []
+        for path in img_paths:
+            img = nb.load(path)
+            slices.append(get_gif_slices(img, dtype))
 
     start_time = time.time()
     if not os.path.exists(out_path + os.sep + "figures"):
@@ -628,3 +3457,4 @@ def make_gif(img_paths, out_path):
     optimize(gif_path)
     total_time = time.gmtime((time.time() - start_time))
     print(f"Gif generated in in {time.strftime('%Hh%Mm%Ss', total_time)}")
+    return gif_path
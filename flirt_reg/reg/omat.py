@@ -1,6 +1,6 @@
 import math
 import csv
-import gpuoptional.gpuoptional as gpopt
+from flirt_reg.utils import gpu
 
 # Converts the output matrix from FLIRT
 # Based on a MATLAB script by Dr Shaihan Malik
@@ -11,7 +11,7 @@ def read_omat(fname):
     """
     Read an FSL/FLIRT omat file
     """
-    xp = gpopt.array_module("cupy")
+    xp = gpu.array_module()
     in_omat = []
     with open(fname, "r") as file:
         for line in file:
@@ -25,11 +25,21 @@ def read_omat(fname):
     return in_omat
 
 
+def write_omat(mat, fname):
+    """
+    Writes a 4x4 matrix in FSL/FLIRT's omat layout
+    """
+    with open(fname, "w") as file:
+        for row in mat:
+            file.write("  ".join(f"{float(val):.10f}" for val in row) + "  \n")
+    return fname
+
+
 def read_tmp_trans(fname):
     """
     Read an FSL/FLIRT temporary translations file
     """
-    xp = gpopt.array_module("cupy")
+    xp = gpu.array_module()
     in_omat = []
     with open(fname, "r") as file:
         for line in file:
@@ -47,7 +57,7 @@ def read_avs(avs_str, cost_val=0):
     """
     Read FSL/FLIRT avscale output
     """
-    xp = gpopt.array_module("cupy")
+    xp = gpu.array_module()
     in_omat = [0, 0, 0, 0, 0, 0, 0]
     for line in avs_str.split("\n"):
         if "Rotation Angles (x,y,z) [rads]" in line:
@@ -70,7 +80,7 @@ def read_avs_txt(fname, cost_val=0):
     """
     Read FSL/FLIRT avscale output file
     """
-    xp = gpopt.array_module("cupy")
+    xp = gpu.array_module()
     in_omat = [0, 0, 0, 0, 0, 0, 0]
     with open(fname, "r") as file:
         for line in file:
@@ -95,7 +105,7 @@ def convert_omat(omat, rads=False):
     Converts omat into 3 translations in mm and
     3 rotations in degrees
     """
-    xp = gpopt.array_module("cupy")
+    xp = gpu.array_module()
     # omat is a 4x4 matrix
     # the x, y, z translations are the final column
     t = omat[0:3, 3]
@@ -186,29 +196,46 @@ def orig_to_csv(original_omats, fname="out.csv"):
             )
 
 
+def avs_row(reg, width=7):
+    """
+    One original_out.csv row, padded with 0 to width columns
+    """
+    row = [reg[idx] for idx in range(len(reg))]
+    return row + [0] * (width - len(row))
+
+
 def avs_to_csv(original_omats, fname="avs.csv"):
     """
-    Outputs a list of avscale registrations to csv file
+    Outputs a list of avscale registrations to csv file, rows shorter than
+    the longest (e.g. the reference's 6 zeros) are padded with 0
     """
+    width = max([7] + [len(reg) for reg in original_omats])
     with open(fname, "w", newline="\n") as csvfile:
         regwriter = csv.writer(csvfile, delimiter=",")
         for reg in original_omats:
-            if len(reg) > 6:
-                regwriter.writerow(
-                    [
-                        reg[0],
-                        reg[1],
-                        reg[2],
-                        reg[3],
-                        reg[4],
-                        reg[5],
-                        reg[6],
-                    ]
-                )
-            else:
-                regwriter.writerow(
-                    [reg[0], reg[1], reg[2], reg[3], reg[4], reg[5], 0]
-                )
+            regwriter.writerow(avs_row(reg, width))
+
+
+def reg_row(reg, verbose=False):
+    """
+    One out.csv row, with axis labels if verbose
+    """
+    if verbose:
+        return [
+            "x",
+            reg[0],
+            "y",
+            reg[1],
+            "z",
+            reg[2],
+            "Rx",
+            reg[3],
+            "Ry",
+            reg[4],
+            "Rz",
+            reg[5],
+        ]
+    return [reg[0], reg[1], reg[2], reg[3], reg[4], reg[5]]
 
 
 def reg_to_csv(omats, fname="out.csv", verbose=False):
@@ -218,41 +245,14 @@ def reg_to_csv(omats, fname="out.csv", verbose=False):
     with open(fname, "w", newline="\n") as csvfile:
         regwriter = csv.writer(csvfile, delimiter=",")
         for reg in omats:
-            if verbose:
-                regwriter.writerow(
-                    [
-                        "x",
-                        reg[0],
-                        "y",
-                        reg[1],
-                        "z",
-                        reg[2],
-                        "Rx",
-                        reg[3],
-                        "Ry",
-                        reg[4],
-                        "Rz",
-                        reg[5],
-                    ]
-                )
-            else:
-                regwriter.writerow(
-                    [
-                        reg[0],
-                        reg[1],
-                        reg[2],
-                        reg[3],
-                        reg[4],
-                        reg[5],
-                    ]
-                )
+            regwriter.writerow(reg_row(reg, verbose))
 
 
 def csv_to_reg(fname="out.csv"):
     """
     Reads a list of registrations from a csv file
     """
-    xp = gpopt.array_module("cupy")
+    xp = gpu.array_module()
     omats = []
     with open(fname, "r", newline="\n") as csvfile:
         regreader = csv.reader(csvfile, delimiter=",")
@@ -0,0 +1,153 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# A three stage pipeline for a list of items: prefetch, register and write,
+# joined by bounded asyncio queues so a slow stage holds back the one before
+# it instead of letting work pile up. The prefetch and write stages get
+# thread pools of their own so file I/O never waits behind, or holds up,
+# the registration workers' executor jobs.
+
+# The result of an item that was never started because the run was stopped
+SKIPPED = object()
+
+
+class Pipeline:
+    """
+    Runs every item through the stages, see results(). The stages are
+    coroutine functions:
+
+        stage(pos, lane, executor): reads item pos, returns a failure
+            dict or None
+        register(pos, worker, staged, failure): returns the result
+        finish(pos, result, lane, executor): returns the written result
+
+    A depth of 0 skips that stage's queue and threads: register then
+    gets staged=False, and finish runs in the registration worker. Items
+    are started in the order given (a permutation of the positions),
+    position order by default. Once stop (a threading.Event) is set no
+    more items are started, those in flight are finished.
+    """
+
+    def __init__(
+        self,
+        n_items,
+        stage,
+        register,
+        finish,
+        jobs=1,
+        prefetch_depth=2,
+        write_depth=2,
+        io_threads=2,
+        order=None,
+        stop=None,
+    ):
+        self.n_items = n_items
+        self.stop = stop
+        self.stage = stage
+        self.register = register
+        self.finish = finish
+        self.jobs = jobs
+        self.prefetch_depth = prefetch_depth
+        self.write_depth = write_depth
+        self.io_threads = max(io_threads, 1)
+        self.todo = iter(range(n_items) if order is None else order)
+        self.staged = asyncio.Queue(prefetch_depth)
+        self.written = asyncio.Queue(write_depth)
+        self.done = asyncio.Queue()
+        self.prefetch_pool = None
+        self.writer_pool = None
+
+    def stopped(self):
+        return self.stop is not None and self.stop.is_set()
+
+    async def prefetch_stage(self, lane):
+        for pos in self.todo:
+            if self.stopped():
+                await self.done.put((pos, SKIPPED))
+                continue
+            failure = await self.stage(pos, lane, self.prefetch_pool)
+            await self.staged.put((pos, failure))
+
+    async def register_stage(self, worker):
+        while True:
+            if self.prefetch_depth:
+                pos, failure = await self.staged.get()
+            else:
+                pos = next(self.todo, None)
+                failure = None
+                if pos is None:
+                    return
+                if self.stopped():
+                    await self.done.put((pos, SKIPPED))
+                    continue
+            res = await self.register(
+                pos, worker, bool(self.prefetch_depth), failure
+            )
+            if self.write_depth:
+                await self.written.put((pos, res))
+            else:
+                await self.done.put((pos, await self.finish(pos, res, worker)))
+
+    async def write_stage(self, lane):
+        while True:
+            pos, res = await self.written.get()
+            res = await self.finish(pos, res, lane, self.writer_pool)
+            await self.done.put((pos, res))
+
+    async def guard(self, stage):
+        # An unexpected error ends the run rather than stalling it
+        try:
+            await stage
+        except Exception as err:
+            self.done.put_nowait((None, err))
+
+    def start(self):
+        """
+        Starts the stage tasks, prefetch then writer lanes numbered after
+        the registration workers' so each has its own row in a trace
+        """
+        tasks = [
+            asyncio.ensure_future(self.guard(self.register_stage(worker)))
+            for worker in range(self.jobs)
+        ]
+        lanes = range(self.jobs, self.jobs + self.io_threads)
+        if self.prefetch_depth:
+            self.prefetch_pool = ThreadPoolExecutor(
+                self.io_threads, thread_name_prefix="prefetch"
+            )
+            tasks += [
+                asyncio.ensure_future(self.guard(self.prefetch_stage(lane)))
+                for lane in lanes
+            ]
+        if self.write_depth:
+            self.writer_pool = ThreadPoolExecutor(
+                self.io_threads, thread_name_prefix="writer"
+            )
+            tasks += [
+                asyncio.ensure_future(
+                    self.guard(self.write_stage(lane + self.io_threads))
+                )
+                for lane in lanes
+            ]
+        return tasks
+
+    async def results(self):
+        """
+        Yields (position, result) for every item as it leaves the last
+        stage, skipped items aside, then stops the stages
+        """
+        tasks = self.start()
+        try:
+            for _ in range(self.n_items):
+                pos, res = await self.done.get()
+                if pos is None:
+                    raise res
+                if res is not SKIPPED:
+                    yield pos, res
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for pool in [self.prefetch_pool, self.writer_pool]:
+                if pool:
+                    pool.shutdown()
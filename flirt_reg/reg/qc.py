@@ -0,0 +1,157 @@
+import csv
+
+from flirt_reg.reg import volume
+
+# Per volume quality control after registration. Framewise displacement is
+# computed from the motion parameters in one vectorised pass, DVARS and the
+# global signal by streaming the series one volume at a time, so at most
+# two volumes are in memory however long the series is.
+
+# Power et al. (2012): rotations become arc lengths on a 50 mm sphere
+FD_RADIUS = 50.0
+FD_THRESHOLD = 0.5
+
+
+def framewise_displacement(params, radius=FD_RADIUS):
+    """
+    FD of each volume from (N, 6) translations in mm and rotations in
+    radians, the first volume is 0. Failed (NaN) rows give NaN.
+    """
+    import numpy as np
+
+    params = np.asarray(params, dtype=float)[:, :6]
+    deltas = np.abs(np.diff(params, axis=0))
+    fd = deltas[:, :3].sum(axis=1) + radius * deltas[:, 3:].sum(axis=1)
+    return np.concatenate([[0.0], fd])
+
+
+def qc_mask(ref_file, mask_file=None, threshold=0.1):
+    """
+    Voxels DVARS and the global signal are computed over, the brain mask
+    if there is one else the reference above threshold times its maximum
+    """
+    import nibabel as nb
+
+    if mask_file:
+        return volume.load_data(nb.load(mask_file), "native") > 0
+    data = volume.load_data(nb.load(ref_file), "native")
+    return data > threshold * data.max()
+
+
+def stream_dvars(images, mask, dtype="float32"):
+    """
+    Yields (DVARS, global signal) per image, DVARS being the RMS change
+    within mask from the previous image (0 for the first). An image that
+    is None (failed) or not on the grid of mask gives NaN for both, and
+    the image after it NaN DVARS. Only the current and previous masked
+    volumes are held in memory, uncompressed files are memory mapped.
+    """
+    import nibabel as nb
+    import numpy as np
+
+    work_dtype = np.float64 if dtype == "float64" else np.float32
+    previous = None
+    for idx, image in enumerate(images):
+        current = None
+        img = nb.load(image, mmap=True) if image else None
+        if img is not None and img.shape == mask.shape:
+            data = volume.load_data(img, dtype)
+            current = np.asarray(data[mask], dtype=work_dtype)
+            del data
+        if current is None:
+            dvars = signal = np.nan
+        else:
+            signal = float(current.mean()) if current.size else 0.0
+            if idx == 0:
+                dvars = 0.0
+            elif previous is None:
+                dvars = np.nan
+            else:
+                dvars = float(np.sqrt(np.mean((current - previous) ** 2)))
+        yield dvars, signal
+        previous = current
+
+
+def iqr_outliers(values):
+    """
+    Boxplot outliers, above the upper quartile plus 1.5 times the IQR
+    """
+    import numpy as np
+
+    values = np.asarray(values, dtype=float)
+    finite = values[np.isfinite(values)]
+    if finite.size == 0:
+        return np.zeros(values.shape, dtype=bool)
+    q1, q3 = np.percentile(finite, [25, 75])
+    return values > q3 + 1.5 * (q3 - q1)
+
+
+def run_qc(
+    params,
+    images,
+    ref_file,
+    out_csv,
+    mask_file=None,
+    radius=FD_RADIUS,
+    fd_threshold=FD_THRESHOLD,
+    dtype="float32",
+    volumes=None,
+):
+    """
+    Writes qc.csv style rows for a registered series: FD, DVARS, global
+    signal and outlier flags per volume. params has one row per image,
+    volumes the registered file of each (None if it failed) that DVARS
+    and the global signal are computed on, images by default. Returns a
+    summary dict.
+    """
+    import numpy as np
+
+    fd = framewise_displacement(params, radius)
+    mask = qc_mask(ref_file, mask_file)
+    dvars = np.empty(len(images))
+    global_signal = np.empty(len(images))
+    for idx, (dvar, gs) in enumerate(
+        stream_dvars(volumes or images, mask, dtype)
+    ):
+        dvars[idx] = dvar
+        global_signal[idx] = gs
+    fd_outliers = fd > fd_threshold
+    dvars_outliers = iqr_outliers(dvars[1:])
+    dvars_outliers = np.concatenate([[False], dvars_outliers])
+    outliers = fd_outliers | dvars_outliers
+
+    with open(out_csv, "w", newline="\n") as csvfile:
+        qcwriter = csv.writer(csvfile, delimiter=",")
+        qcwriter.writerow(
+            [
+                "volume",
+                "image",
+                "fd",
+                "dvars",
+                "global_signal",
+                "fd_outlier",
+                "dvars_outlier",
+                "outlier",
+            ]
+        )
+        for idx, image in enumerate(images):
+            qcwriter.writerow(
+                [
+                    idx,
+                    image,
+                    fd[idx],
+                    dvars[idx],
+                    global_signal[idx],
+                    int(fd_outliers[idx]),
+                    int(dvars_outliers[idx]),
+                    int(outliers[idx]),
+                ]
+            )
+    return {
+        "fd_mean": float(np.nanmean(fd)),
+        "fd_max": float(np.nanmax(fd)),
+        "dvars_mean": (
+            float(np.nanmean(dvars[1:])) if len(images) > 1 else 0.0
+        ),
+        "outliers": [int(idx) for idx in np.nonzero(outliers)[0]],
+    }
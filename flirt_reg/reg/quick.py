@@ -0,0 +1,180 @@
+from flirt_reg.reg import volume
+
+# Quick look motion estimates for live QC. The reference and each volume
+# are smoothed and resampled onto a coarse grid of QUICK_VOXEL mm voxels and
+# a rigid transform is fitted in process by least squares, starting from
+# the previous volume's. The result is a FLIRT style matrix (in to
+# reference, in FLIRT's scaled voxel coordinates of the full images) and
+# the six usual parameters, approximate as the fit only sees the coarse
+# grid. numpy, scipy and nibabel are imported inside the functions.
+
+QUICK_VOXEL = 6.0
+# Rotations are fitted as arcs on a sphere of this radius in mm, so a step
+# in any of the six parameters moves voxels by a similar distance
+RADIUS = 50.0
+
+
+def euler_to_rot(angles):
+    """
+    Rotation matrix for FSL's (x, y, z) Euler angles, the inverse of
+    rot_to_euler
+    """
+    import numpy as np
+
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    rot_x = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rot_y = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot_z = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return (rot_z @ rot_y @ rot_x).T
+
+
+def rot_to_euler(rot):
+    """
+    FSL's rotmat2euler, the angles avscale reports
+    """
+    import numpy as np
+
+    return np.array(
+        [
+            np.arctan2(rot[1, 2], rot[2, 2]),
+            -np.arcsin(np.clip(rot[0, 2], -1, 1)),
+            np.arctan2(rot[0, 1], rot[0, 0]),
+        ]
+    )
+
+
+def rigid_matrix(params, centre):
+    """
+    4x4 matrix rotating by the angles params[3:6] about centre, then
+    translating by params[0:3]
+    """
+    import numpy as np
+
+    rot = euler_to_rot(params[3:6])
+    mat = np.eye(4)
+    mat[:3, :3] = rot
+    mat[:3, 3] = centre - rot @ centre + params[0:3]
+    return mat
+
+
+def smoothed(img, voxel=QUICK_VOXEL, dtype="float32"):
+    """
+    (data, step) of img smoothed to a resolution of about voxel mm and
+    scaled to a mean of 1 over its foreground, step is the voxel mm grid
+    spacing in voxels of img. Only the first volume of a 4D image is used.
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    index = None
+    if len(img.shape) > 3:
+        index = (slice(None), slice(None), slice(None), 0)
+    data = volume.load_data(
+        img, "float64" if dtype == "float64" else "float32", index
+    )
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    step = np.maximum(voxel / zooms, 1.0)
+    # Smoothing first so the coarse samples are not aliased
+    data = ndimage.gaussian_filter(data, sigma=(step - 1) / 2)
+    foreground = data > 0.1 * data.max()
+    if foreground.any():
+        data = data / data[foreground].mean()
+    return data, step
+
+
+def coarse(img, voxel=QUICK_VOXEL, dtype="float32"):
+    """
+    (data, step) of img smoothed and sampled every step voxels, a grid of
+    about voxel mm, see smoothed
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    data, step = smoothed(img, voxel, dtype)
+    shape = np.maximum(np.ceil(np.array(data.shape) / step), 1)
+    data = ndimage.affine_transform(
+        data, step, output_shape=tuple(shape.astype(int)), order=1
+    )
+    return data, step
+
+
+class QuickReference:
+    """
+    The reference sampled on a coarse grid, see fit
+    """
+
+    def __init__(self, ref_file, voxel=QUICK_VOXEL, dtype="float32"):
+        import nibabel as nb
+        import numpy as np
+
+        img = nb.load(ref_file)
+        self.voxel = voxel
+        self.dtype = dtype
+        self.data, step = coarse(img, voxel, dtype)
+        # Coarse reference voxels to FLIRT coordinates
+        self.grid = volume.fsl_coords(img) @ np.diag(list(step) + [1.0])
+        middle = [(n - 1) / 2 for n in img.shape[:3]] + [1.0]
+        self.centre = (volume.fsl_coords(img) @ np.array(middle))[:3]
+
+    def residuals(self, data, in_coords, params):
+        """
+        The smoothed data (in_coords its voxel to FLIRT coordinates) moved
+        by params minus the reference, at the coarse reference voxels only
+        """
+        import numpy as np
+        from scipy import ndimage
+
+        vox = (
+            np.linalg.inv(in_coords)
+            @ np.linalg.inv(rigid_matrix(params, self.centre))
+            @ self.grid
+        )
+        moved = ndimage.affine_transform(
+            data,
+            vox[:3, :3],
+            offset=vox[:3, 3],
+            output_shape=self.data.shape,
+            order=1,
+        )
+        return (moved - self.data).ravel()
+
+    def fit(self, in_file, start=None):
+        """
+        Fits in_file to the reference by least squares, starting from the
+        params of an earlier fit (e.g. the previous volume's) or the
+        identity. Returns (FLIRT matrix, params, mean squared difference).
+        """
+        import nibabel as nb
+        import numpy as np
+        from scipy import optimize
+
+        img = nb.load(in_file)
+        data, _ = smoothed(img, self.voxel, self.dtype)
+        in_coords = volume.fsl_coords(img)
+        units = np.array([1.0, 1.0, 1.0, RADIUS, RADIUS, RADIUS])
+        if start is None:
+            start = np.zeros(6)
+        # Levenberg-Marquardt converges in a few steps from a warm start
+        res = optimize.least_squares(
+            lambda val: self.residuals(data, in_coords, val / units),
+            np.asarray(start, dtype=float) * units,
+            method="lm",
+            diff_step=1e-3,
+            xtol=1e-4,
+        )
+        params = res.x / units
+        cost = float(np.mean(res.fun**2))
+        return rigid_matrix(params, self.centre), params, cost
+
+
+def omat_row(mat, cost):
+    """
+    The original_out.csv row of a fit: the translations of mat, its
+    rotation angles and the cost
+    """
+    import numpy as np
+
+    row = np.concatenate([mat[:3, 3], rot_to_euler(mat[:3, :3]), [cost]])
+    # As many decimals as avscale prints
+    return np.round(row, 6)
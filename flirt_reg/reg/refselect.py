@@ -0,0 +1,95 @@
+import csv
+from concurrent.futures import ThreadPoolExecutor
+
+from flirt_reg.reg import quick
+
+# Automatic reference selection. Every candidate volume is smoothed and
+# sampled once on a coarse grid (see quick.coarse), the correlation of
+# every pair is computed as a matrix product BLOCK rows at a time, so only
+# BLOCK x candidates correlations are held at once, and the medoid, the
+# volume with the highest mean correlation with all the others, becomes
+# the reference. A motion corrupted volume correlates poorly with the rest
+# so it is never chosen. numpy and nibabel are imported inside the
+# functions.
+
+BLOCK = 256
+# Coarse voxels whose mean over the candidates is below this fraction of
+# the foreground mean are background and left out of the correlations
+FOREGROUND = 0.1
+
+
+def coarse_rows(paths, voxel=quick.QUICK_VOXEL, dtype="float32", jobs=1):
+    """
+    (candidates x voxels) float32 matrix of the coarse foreground of each
+    path, each row scaled to zero mean and unit norm so the product of two
+    rows is their correlation
+    """
+    import nibabel as nb
+    import numpy as np
+
+    def load(path):
+        data, _ = quick.coarse(nb.load(path), voxel, dtype)
+        return data.astype(np.float32).ravel()
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        rows = np.stack(list(pool.map(load, paths)))
+    # smoothed scales each foreground to a mean of 1
+    rows = rows[:, rows.mean(axis=0) > FOREGROUND]
+    rows -= rows.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    rows /= np.where(norms > 0, norms, 1)
+    return rows
+
+
+def mean_correlations(rows, block=BLOCK):
+    """
+    Mean correlation of each row with every other row, the all pairs
+    matrix is built block rows at a time
+    """
+    import numpy as np
+
+    n_rows = rows.shape[0]
+    if n_rows < 2:
+        return np.ones(n_rows)
+    sums = np.empty(n_rows)
+    for start in range(0, n_rows, block):
+        chunk = rows[start : start + block]
+        # Less the correlation of each row with itself
+        sums[start : start + block] = (chunk @ rows.T).sum(axis=1) - (
+            np.einsum("ij,ij->i", chunk, chunk)
+        )
+    return sums / (n_rows - 1)
+
+
+def select_reference(
+    paths, voxel=quick.QUICK_VOXEL, dtype="float32", jobs=1, block=BLOCK
+):
+    """
+    The medoid of paths by coarse correlation. Returns a dict with the
+    chosen image, its score (mean correlation with the others) and the
+    score of every candidate in candidates, in the order of paths.
+    """
+    import numpy as np
+
+    scores = mean_correlations(coarse_rows(paths, voxel, dtype, jobs), block)
+    best = int(np.argmax(scores))
+    return {
+        "image": paths[best],
+        "score": float(scores[best]),
+        "candidates": {
+            path: float(score) for path, score in zip(paths, scores)
+        },
+    }
+
+
+def write_scores(selection, fname):
+    """
+    Writes reference.csv, each candidate's score and which was chosen
+    """
+    with open(fname, "w", newline="\n") as csvfile:
+        scorewriter = csv.writer(csvfile, delimiter=",")
+        scorewriter.writerow(["image", "mean_correlation", "reference"])
+        for path, score in selection["candidates"].items():
+            scorewriter.writerow(
+                [path, f"{score:.6f}", int(path == selection["image"])]
+            )
@@ -0,0 +1,340 @@
+import functools
+import os
+
+from flirt_reg.reg import omat
+from flirt_reg.utils import niio
+
+# Voxel level helpers that work on the images directly rather than through
+# an FSL tool. numpy, scipy and nibabel are imported inside the functions
+# so importing this module stays cheap.
+
+# How voxel data is loaded. float32: scaled float32, half the memory of
+# nibabel's float64 get_fdata. native: the stored integers when there is no
+# scaling to apply (lossless), else float32. float64: as get_fdata.
+DTYPES = ["float32", "native", "float64"]
+
+
+def is_scaled(img):
+    """
+    True if the stored values need a slope or intercept applied
+    """
+    slope = getattr(img.dataobj, "slope", 1.0)
+    inter = getattr(img.dataobj, "inter", 0.0)
+    return slope != 1.0 or inter != 0.0
+
+
+def load_data(img, dtype="float32", index=None):
+    """
+    Voxel data of img (or img.dataobj[index], read without loading the
+    rest of the volume, see niio.read_slab) under the dtype policy, see
+    DTYPES
+    """
+    import numpy as np
+
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype {dtype}")
+    if index is None:
+        if dtype == "native" and not is_scaled(img):
+            return np.asanyarray(img.dataobj)
+        if dtype == "float64":
+            return img.get_fdata()
+        return img.get_fdata(dtype=np.float32)
+    data = niio.read_slab(img, index)
+    if dtype == "native" and not is_scaled(img):
+        return data
+    if dtype == "float64":
+        return data.astype(np.float64, copy=False)
+    return data.astype(np.float32, copy=False)
+
+
+@functools.lru_cache(maxsize=4)
+def _cached_volume(path, mtime_ns, dtype):
+    import nibabel as nb
+
+    img = nb.load(path)
+    data = load_data(img, dtype)
+    data.setflags(write=False)
+    return img, data
+
+
+def load_reference(path, dtype="float32"):
+    """
+    (image, read only data) of a file that every image is compared with,
+    e.g. the reference or its mask. Loaded once per process and reloaded
+    only if the file changes.
+    """
+    path = os.path.abspath(path)
+    return _cached_volume(path, os.stat(path).st_mtime_ns, dtype)
+
+
+def fsl_coords(img):
+    """
+    Voxel to FLIRT's scaled voxel coordinates for img. FLIRT flips x when
+    the voxel to world matrix has a positive determinant.
+    """
+    import numpy as np
+
+    zooms = [float(zoom) for zoom in img.header.get_zooms()[:3]]
+    mat = np.diag(zooms + [1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        mat[0, 0] = -zooms[0]
+        mat[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return mat
+
+
+def vox_to_ref(in_img, ref_img, flirt_mat=None):
+    """
+    4x4 matrix taking voxel indices of in_img to voxel indices of ref_img,
+    through a FLIRT matrix (in to ref) if given, else the header affines
+    """
+    import numpy as np
+
+    if flirt_mat is None:
+        return np.linalg.inv(ref_img.affine) @ in_img.affine
+    return (
+        np.linalg.inv(fsl_coords(ref_img))
+        @ np.asarray(flirt_mat, dtype=float)
+        @ fsl_coords(in_img)
+    )
+
+
+def propagate_mask(mask_img, in_img, flirt_mat=None, mask_data=None):
+    """
+    Nearest neighbour resamples a reference mask onto the grid of in_img,
+    returns a boolean array. mask_data is the already loaded mask.
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    if mask_data is None:
+        mask_data = load_data(mask_img, "native")
+    vox = vox_to_ref(in_img, mask_img, flirt_mat)
+    mask = ndimage.affine_transform(
+        np.asarray(mask_data, dtype=np.uint8),
+        vox[:3, :3],
+        offset=vox[:3, 3],
+        output_shape=in_img.shape[:3],
+        order=0,
+    )
+    return mask > 0
+
+
+def resample_to_ref(in_file, ref_img, mat_file, dtype="float32"):
+    """
+    Trilinearly resamples in_file onto the grid of ref_img through the
+    FLIRT matrix in mat_file, what FLIRT's -out would have written
+    """
+    import nibabel as nb
+    import numpy as np
+    from scipy import ndimage
+
+    img = nb.load(in_file)
+    data = load_data(img, "float64" if dtype == "float64" else "float32")
+    if data.ndim > 3:
+        data = data[..., 0]
+    # Reference voxels to input voxels
+    vox = np.linalg.inv(vox_to_ref(img, ref_img, np.loadtxt(mat_file)))
+    return ndimage.affine_transform(
+        data,
+        vox[:3, :3],
+        offset=vox[:3, 3],
+        output_shape=ref_img.shape[:3],
+        order=1,
+    )
+
+
+def mean_volume(paths, out_file, dtype="float32"):
+    """
+    Writes the voxelwise mean of the images in paths to out_file, reading
+    one image at a time. The header is the first image's.
+    """
+    import nibabel as nb
+    import numpy as np
+
+    total = None
+    for path in paths:
+        img = nb.load(path)
+        data = load_data(img, "float64" if dtype == "float64" else "float32")
+        if total is None:
+            first = img
+            total = np.zeros(data.shape, dtype=data.dtype)
+        total += data
+    mean = total / len(paths)
+    header = first.header.copy()
+    header.set_data_dtype(mean.dtype)
+    nb.save(nb.Nifti1Image(mean, first.affine, header), out_file)
+    return out_file
+
+
+def mask_for(in_file, mask_file, mat_file=None):
+    """
+    Loads in_file and the reference mask propagated onto it, through the
+    FLIRT matrix in mat_file if given
+    """
+    import nibabel as nb
+    import numpy as np
+
+    flirt_mat = None
+    if mat_file:
+        flirt_mat = np.loadtxt(mat_file)
+    img = nb.load(in_file)
+    mask_img, mask_data = load_reference(mask_file, "native")
+    return img, propagate_mask(mask_img, img, flirt_mat, mask_data)
+
+
+def apply_mask(in_file, mask_file, out_file, mat_file=None):
+    """
+    Writes in_file with everything outside the propagated reference mask
+    set to zero, the stand-in for running BET on in_file
+    """
+    import nibabel as nb
+
+    img, mask = mask_for(in_file, mask_file, mat_file)
+    # Zeroing voxels is lossless on the stored integers
+    data = load_data(img, "native")
+    if data.ndim > 3:
+        mask = mask.reshape(mask.shape + (1,) * (data.ndim - 3))
+    nb.save(nb.Nifti1Image(data * mask, img.affine, img.header), out_file)
+    return out_file
+
+
+def dice(mask_a, mask_b):
+    """
+    Dice overlap of two boolean masks, 1 when both are empty
+    """
+    import numpy as np
+
+    total = np.count_nonzero(mask_a) + np.count_nonzero(mask_b)
+    if total == 0:
+        return 1.0
+    return 2.0 * np.count_nonzero(mask_a & mask_b) / total
+
+
+def mask_dice(in_file, mask_file, bet_mask_file, mat_file=None):
+    """
+    Dice overlap of the reference mask propagated onto in_file and a BET
+    mask of in_file itself
+    """
+    import nibabel as nb
+    import numpy as np
+
+    _, mask = mask_for(in_file, mask_file, mat_file)
+    bet_mask = load_data(nb.load(bet_mask_file), "native") > 0
+    return dice(mask, bet_mask)
+
+
+def foreground_box(img, mask_img=None, margin=10.0, threshold=0.1):
+    """
+    (start, stop) voxel indices of the foreground of img padded by margin
+    mm. The foreground is mask_img if given, else voxels above threshold
+    times the maximum.
+    """
+    import numpy as np
+
+    if mask_img is not None:
+        fg = load_data(mask_img, "native") > 0
+    else:
+        data = load_data(img, "native")
+        fg = data > threshold * data.max()
+    fg = fg.reshape(fg.shape[:3] + (-1,)).any(axis=3)
+    if not fg.any():
+        return [0, 0, 0], list(img.shape[:3])
+    pad = np.ceil(margin / np.array(img.header.get_zooms()[:3])).astype(int)
+    start = []
+    stop = []
+    for axis in range(3):
+        hits = np.nonzero(fg.any(axis=tuple(a for a in range(3) if a != axis)))
+        start.append(int(max(hits[0][0] - pad[axis], 0)))
+        stop.append(int(min(hits[0][-1] + 1 + pad[axis], fg.shape[axis])))
+    return start, stop
+
+
+def matching_box(box_img, img, margin=10.0):
+    """
+    (start, stop) voxel indices of img covering the field of view of
+    box_img padded by margin mm, found through the header affines
+    """
+    import itertools
+
+    import numpy as np
+
+    corners = np.array(
+        [
+            list(corner) + [1]
+            for corner in itertools.product(
+                *[[-0.5, n - 0.5] for n in box_img.shape[:3]]
+            )
+        ]
+    ).T
+    vox = (np.linalg.inv(img.affine) @ box_img.affine @ corners)[:3]
+    pad = margin / np.array(img.header.get_zooms()[:3])
+    lo = np.floor(vox.min(axis=1) - pad).astype(int)
+    hi = np.ceil(vox.max(axis=1) + pad).astype(int)
+    start = [int(max(val, 0)) for val in lo]
+    stop = [int(min(val, n)) for val, n in zip(hi, img.shape[:3])]
+    return start, stop
+
+
+def crop(in_file, out_file, box):
+    """
+    Writes the (start, stop) box of in_file to out_file, the header is
+    moved with the crop so world coordinates are unchanged
+    """
+    import nibabel as nb
+
+    start, stop = box
+    img = nb.load(in_file)
+    cropped = img.slicer[tuple(slice(a, b) for a, b in zip(start, stop))]
+    nb.save(cropped, out_file)
+    return out_file
+
+
+def crop_reference(ref_file, out_file, margin=10.0, mask_file=None):
+    """
+    Crops the reference to its foreground (or mask) plus margin mm,
+    returns the full and cropped shapes
+    """
+    import nibabel as nb
+
+    img = nb.load(ref_file)
+    mask_img = nb.load(mask_file) if mask_file else None
+    box = foreground_box(img, mask_img, margin)
+    crop(ref_file, out_file, box)
+    return img.shape[:3], tuple(b - a for a, b in zip(*box))
+
+
+def crop_like(in_file, box_file, out_file, margin=10.0):
+    """
+    Crops in_file to the field of view of box_file plus margin mm
+    """
+    import nibabel as nb
+
+    box = matching_box(nb.load(box_file), nb.load(in_file), margin)
+    return crop(in_file, out_file, box)
+
+
+def crop_to_full(
+    crop_mat_file, mat_file, in_file, in_crop, ref_file, ref_crop
+):
+    """
+    Converts a FLIRT matrix found between cropped images into one for the
+    full images and writes it to mat_file. Each crop is a shift in voxels,
+    so in FLIRT coordinates the full matrix is K_ref @ M @ inv(K_in) where
+    K takes cropped to full coordinates, x flips included.
+    """
+    import nibabel as nb
+    import numpy as np
+
+    def to_full(full_img, crop_img):
+        return (
+            fsl_coords(full_img)
+            @ np.linalg.inv(full_img.affine)
+            @ crop_img.affine
+            @ np.linalg.inv(fsl_coords(crop_img))
+        )
+
+    k_in = to_full(nb.load(in_file), nb.load(in_crop))
+    k_ref = to_full(nb.load(ref_file), nb.load(ref_crop))
+    return omat.write_omat(
+        k_ref @ np.loadtxt(crop_mat_file) @ np.linalg.inv(k_in), mat_file
+    )
@@ -0,0 +1,341 @@
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# A work queue that lives entirely on a shared filesystem. The coordinator
+# writes one task file per image into pending/, workers claim a task by
+# renaming it into claimed/ (rename is atomic on POSIX and NFS), keep the
+# claim alive by touching it and finally write results/<id>.json. Claims
+# whose mtime is older than the lease are moved back into pending/.
+
+MANIFEST = "manifest.json"
+PENDING = "pending"
+CLAIMED = "claimed"
+RESULTS = "results"
+
+
+def task_name(task_id):
+    """
+    File name used for a task in every queue directory
+    """
+    return f"{str(task_id).zfill(6)}.json"
+
+
+def write_json(fname, obj):
+    """
+    Atomically writes obj as json to fname
+    """
+    tmp_name = f"{fname}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_name, "w") as file:
+        json.dump(obj, file)
+    os.replace(tmp_name, fname)
+
+
+def read_json(fname):
+    """
+    Reads a json file, returns None if it vanished or is partial
+    """
+    try:
+        with open(fname, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def worker_id():
+    """
+    Identifies a worker process across nodes
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def make_tasks(images):
+    """
+    Turns the (directory, file, index) images to register, see
+    flirt_reg.list_images, into an ordered task list
+    """
+    return [
+        {
+            "id": task_id,
+            "data_directory": data_directory,
+            "nii": nii_name,
+            "index": i,
+        }
+        for task_id, (data_directory, nii_name, i) in enumerate(images)
+    ]
+
+
+def write_manifest(queue_dir, tasks, config):
+    """
+    Creates the queue layout and a pending file for every task without a
+    result. Re-running against an existing queue with the same tasks and
+    settings resumes it, else the old results are cleared.
+    """
+    for sub_dir in [PENDING, CLAIMED, RESULTS]:
+        os.makedirs(os.path.join(queue_dir, sub_dir), exist_ok=True)
+    # As read back from the manifest, tuples become lists
+    manifest = json.loads(json.dumps({"config": config, "tasks": tasks}))
+    old_manifest = read_json(os.path.join(queue_dir, MANIFEST))
+    if old_manifest and old_manifest != manifest:
+        print(
+            f"Task list or settings changed, clearing old results in "
+            f"{queue_dir}"
+        )
+        for sub_dir in [PENDING, CLAIMED, RESULTS]:
+            for fname in os.listdir(os.path.join(queue_dir, sub_dir)):
+                os.remove(os.path.join(queue_dir, sub_dir, fname))
+    write_json(os.path.join(queue_dir, MANIFEST), manifest)
+
+    n_done = 0
+    for task in tasks:
+        name = task_name(task["id"])
+        if os.path.exists(os.path.join(queue_dir, RESULTS, name)):
+            n_done += 1
+            continue
+        claimed = [
+            f
+            for f in os.listdir(os.path.join(queue_dir, CLAIMED))
+            if f.startswith(name)
+        ]
+        if not claimed:
+            write_json(os.path.join(queue_dir, PENDING, name), task)
+    if n_done:
+        print(f"Resuming queue, {n_done}/{len(tasks)} tasks already done")
+    return manifest
+
+
+def claim_task(queue_dir, wid):
+    """
+    Tries to claim one pending task, returns (task, claim path) or
+    (None, None) if nothing is pending
+    """
+    pending_dir = os.path.join(queue_dir, PENDING)
+    for name in sorted(os.listdir(pending_dir)):
+        src = os.path.join(pending_dir, name)
+        dst = os.path.join(queue_dir, CLAIMED, f"{name}.{wid}")
+        try:
+            # Touch first so the claim never looks expired after the rename
+            os.utime(src)
+            os.rename(src, dst)
+        except FileNotFoundError:
+            # Another worker got there first
+            continue
+        task = read_json(dst)
+        if task is None:
+            continue
+        return task, dst
+    return None, None
+
+
+class Lease:
+    """
+    Keeps a claim alive by touching it from a background thread
+    """
+
+    def __init__(self, path, lease_time):
+        self.path = path
+        self.interval = max(lease_time / 3, 0.1)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+
+    def _renew(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                # Requeued by the coordinator, the result still counts
+                logging.debug(f"Lease on {self.path} lost")
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def requeue_expired(queue_dir, lease_time):
+    """
+    Moves claims that have not been renewed back to pending
+    """
+    claimed_dir = os.path.join(queue_dir, CLAIMED)
+    n_requeued = 0
+    now = time.time()
+    for claim in os.listdir(claimed_dir):
+        path = os.path.join(claimed_dir, claim)
+        name = claim.split(".json")[0] + ".json"
+        try:
+            expired = now - os.path.getmtime(path) > lease_time
+        except FileNotFoundError:
+            continue
+        if not expired:
+            continue
+        if os.path.exists(os.path.join(queue_dir, RESULTS, name)):
+            # Worker finished but died before cleaning up
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            os.rename(path, os.path.join(queue_dir, PENDING, name))
+            n_requeued += 1
+            logging.debug(f"Lease expired, requeued {claim}")
+        except FileNotFoundError:
+            pass
+    return n_requeued
+
+
+def count_results(queue_dir):
+    return len(
+        [
+            f
+            for f in os.listdir(os.path.join(queue_dir, RESULTS))
+            if f.endswith(".json")
+        ]
+    )
+
+
+def run_worker(queue_dir, register, poll=1.0):
+    """
+    Claims and runs tasks until every task in the manifest has a result.
+    register(task, config) must return a json serialisable result dict.
+    """
+    queue_dir = os.path.abspath(queue_dir)
+    manifest = None
+    while manifest is None:
+        manifest = read_json(os.path.join(queue_dir, MANIFEST))
+        if manifest is None:
+            time.sleep(poll)
+    config = manifest["config"]
+    lease_time = config.get("lease", 60)
+    n_tasks = len(manifest["tasks"])
+    wid = worker_id()
+    print(f"Worker {wid} joined queue {queue_dir}")
+
+    n_done = 0
+    while True:
+        task, claim = claim_task(queue_dir, wid)
+        if task is None:
+            if count_results(queue_dir) >= n_tasks:
+                break
+            # Other workers hold the rest, wait in case a lease expires
+            time.sleep(poll)
+            continue
+        start_time = time.time()
+        with Lease(claim, lease_time):
+            result = register(task, config)
+        result["id"] = task["id"]
+        result["worker"] = wid
+        result["elapsed"] = time.time() - start_time
+        write_json(
+            os.path.join(queue_dir, RESULTS, task_name(task["id"])), result
+        )
+        try:
+            os.remove(claim)
+        except FileNotFoundError:
+            pass
+        n_done += 1
+        logging.debug(f"Worker {wid} finished task {task['id']}")
+    print(f"Worker {wid} done, processed {n_done} tasks")
+    return n_done
+
+
+def start_local_workers(queue_dir, n_workers, verbose=False):
+    """
+    Starts worker processes on this machine, handy for testing or for
+    making the coordinator node do some of the work
+    """
+    procs = []
+    cmd = [sys.executable, "-m", "flirt_reg", "--worker", queue_dir]
+    if verbose:
+        cmd.append("--verbose")
+    for _ in range(n_workers):
+        procs.append(subprocess.Popen(cmd))
+    return procs
+
+
+def run_coordinator(
+    queue_dir,
+    tasks,
+    config,
+    local_workers=0,
+    lease_time=60,
+    poll=2.0,
+    verbose=False,
+    on_result=None,
+    on_poll=None,
+    stop=None,
+):
+    """
+    Publishes tasks and waits for workers to finish them, requeueing
+    expired leases. Returns the results in task order.
+
+    on_result(result, reused) is called once per result as it arrives,
+    reused is True for results left by an earlier run of this queue.
+    on_poll(n_pending) is called on every poll with the pending count.
+    Once stop (a threading.Event) is set the coordinator stops waiting
+    and returns None. The tasks left are kept in queue_dir for a later
+    run to resume, the workers carry on with them.
+    """
+    queue_dir = os.path.abspath(queue_dir)
+    config = dict(config, lease=lease_time)
+    write_manifest(queue_dir, tasks, config)
+    results_dir = os.path.join(queue_dir, RESULTS)
+    reused = set(f for f in os.listdir(results_dir) if f.endswith(".json"))
+    seen = set()
+    procs = start_local_workers(queue_dir, local_workers, verbose=verbose)
+    n_tasks = len(tasks)
+    print(f"Coordinating {n_tasks} tasks in {queue_dir}")
+
+    def collect():
+        for name in sorted(os.listdir(results_dir)):
+            if not name.endswith(".json") or name in seen:
+                continue
+            result = read_json(os.path.join(results_dir, name))
+            if result is None:
+                continue
+            seen.add(name)
+            if on_result:
+                on_result(result, name in reused)
+        if on_poll:
+            on_poll(len(os.listdir(os.path.join(queue_dir, PENDING))))
+        return len(seen)
+
+    n_done = collect()
+    while n_done < n_tasks:
+        if stop is not None and stop.is_set():
+            print(f"Stopped, {n_tasks - n_done} tasks left in {queue_dir}")
+            return None
+        time.sleep(poll)
+        n_requeued = requeue_expired(queue_dir, lease_time)
+        if n_requeued:
+            print(f"Requeued {n_requeued} expired tasks")
+        n_done = collect()
+        logging.debug(f"Queue progress: {n_done}/{n_tasks}")
+        if procs and all(p.poll() is not None for p in procs):
+            procs = []
+            # Their last results may have landed after collect() ran
+            n_done = collect()
+            if n_done < n_tasks:
+                print(
+                    "All local workers exited with tasks remaining, "
+                    "waiting for remote workers"
+                )
+
+    for proc in procs:
+        proc.wait()
+
+    results = []
+    for task in tasks:
+        results.append(
+            read_json(os.path.join(results_dir, task_name(task["id"])))
+        )
+    return results
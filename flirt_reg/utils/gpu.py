@@ -0,0 +1,13 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def array_module():
+    """
+    Returns CuPy if it is usable, otherwise NumPy. gpuoptional probes for
+    CuPy when imported so it is only loaded the first time an array
+    is needed.
+    """
+    import gpuoptional.gpuoptional as gpopt
+
+    return gpopt.array_module("cupy")
@@ -0,0 +1,382 @@
+import heapq
+import json
+import os
+import resource
+import socket
+import sqlite3
+import statistics
+import time
+
+# Local history of past runs, kept in an sqlite file: the settings, jobs,
+# cores, wall time and peak memory of each run, and the voxel count and
+# per stage seconds of each image. It is used to predict how long a new
+# input set will take (see plan) and to start the longest images first.
+# Nothing here is needed for a run to succeed, so errors only warn.
+
+HISTORY_ENV = "FLIRT_REG_HISTORY"
+HISTORY_FILE = os.path.join(
+    os.path.expanduser("~"), ".flirt_reg", "history.sqlite"
+)
+# A --jobs value within this fraction of the fastest is good enough
+JOBS_SLACK = 0.05
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    host TEXT,
+    settings TEXT,
+    jobs INTEGER,
+    cpus INTEGER,
+    n_images INTEGER,
+    max_voxels INTEGER,
+    wall_s REAL,
+    self_mb REAL,
+    child_mb REAL
+);
+CREATE TABLE IF NOT EXISTS images (
+    run_id INTEGER REFERENCES runs(id),
+    image TEXT,
+    shape TEXT,
+    zooms TEXT,
+    voxels INTEGER,
+    failed INTEGER,
+    wall_s REAL,
+    stages TEXT
+);
+"""
+
+
+def history_file(path=None):
+    """
+    path, else $FLIRT_REG_HISTORY, else HISTORY_FILE
+    """
+    return path or os.environ.get(HISTORY_ENV) or HISTORY_FILE
+
+
+def connect(path=None):
+    path = history_file(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def settings_key(settings):
+    return json.dumps(settings, sort_keys=True)
+
+
+def voxels(entry):
+    """
+    Voxels in the first volume of a utils.nii catalog entry, 0 if the
+    file could not be read
+    """
+    if "shape" not in entry:
+        return 0
+    count = 1
+    for size in entry["shape"][:3]:
+        count *= size
+    return count
+
+
+def peak_memory():
+    """
+    (peak MB of this process, peak MB of its largest finished child), the
+    children being the FSL tools
+    """
+    scale = 1024.0 if os.uname().sysname == "Linux" else 1024.0**2
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / scale, child / scale
+
+
+def add_seconds(seconds, event):
+    """
+    Adds the wall seconds of a trace event for an image to seconds,
+    {image: {stage: seconds}}
+    """
+    image = event.get("args", {}).get("image")
+    if image:
+        stages = seconds.setdefault(image, {})
+        stages[event["name"]] = (
+            stages.get(event["name"], 0.0) + event["args"]["wall_s"]
+        )
+
+
+def image_seconds(events):
+    """
+    {image: {stage: seconds}} from trace events
+    """
+    seconds = {}
+    for event in events:
+        add_seconds(seconds, event)
+    return seconds
+
+
+def record_run(settings, catalog, events, jobs, wall_s, failed=(), path=None):
+    """
+    Adds a run to the history. catalog is the utils.nii catalog of the
+    inputs, events the run's trace and failed the images that failed.
+    """
+    seconds = image_seconds(events)
+    sizes = {image: catalog.get(os.path.abspath(image)) for image in seconds}
+    seconds = {
+        image: seconds[image]
+        for image in sizes
+        if sizes[image] and "shape" in sizes[image]
+    }
+    if not seconds:
+        return None
+    self_mb, child_mb = peak_memory()
+    try:
+        conn = connect(path)
+        with conn:
+            run_id = conn.execute(
+                "INSERT INTO runs (started, host, settings, jobs, cpus, "
+                "n_images, max_voxels, wall_s, self_mb, child_mb) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time() - wall_s,
+                    socket.gethostname(),
+                    settings_key(settings),
+                    jobs,
+                    os.cpu_count() or 1,
+                    len(seconds),
+                    max(
+                        (voxels(entry) for entry in sizes.values() if entry),
+                        default=0,
+                    ),
+                    wall_s,
+                    self_mb,
+                    child_mb,
+                ),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        run_id,
+                        image,
+                        json.dumps(sizes[image]["shape"]),
+                        json.dumps(sizes[image]["zooms"]),
+                        voxels(sizes[image]),
+                        int(image in failed),
+                        sum(stages.values()),
+                        json.dumps(stages),
+                    )
+                    for image, stages in seconds.items()
+                ],
+            )
+        conn.close()
+    except (OSError, sqlite3.Error) as err:
+        print(f"Warning: could not record the run history: {err}")
+        return None
+    return run_id
+
+
+def lpt_makespan(seconds, workers):
+    """
+    Wall time of running jobs of the given seconds on workers, longest
+    first, each on the worker that frees up first
+    """
+    finish = [0.0] * max(min(workers, len(seconds)), 1)
+    for val in sorted(seconds, reverse=True):
+        heapq.heapreplace(finish, finish[0] + val)
+    return max(finish)
+
+
+def matching(settings, runs):
+    """
+    The runs with these settings, else those with the same cost function,
+    brain extraction and quick fit, and how close the match is
+    """
+    key = settings_key(settings)
+    exact = [run for run in runs if run["key"] == key]
+    if exact:
+        return exact, "exact"
+    loose = ["cost_func", "extraction", "quick_voxel"]
+    similar = [
+        run
+        for run in runs
+        if all(
+            run["settings"].get(name) == settings.get(name) for name in loose
+        )
+    ]
+    return similar, "similar"
+
+
+class Estimator:
+    """
+    Predicts the seconds an image of a given voxel count takes with the
+    given settings, from the history. Each image is scaled to one core
+    (an image in a run with more jobs than cores shared its core) and a
+    line, seconds = a + b * voxels, is fitted to them, or just b when all
+    have the same size. available is False when there is no history.
+    """
+
+    def __init__(self, settings, path=None):
+        self.settings = settings
+        self.runs = []
+        self.match = None
+        self.intercept = self.slope = 0.0
+        self.overhead = 0.0
+        try:
+            conn = connect(path)
+            self.runs = self.load(conn)
+            conn.close()
+        except (OSError, sqlite3.Error) as err:
+            print(f"Warning: could not read the run history: {err}")
+        self.runs, self.match = matching(settings, self.runs)
+        self.available = bool(self.runs)
+        if self.available:
+            self.fit()
+
+    def load(self, conn):
+        runs = {}
+        for row in conn.execute(
+            "SELECT id, settings, jobs, cpus, max_voxels, wall_s, self_mb, "
+            "child_mb FROM runs"
+        ):
+            runs[row[0]] = {
+                "key": row[1],
+                "settings": json.loads(row[1]),
+                "jobs": row[2],
+                "cpus": row[3],
+                "max_voxels": row[4],
+                "wall_s": row[5],
+                "self_mb": row[6],
+                "child_mb": row[7],
+                "images": [],
+            }
+        for run_id, size, wall_s in conn.execute(
+            "SELECT run_id, voxels, wall_s FROM images WHERE failed = 0"
+        ):
+            if run_id in runs:
+                run = runs[run_id]
+                share = min(run["jobs"], run["cpus"]) / max(run["jobs"], 1)
+                run["images"].append((size, wall_s * share))
+        return [run for run in runs.values() if run["images"]]
+
+    def fit(self):
+        samples = [sample for run in self.runs for sample in run["images"]]
+        sizes = [float(size) for size, _ in samples]
+        seconds = [val for _, val in samples]
+        if len(set(sizes)) > 1:
+            mean_size = statistics.fmean(sizes)
+            mean_s = statistics.fmean(seconds)
+            self.slope = sum(
+                (size - mean_size) * (val - mean_s)
+                for size, val in zip(sizes, seconds)
+            ) / sum((size - mean_size) ** 2 for size in sizes)
+            self.intercept = mean_s - self.slope * mean_size
+        if self.slope <= 0:
+            self.intercept = 0.0
+            self.slope = statistics.median(seconds) / statistics.median(sizes)
+        # Reference preparation, GIF and the like, what the per image
+        # seconds do not account for in each run's wall time
+        self.overhead = statistics.median(
+            max(
+                run["wall_s"]
+                - lpt_makespan(
+                    [self.seconds(size) for size, _ in run["images"]],
+                    min(run["jobs"], run["cpus"]),
+                ),
+                0.0,
+            )
+            for run in self.runs
+        )
+
+    def seconds(self, size):
+        """
+        Predicted seconds for an image of size voxels on one core
+        """
+        return max(self.intercept + self.slope * size, 0.0)
+
+    def predictor(self, catalog):
+        """
+        predict(image path) for iter_flirt_async, from the image sizes in
+        a utils.nii catalog, 0 for images it does not hold
+        """
+
+        def predict(image):
+            entry = catalog.get(os.path.abspath(image))
+            return self.seconds(voxels(entry)) if entry else 0.0
+
+        return predict
+
+    def memory(self, jobs, size):
+        """
+        Predicted peak MB with jobs at once and images of at most size
+        voxels, the largest FSL process seen is scaled by voxel count
+        """
+        return max(
+            run["self_mb"]
+            + jobs * run["child_mb"] * size / max(run["max_voxels"], 1)
+            for run in self.runs
+        )
+
+    def wall(self, sizes, jobs, cpus):
+        """
+        Predicted wall seconds for images of sizes with jobs at once on
+        cpus cores
+        """
+        slowdown = max(jobs / cpus, 1.0)
+        return self.overhead + lpt_makespan(
+            [self.seconds(size) * slowdown for size in sizes], jobs
+        )
+
+
+def jobs_options(cpus, n_images):
+    """
+    Powers of two up to cpus, and cpus, no more than there are images
+    """
+    most = min(cpus, max(n_images, 1))
+    options = {most}
+    jobs = 1
+    while jobs < most:
+        options.add(jobs)
+        jobs *= 2
+    return sorted(options)
+
+
+def plan(settings, sizes, cpus=None, memory_mb=None, path=None):
+    """
+    Predicted wall time and peak memory for registering images of sizes
+    voxels with the given settings, for each jobs_options value on cpus
+    cores (this machine's by default). best is the smallest --jobs
+    within JOBS_SLACK of the fastest whose memory fits in memory_mb (this
+    machine's by default). Returns None without a matching history.
+    """
+    estimator = Estimator(settings, path)
+    if not estimator.available or not sizes:
+        return None
+    cpus = cpus or os.cpu_count() or 1
+    if memory_mb is None:
+        memory_mb = (
+            os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20
+        )
+    rows = [
+        {
+            "jobs": jobs,
+            "wall_s": estimator.wall(sizes, jobs, cpus),
+            "peak_mb": estimator.memory(jobs, max(sizes)),
+        }
+        for jobs in jobs_options(cpus, len(sizes))
+    ]
+    fits = [row for row in rows if row["peak_mb"] <= memory_mb] or rows[:1]
+    fastest = min(row["wall_s"] for row in fits)
+    best = next(
+        row["jobs"]
+        for row in fits
+        if row["wall_s"] <= fastest * (1 + JOBS_SLACK)
+    )
+    return {
+        "images": len(sizes),
+        "cpus": cpus,
+        "memory_mb": memory_mb,
+        "match": estimator.match,
+        "history_runs": len(estimator.runs),
+        "image_s": [estimator.seconds(size) for size in sizes],
+        "options": rows,
+        "best_jobs": best,
+    }
@@ -0,0 +1,268 @@
+import json
+import os
+import socket
+import threading
+import time
+
+# Live run metrics. Stage latencies come from trace spans, image counts
+# from the pipeline. An exporter thread rewrites a Prometheus textfile
+# (for node_exporter's textfile collector) and a small json status file,
+# and listeners such as the progress bar are called on every update.
+
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+class Histogram:
+    """
+    Cumulative latency histogram in the Prometheus style
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.sum / self.count
+
+
+class Metrics:
+    """
+    Thread safe counters for one run
+    """
+
+    def __init__(self, total=0):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.queue_depth = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.stages = {}
+        self.start_time = time.time()
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener(self)
+
+    def set_total(self, total):
+        with self._lock:
+            self.total = total
+            self.queue_depth = total
+        self._notify()
+
+    def observe_span(self, event):
+        """
+        Trace listener, adds a finished span to its stage histogram
+        """
+        with self._lock:
+            stage = self.stages.setdefault(event["name"], Histogram())
+            stage.observe(event["dur"] / 1e6)
+
+    def image_done(self, failed=False):
+        with self._lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+        self._notify()
+
+    def set_queue_depth(self, depth):
+        with self._lock:
+            self.queue_depth = depth
+
+    def cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def cache_miss(self):
+        with self._lock:
+            self.cache_misses += 1
+
+    def finished(self):
+        return self.completed + self.failed
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def images_per_sec(self):
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self.finished() / elapsed
+
+    def eta(self):
+        """
+        Seconds until every image is done at the current rate, None if
+        nothing has finished yet
+        """
+        rate = self.images_per_sec()
+        if rate == 0:
+            return None
+        return max(self.total - self.finished(), 0) / rate
+
+    def cache_hit_rate(self):
+        lookups = self.cache_hits + self.cache_misses
+        if lookups == 0:
+            return 0.0
+        return self.cache_hits / lookups
+
+    def to_status(self):
+        with self._lock:
+            return {
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "time": time.time(),
+                "elapsed_s": self.elapsed(),
+                "total": self.total,
+                "completed": self.completed,
+                "failed": self.failed,
+                "queue_depth": self.queue_depth,
+                "images_per_sec": self.images_per_sec(),
+                "eta_s": self.eta(),
+                "cache_hit_rate": self.cache_hit_rate(),
+                "stage_mean_s": {
+                    stage: hist.mean() for stage, hist in self.stages.items()
+                },
+            }
+
+    def to_prometheus(self):
+        """
+        Renders the metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, help_str, value):
+            lines.append(f"# HELP flirt_reg_{name} {help_str}")
+            lines.append(f"# TYPE flirt_reg_{name} {kind}")
+            lines.append(f"flirt_reg_{name} {value}")
+
+        with self._lock:
+            eta = self.eta()
+            metric("images", "gauge", "Images in this run.", self.total)
+            metric(
+                "images_completed_total",
+                "counter",
+                "Images registered.",
+                self.completed,
+            )
+            metric(
+                "images_failed_total",
+                "counter",
+                "Images that failed after retries.",
+                self.failed,
+            )
+            metric(
+                "images_per_second",
+                "gauge",
+                "Images finished per second since the start.",
+                self.images_per_sec(),
+            )
+            metric(
+                "queue_depth",
+                "gauge",
+                "Images waiting for a worker.",
+                self.queue_depth,
+            )
+            metric(
+                "eta_seconds",
+                "gauge",
+                "Estimated seconds until the run finishes.",
+                "NaN" if eta is None else eta,
+            )
+            metric(
+                "cache_hits_total",
+                "counter",
+                "Results reused instead of recomputed.",
+                self.cache_hits,
+            )
+            metric(
+                "cache_misses_total",
+                "counter",
+                "Results that had to be computed.",
+                self.cache_misses,
+            )
+            lines.append(
+                "# HELP flirt_reg_stage_seconds Wall time of each stage."
+            )
+            lines.append("# TYPE flirt_reg_stage_seconds histogram")
+            for stage, hist in sorted(self.stages.items()):
+                for upper, count in zip(hist.buckets, hist.counts):
+                    lines.append(
+                        f'flirt_reg_stage_seconds_bucket{{stage="{stage}",'
+                        f'le="{upper}"}} {count}'
+                    )
+                lines.append(
+                    f'flirt_reg_stage_seconds_bucket{{stage="{stage}",'
+                    f'le="+Inf"}} {hist.count}'
+                )
+                lines.append(
+                    f'flirt_reg_stage_seconds_sum{{stage="{stage}"}} '
+                    f"{hist.sum}"
+                )
+                lines.append(
+                    f'flirt_reg_stage_seconds_count{{stage="{stage}"}} '
+                    f"{hist.count}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def write_atomic(fname, text):
+    tmp_name = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp_name, "w") as file:
+        file.write(text)
+    os.replace(tmp_name, fname)
+
+
+class MetricsExporter:
+    """
+    Rewrites flirt_reg.prom and status.json in out_dir every interval
+    seconds until stopped, then writes them one last time
+    """
+
+    def __init__(self, metrics, out_dir, interval=10):
+        self.metrics = metrics
+        self.out_dir = out_dir
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        os.makedirs(out_dir, exist_ok=True)
+
+    def write(self):
+        write_atomic(
+            os.path.join(self.out_dir, "flirt_reg.prom"),
+            self.metrics.to_prometheus(),
+        )
+        write_atomic(
+            os.path.join(self.out_dir, "status.json"),
+            json.dumps(self.metrics.to_status()),
+        )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self.write()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
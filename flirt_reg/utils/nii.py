@@ -1,7 +1,243 @@
 import argparse
+import hashlib
+import json
 import os
 import time
-import nibabel as nib
+
+# nibabel is imported inside the functions that use it. nib.load only
+# parses the header, the voxel data stays on disk until it is read, so
+# cataloguing a tree costs a few hundred bytes per file (more for .nii.gz,
+# which has to be decompressed as far as the end of the header).
+
+INDEX_NAME = "nii_index.json"
+INDEX_VERSION = 1
+
+
+def is_nii_file(fname):
+    return fname.endswith(".nii") or fname.endswith(".nii.gz")
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    sha256 of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_header(path, digest=False):
+    """
+    Catalog entry for one NIfTI file, from its header only. A file that
+    cannot be read gets an entry holding only the error.
+    """
+    import nibabel as nib
+    from nibabel.filebasedimages import ImageFileError
+
+    try:
+        stat = os.stat(path)
+        img = nib.load(path)
+    except (ImageFileError, OSError, ValueError) as err:
+        return {"error": str(err)}
+    hdr = img.header
+    entry = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "shape": [int(n) for n in img.shape],
+        "zooms": [float(zoom) for zoom in hdr.get_zooms()],
+        "dtype": str(hdr.get_data_dtype()),
+        "affine": [[float(val) for val in row] for row in img.affine],
+        "qform_code": int(hdr["qform_code"]),
+        "sform_code": int(hdr["sform_code"]),
+    }
+    if digest:
+        entry["sha256"] = file_digest(path)
+    return entry
+
+
+def load_index(index_file):
+    """
+    Reads an index written by catalog_files, empty if missing or stale
+    """
+    try:
+        with open(index_file, "r") as file:
+            index = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if index.get("version") != INDEX_VERSION:
+        return {}
+    return index.get("files", {})
+
+
+def catalog_files(paths, jobs=8, digest=False, index_file=None):
+    """
+    Reads the headers of paths with jobs threads, returns {path: entry},
+    see read_header. Entries in index_file whose size and mtime still
+    match are reused and the updated catalog is written back to it.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from flirt_reg.utils.metrics import write_atomic
+
+    paths = [os.path.abspath(path) for path in paths]
+    old = load_index(index_file) if index_file else {}
+
+    def entry_for(path):
+        entry = old.get(path)
+        # Unreadable files are tried again
+        if entry and "error" not in entry:
+            stat = os.stat(path)
+            if (
+                entry["size"] == stat.st_size
+                and entry["mtime_ns"] == stat.st_mtime_ns
+                and (not digest or "sha256" in entry)
+            ):
+                return entry
+        return read_header(path, digest)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        catalog = dict(zip(paths, pool.map(entry_for, paths)))
+    if index_file:
+        write_atomic(
+            index_file,
+            json.dumps({"version": INDEX_VERSION, "files": catalog}),
+        )
+    return catalog
+
+
+def find_nii(root):
+    """
+    Every NIfTI file under root, sorted
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Skip the pipeline's own staging and output directories
+        dirnames[:] = [
+            name for name in dirnames if name not in ["tmp", "FLIRT_out"]
+        ]
+        paths += [
+            os.path.join(dirpath, fname)
+            for fname in filenames
+            if is_nii_file(fname)
+        ]
+    return sorted(paths)
+
+
+def geometry_key(entry, decimals=4):
+    """
+    Images with the same key share a voxel grid
+    """
+    return (
+        tuple(entry["shape"][:3]),
+        tuple(round(zoom, decimals) for zoom in entry["zooms"][:3]),
+        tuple(round(val, decimals) for row in entry["affine"] for val in row),
+    )
+
+
+def unreadable(catalog):
+    """
+    "path: error" for every file whose header could not be read
+    """
+    return [
+        f"{path}: {entry['error']}"
+        for path, entry in catalog.items()
+        if "error" in entry
+    ]
+
+
+def geometry_groups(catalog):
+    """
+    Groups the readable catalog paths by voxel grid, largest group first
+    """
+    groups = {}
+    for path, entry in catalog.items():
+        if "error" not in entry:
+            groups.setdefault(geometry_key(entry), []).append(path)
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def geometry_mismatches(catalog, reference):
+    """
+    Describes every image whose shape or voxel size differs from the
+    reference, or whose grid is placed differently. Unreadable files are
+    left out, see unreadable.
+    """
+    ref = catalog[os.path.abspath(reference)]
+    if "error" in ref:
+        return []
+    ref_shape, ref_zooms, ref_affine = geometry_key(ref)
+    mismatches = []
+    for path, entry in catalog.items():
+        if "error" in entry:
+            continue
+        shape, zooms, affine = geometry_key(entry)
+        if shape != ref_shape:
+            mismatches.append(f"{path}: shape {shape} vs {ref_shape}")
+        elif zooms != ref_zooms:
+            mismatches.append(f"{path}: voxel size {zooms} vs {ref_zooms}")
+        elif affine != ref_affine:
+            mismatches.append(f"{path}: affine differs from the reference")
+    return mismatches
+
+
+def catalog_cmd():
+    """
+    Builds or refreshes the header index of a directory tree
+    """
+    start_time = time.time()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--dirname",
+        help="directory tree to catalog. Default: current directory.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help=f"index file. Default: <dirname>/{INDEX_NAME}.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="headers read at once. Default: 8.",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--digest",
+        action="store_true",
+        help="also record a sha256 of every file. Default: false.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="prints the files in each geometry group. Default: false.",
+    )
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.dirname or os.getcwd())
+    index_file = args.output or os.path.join(root, INDEX_NAME)
+    catalog = catalog_files(find_nii(root), args.jobs, args.digest, index_file)
+    groups = geometry_groups(catalog)
+    print(f"{len(catalog)} files in {len(groups)} geometry groups")
+    for error in unreadable(catalog):
+        print(f"  unreadable: {error}")
+    for group in groups:
+        entry = catalog[group[0]]
+        print(
+            f"  {len(group)} x shape {entry['shape']}, "
+            f"voxels {entry['zooms'][:3]} mm, {entry['dtype']}"
+        )
+        if args.verbose:
+            for path in group:
+                print(f"    {path}")
+    print(f"Index saved to {index_file}")
+    if args.verbose:
+        total_time = time.gmtime((time.time() - start_time))
+        print(f"Catalog built in {time.strftime('%Hh%Mm%Ss', total_time)}")
 
 
 def read_nii_hdr():
@@ -31,6 +267,8 @@ def read_nii_hdr():
     args = parser.parse_args()
 
     if args.input:
+        import nibabel as nib
+
         img = nib.load(args.input)
         hdr = img.header
         if args.output:
@@ -0,0 +1,315 @@
+import collections
+import functools
+import gzip
+import json
+import numbers
+import os
+import shutil
+import threading
+import zlib
+
+# Compressed NIfTI I/O. Files are written as a run of gzip members holding
+# block_size uncompressed bytes each, which every gzip reader (nibabel, FSL)
+# reads as one stream. zlib releases the GIL, so the members are compressed
+# and decompressed on a pool of threads. Their offsets are kept in a sidecar
+# index, <file>.gz.gzidx, so a slice is read by decompressing only the
+# members that hold it. Files without an index, e.g. written by FSL, are
+# read as a single stream as before. numpy and nibabel are imported inside
+# the functions that use them.
+
+GZIP_LEVEL = 1
+BLOCK_SIZE = 1 << 20
+THREADS = min(os.cpu_count() or 1, 8)
+INDEX_SUFFIX = ".gzidx"
+INDEX_VERSION = 1
+
+# Defaults for this process, see configure
+SETTINGS = {"level": GZIP_LEVEL, "threads": THREADS, "block_size": BLOCK_SIZE}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def configure(level=None, threads=None, block_size=None):
+    """
+    Sets the compression level, threads and member size used when they are
+    not given, returns the settings
+    """
+    for key, val in [
+        ("level", level),
+        ("threads", threads),
+        ("block_size", block_size),
+    ]:
+        if val is not None:
+            SETTINGS[key] = val
+    return dict(SETTINGS)
+
+
+def thread_pool(threads=None):
+    """
+    The shared pool of threads (SETTINGS["threads"] by default)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    threads = max(threads or SETTINGS["threads"], 1)
+    with _pools_lock:
+        if threads not in _pools:
+            _pools[threads] = ThreadPoolExecutor(
+                threads, thread_name_prefix="niio"
+            )
+        return _pools[threads], threads
+
+
+def ordered_map(func, items, threads=None):
+    """
+    Yields func(item) for each item in order, computed on the thread pool
+    at most twice threads items ahead so memory stays bounded
+    """
+    executor, threads = thread_pool(threads)
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= 2 * threads:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def index_name(gz_file):
+    return f"{gz_file}{INDEX_SUFFIX}"
+
+
+def write_index(gz_file, members):
+    """
+    Writes the sidecar index of gz_file, members are [uncompressed offset,
+    uncompressed size, offset, size] of each gzip member
+    """
+    from flirt_reg.utils.metrics import write_atomic
+
+    stat = os.stat(gz_file)
+    index = {
+        "version": INDEX_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "members": members,
+    }
+    write_atomic(index_name(gz_file), json.dumps(index))
+    return members
+
+
+def load_index(gz_file):
+    """
+    The members of gz_file from its sidecar index, None if it has none or
+    the file changed since the index was written
+    """
+    try:
+        with open(index_name(gz_file), "r") as file:
+            index = json.load(file)
+        stat = os.stat(gz_file)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (
+        index.get("version") != INDEX_VERSION
+        or index.get("size") != stat.st_size
+        or index.get("mtime_ns") != stat.st_mtime_ns
+    ):
+        return None
+    return index["members"]
+
+
+def build_index(gz_file, chunk_size=1 << 20):
+    """
+    Finds the members of an existing gz_file in one pass and writes its
+    index. A file written as a single stream has one member, so it gains
+    nothing, rewrite it with compress_file to read it in parallel.
+    """
+    members = []
+    raw = fed = start = raw_start = 0
+    decomp = zlib.decompressobj(31)
+    with open(gz_file, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            fed += len(chunk)
+            while chunk:
+                raw += len(decomp.decompress(chunk))
+                if not decomp.eof:
+                    break
+                # The rest of the chunk starts the next member
+                chunk = decomp.unused_data
+                end = fed - len(chunk)
+                members.append(
+                    [raw_start, raw - raw_start, start, end - start]
+                )
+                start, raw_start = end, raw
+                decomp = zlib.decompressobj(31)
+    return write_index(gz_file, members)
+
+
+def read_blocks(path, block_size):
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            yield block
+
+
+def compress_block(block, level=GZIP_LEVEL):
+    return gzip.compress(block, compresslevel=level, mtime=0)
+
+
+def compress_file(
+    in_file, out_file=None, level=None, threads=None, block_size=None
+):
+    """
+    gzips in_file to out_file (in_file.gz by default) as one member per
+    block_size bytes, compressed in parallel, and writes the index
+    """
+    if level is None:
+        level = SETTINGS["level"]
+    block_size = block_size or SETTINGS["block_size"]
+    out_file = out_file or f"{in_file}.gz"
+    members = []
+    raw = comp = 0
+    with open(out_file, "wb") as dst:
+        for size, member in ordered_map(
+            lambda block: (len(block), compress_block(block, level)),
+            read_blocks(in_file, block_size),
+            threads,
+        ):
+            dst.write(member)
+            members.append([raw, size, comp, len(member)])
+            raw += size
+            comp += len(member)
+        if not members:
+            dst.write(compress_block(b"", level))
+    write_index(out_file, members)
+    return out_file
+
+
+def read_member(gz_file, member):
+    """
+    The uncompressed bytes of one member of gz_file
+    """
+    with open(gz_file, "rb") as file:
+        file.seek(member[2])
+        return zlib.decompress(file.read(member[3]), 31)
+
+
+def decompress_file(gz_file, out_file, threads=None):
+    """
+    Writes the uncompressed contents of gz_file to out_file, decompressing
+    its members in parallel if it has an index
+    """
+    members = load_index(gz_file)
+    with open(out_file, "wb") as dst:
+        if members is None:
+            with gzip.open(gz_file, "rb") as src:
+                shutil.copyfileobj(src, dst, 1 << 20)
+        else:
+            for data in ordered_map(
+                functools.partial(read_member, gz_file), members, threads
+            ):
+                dst.write(data)
+    return out_file
+
+
+def read_bytes(path, start=0, stop=None, threads=None):
+    """
+    Uncompressed bytes start to stop (the end if None) of path, only the
+    members of an indexed .gz file that hold them are decompressed
+    """
+    members = load_index(path) if path.endswith(".gz") else None
+    if members is None:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as file:
+            file.seek(start)
+            return file.read(-1 if stop is None else stop - start)
+    if stop is None:
+        stop = sum(member[1] for member in members)
+    needed = [
+        member
+        for member in members
+        if member[0] < stop and member[0] + member[1] > start
+    ]
+    if not needed:
+        return b""
+    data = b"".join(
+        ordered_map(functools.partial(read_member, path), needed, threads)
+    )
+    return data[start - needed[0][0] : stop - needed[0][0]]
+
+
+def load(path, threads=None):
+    """
+    nibabel image of path, an indexed .nii.gz is decompressed in parallel
+    into memory, anything else is loaded by nibabel as usual
+    """
+    import nibabel as nb
+
+    img = nb.load(path)
+    if not path.endswith(".gz") or load_index(path) is None:
+        return img
+    return type(img).from_bytes(read_bytes(path, threads=threads))
+
+
+def slab_range(img, index):
+    """
+    (start, stop) bytes of the voxel data holding img.dataobj[index] and
+    the shape and strides of the slab within them, or None if index is not
+    a tuple of ints and full slices
+    """
+    shape = img.shape
+    index = tuple(index) + (slice(None),) * (len(shape) - len(index))
+    if len(index) != len(shape):
+        return None
+    itemsize = img.get_data_dtype().itemsize
+    # Fortran order, the first axis varies fastest
+    strides = [itemsize]
+    for size in shape[:-1]:
+        strides.append(strides[-1] * size)
+    start = 0
+    length = itemsize
+    out_shape = []
+    out_strides = []
+    for idx, size, stride in zip(index, shape, strides):
+        if isinstance(idx, slice) and idx == slice(None):
+            length += (size - 1) * stride
+            out_shape.append(size)
+            out_strides.append(stride)
+        elif isinstance(idx, numbers.Integral) and 0 <= idx < size:
+            start += idx * stride
+        else:
+            return None
+    return start, start + length, out_shape, out_strides
+
+
+def read_slab(img, index, threads=None):
+    """
+    np.asanyarray(img.dataobj[index]) for an image loaded from an indexed
+    .nii.gz, reading only the members that hold the slab, e.g. an axial
+    slice. Other images and indices are read through nibabel.
+    """
+    import numpy as np
+
+    path = img.get_filename()
+    dataobj = img.dataobj
+    slab = None
+    if (
+        path
+        and path.endswith(".gz")
+        and getattr(dataobj, "order", None) == "F"
+        and load_index(path) is not None
+    ):
+        slab = slab_range(img, index)
+    if slab is None:
+        return np.asanyarray(dataobj[index])
+    start, stop, shape, strides = slab
+    offset = int(dataobj.offset)
+    data = np.ndarray(
+        shape,
+        dtype=img.get_data_dtype(),
+        buffer=read_bytes(path, offset + start, offset + stop, threads),
+        strides=strides,
+    )
+    slope = getattr(dataobj, "slope", 1.0)
+    inter = getattr(dataobj, "inter", 0.0)
+    if slope != 1.0 or inter != 0.0:
+        return data * slope + inter
+    return np.array(data)
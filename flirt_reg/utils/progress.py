@@ -28,3 +28,20 @@ def printProgressBar(
     # Print New Line on Complete
     if iteration == total:
         print()
+
+
+def metrics_progress(prefix="Progress:", suffix="Complete", length=50):
+    """
+    Returns a utils.metrics.Metrics listener that draws the progress bar
+    """
+
+    def listener(metrics):
+        printProgressBar(
+            metrics.finished(),
+            max(metrics.total, 1),
+            prefix=prefix,
+            suffix=suffix,
+            length=length,
+        )
+
+    return listener
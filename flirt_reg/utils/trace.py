@@ -0,0 +1,112 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Records a span for every stage of every image in Chrome trace-event
+# format (load the saved json in chrome://tracing or ui.perfetto.dev).
+# Timestamps are epoch microseconds so spans recorded by queue workers on
+# other nodes can be merged into the coordinator's trace.
+
+
+def cpu_time():
+    """
+    CPU seconds used by this process and its finished children. FSL runs
+    in child processes, so with several jobs at once a span also counts
+    children of other images that exit while it is open.
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class Span:
+    """
+    Handle for an open span, stages report the files they read and wrote
+    """
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self, *paths):
+        for path in paths:
+            if path and os.path.isfile(path):
+                self.bytes_read += os.path.getsize(path)
+
+    def wrote(self, *paths):
+        for path in paths:
+            if path and os.path.isfile(path):
+                self.bytes_written += os.path.getsize(path)
+
+
+class Tracer:
+    """
+    Collects spans, listeners are called with each finished event
+    """
+
+    def __init__(self, pid=None):
+        self.events = []
+        self.pid = pid or os.getpid()
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add_event(self, event):
+        with self._lock:
+            self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+
+    def extend(self, events):
+        """
+        Merges events recorded elsewhere, e.g. by a queue worker
+        """
+        for event in events:
+            self.add_event(event)
+
+    def to_chrome(self):
+        return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def save(self, fname):
+        with open(fname, "w") as file:
+            json.dump(self.to_chrome(), file)
+        print(f"Trace saved to {fname}")
+
+
+@contextmanager
+def span(tracer, name, image=None, worker=0):
+    """
+    Times the enclosed stage and records it on tracer, which may be None
+    """
+    handle = Span()
+    start_wall = time.time()
+    start_perf = time.perf_counter()
+    start_cpu = cpu_time()
+    try:
+        yield handle
+    finally:
+        if tracer is not None:
+            wall = time.perf_counter() - start_perf
+            tracer.add_event(
+                {
+                    "name": name,
+                    "cat": "flirt_reg",
+                    "ph": "X",
+                    "ts": int(start_wall * 1e6),
+                    "dur": int(wall * 1e6),
+                    "pid": tracer.pid,
+                    "tid": worker,
+                    "args": {
+                        "image": image,
+                        "worker": worker,
+                        "wall_s": wall,
+                        "cpu_s": cpu_time() - start_cpu,
+                        "bytes_read": handle.bytes_read,
+                        "bytes_written": handle.bytes_written,
+                    },
+                }
+            )
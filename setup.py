@@ -16,11 +16,12 @@ setup(
     download_url="",
     keywords=["MRI", "FLS", "FLIRT", "registration", "imaging"],
     classifiers=[],
-    install_requires=["numpy", "scipy", "nipype"],
+    install_requires=["numpy", "scipy", "nibabel"],
     entry_points={
         "console_scripts": [
             "flirt-reg = flirt_reg.__main__:main",
             "flirt-apply = flirt_reg.reg.flirt_reg:apply_transform_cmd",
+            "flirt-catalog = flirt_reg.utils.nii:catalog_cmd",
         ]
     },
     extras_require={